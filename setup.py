@@ -4,7 +4,7 @@
 
 """
 
-from setuptools import setup
+from setuptools import setup, find_packages
 import os
 
 # Note: Make sure to use `pip -v` when pip-installing, so you can check what is being installed.
@@ -30,7 +30,7 @@ See `README.md` for installation and usage.
 setup(
     name='zepto-lims',
     version='2019.9.20',  # remember to also update __init__.py
-    packages=['zepto_lims'],  # List all packages (directories) to include in the source dist.
+    packages=find_packages(include=['zepto_lims', 'zepto_lims.*']),  # Include all sub-packages.
     url='https://github.com/scholer/zepto-lims',
     license='GNU General Public License v3 (GPLv3)',
     author='Rasmus Scholer Sorensen',
@@ -40,8 +40,9 @@ setup(
     long_description_content_type='text/markdown',
     keywords=['LIMS', 'tracking', 'tubes', 'laboratory inventory management system'],
     entry_points={
-        # 'console_scripts': [
-        # ],
+        'console_scripts': [
+            'zepto-batch-scan=zepto_lims.apps.tubetracker_cli:main',
+        ],
         # 'gui_scripts': [
         # ]
     },
@@ -51,6 +52,9 @@ setup(
         'click',            # CLI package. (Only used for auxiliary CLI programs)
         'pylibdmtx',        # Datamatrix barcode scanner.
     ],
+    extras_require={
+        'xxhash': ['xxhash'],  # Faster hashing of cell images for the decode cache (falls back to blake2b).
+    },
     python_requires='>=3.6',  # Type-hints, f-strings,
     classifiers=[
         # How mature is this project? Common values are
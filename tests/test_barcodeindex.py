@@ -0,0 +1,34 @@
+# Copyright 2019, Rasmus Sorensen <rasmusscholer@gmail.com>
+"""
+
+
+"""
+
+import pandas as pd
+from io import StringIO
+
+from tests.testdata.table_data import TUBES_DATA_CSV_MULTI
+from zepto_lims.trackers.barcodeindex import BarcodeBoxIndex
+
+
+def test_barcode_box_index():
+    index = BarcodeBoxIndex.from_tubes_df(pd.read_csv(StringIO(TUBES_DATA_CSV_MULTI)))
+    assert len(index) == 11
+    assert index.get_box('tube1') == 'box2'
+    assert index.box_sizes == {'box1': 4, 'box2': 5, 'box3': 2}
+
+    scan = {'First', 'Second', 'Third', 'tube1', 'tube2', 'One', 'new-tube'}
+    # Only boxes sharing a barcode with the scan are scored, as (common, added, removed):
+    assert index.match_counts(scan) == {'box1': (3, 4, 1), 'box2': (2, 5, 3), 'box3': (1, 6, 1)}
+    top = index.top_matches(scan, k=2)
+    assert list(top.index) == ['box1', 'box2']
+    assert list(top.loc['box1', ['common', 'added', 'removed']]) == [3, 4, 1]
+    assert index.top_matches({'unknown'}).empty
+
+    # Incremental updates:
+    index.move('Fourth', '(missing)')
+    index.move_many(['One', 'Two'], 'box1')
+    index.move('new-tube', 'box1')
+    index.remove('tube9')
+    assert index.box_sizes == {'box1': 6, 'box2': 4, '(missing)': 1}
+    assert index.match_counts({'One', 'tube9'}) == {'box1': (1, 1, 5)}
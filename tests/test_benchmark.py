@@ -0,0 +1,93 @@
+# Copyright 2019, Rasmus Sorensen <rasmusscholer@gmail.com>
+"""
+
+Run the decode benchmark as part of the test suite.
+
+Set the `ZEPTO_BENCHMARK_BASELINE` environment variable to a JSON file from a previous benchmark run
+(`python -m zepto_lims.scanners.benchmark --output baseline.json`) to fail on throughput regressions.
+
+"""
+
+import json
+import os
+from pathlib import Path
+import numpy as np
+import pytest
+from click.testing import CliRunner
+
+from zepto_lims.scanners.benchmark import (
+    run_benchmark, compare_benchmark_results, grid_params_for_image, latency_percentiles, main,
+    print_benchmark_results, measure_cell_latencies,
+)
+
+TEST_DATA_DIR = Path(__file__).parent / 'testdata'
+TEST_IMAGES = sorted((TEST_DATA_DIR / 'images').glob('*.jpg'))
+
+
+def test_grid_params_for_image():
+    assert grid_params_for_image('datamatrix_x4_50pct-90.jpg')[-1] == (4, 1)
+    assert grid_params_for_image('datamatrix_x1_02.jpg')[-1] == (1, 1)
+
+
+def test_latency_percentiles():
+    assert latency_percentiles([0.001] * 10) == {'p50': 1.0, 'p90': 1.0, 'p99': 1.0}
+
+
+def test_print_benchmark_results_missing_values(capsys):
+    summary = {'images_per_s': None, 'cell_latency_ms': latency_percentiles([]), 'success_rate': 0.0,
+               'peak_memory_mb': 1.0}
+    print_benchmark_results({'configs': {'empty': summary}})
+    assert capsys.readouterr().out.splitlines()[1].split() == ['empty', 'n/a', 'n/a', 'n/a', 'n/a', '0.0%', '1.0']
+
+
+def test_measure_cell_latencies_config():
+    image = np.full((40, 40), 255, np.uint8)
+    # Config keys other than the ladder (e.g. skipping empty wells) are used:
+    assert len(measure_cell_latencies(image, (0, None, 0, None, (2, 2)), {'skip_empty': True})) == 4
+    with pytest.raises(TypeError):
+        measure_cell_latencies(image, (0, None, 0, None, (2, 2)), {'unknown_option': 1})
+    assert latency_percentiles([])['p50'] is None
+
+
+def test_run_benchmark(tmp_path):
+    configs = {'lid': {'mode': 'lid'}, 'grid': {}}
+    results = run_benchmark(TEST_IMAGES, configs=configs, repeats=1)
+    assert set(results['configs']) == {'lid', 'grid'}
+    for summary in results['configs'].values():
+        assert summary['images_per_s'] > 0
+        assert 0 <= summary['success_rate'] <= 1
+        assert set(summary['images']) == {image_file.name for image_file in TEST_IMAGES}
+        assert summary['cell_latency_ms']['p50'] <= summary['cell_latency_ms']['p99']
+    assert results['configs']['grid']['images']['datamatrix_x4_50pct-90.jpg']['cells'] == 4
+    json.dumps(results)  # Results must be JSON-serializable.
+
+    # Compare against a "baseline" with twice the throughput:
+    baseline = json.loads(json.dumps(results))
+    assert compare_benchmark_results(results, baseline) == []
+    baseline['configs']['grid']['images_per_s'] *= 2
+    assert [config_name for config_name, *_ in compare_benchmark_results(results, baseline)] == ['grid']
+    assert compare_benchmark_results(results, baseline, threshold=0.6) == []
+
+
+def test_benchmark_cli(tmp_path):
+    output = tmp_path / 'results.json'
+    configs = tmp_path / 'configs.json'
+    configs.write_text(json.dumps({'lid': {'mode': 'lid'}}))
+    args = [str(f) for f in TEST_IMAGES] + ['--configs', str(configs), '--repeats', '1', '--output', str(output)]
+    assert CliRunner().invoke(main, args).exit_code == 0
+    results = json.loads(output.read_text())
+    results['configs']['lid']['images_per_s'] *= 100
+    baseline = tmp_path / 'baseline.json'
+    baseline.write_text(json.dumps(results))
+    result = CliRunner().invoke(main, args + ['--baseline', str(baseline)])
+    assert result.exit_code == 1
+    assert "REGRESSION: lid" in result.output
+
+
+@pytest.mark.skipif(not os.environ.get('ZEPTO_BENCHMARK_BASELINE'), reason="No benchmark baseline given.")
+def test_benchmark_regression():
+    with open(os.environ['ZEPTO_BENCHMARK_BASELINE']) as fp:
+        baseline = json.load(fp)
+    threshold = float(os.environ.get('ZEPTO_BENCHMARK_THRESHOLD', 0.2))
+    results = run_benchmark()
+    assert compare_benchmark_results(results, baseline, threshold=threshold) == []
@@ -4,6 +4,10 @@
 
 """
 
+from collections import namedtuple
+import asyncio
+import threading
+import time
 from pathlib import Path
 from pprint import pprint
 import numpy as np
@@ -13,8 +17,13 @@ from zepto_lims.utils.image import imread, imshow
 
 
 from zepto_lims.scanners.boxscanner import (
-    segment_image_to_grid, scan_barcodes_in_grid, scan_lid_barcode,
+    segment_image_to_grid, segment_image_to_grid_array, scan_barcodes_in_grid, scan_lid_barcode, get_decode_executor, BoxScanner,
+    scan_box_grid, AggregatingBoxScanner, grid_cell_from_point, rect_center, WHOLE_IMAGE_RUNG,
+    scan_box_grid_with_prior, iter_scan_box_grid, aiter_scan_box_grid, ScanEvent, scan_lid_region, map_cells,
 )
+from zepto_lims.utils.gridpos import val_pos_dict_from_grid
+from zepto_lims.scanners.dmtx_reader import decode_kwargs_for_rung, DEFAULT_DECODE_LADDER
+from zepto_lims.scanners.decodecache import DecodeCache
 
 TEST_DATA_DIR = Path(__file__).parent / 'testdata'
 
@@ -62,6 +71,22 @@ def test_segment_image_to_grid():
     assert all(len(row) == 9 for row in img_segments)
     pprint([[im.shape for im in row] for row in img_segments])
     assert all([im.shape == (20, 10) for row in img_segments for im in row])
+    # The segments are views into the original image:
+    assert all(np.shares_memory(im, RANDOM_IMAGE_260x220) for row in img_segments for im in row)
+
+
+def test_segment_image_to_grid_array():
+    grid_params = (30, -30, 65, -65, (10, 9))
+    cells = segment_image_to_grid_array(RANDOM_IMAGE_260x220, grid_params=grid_params)
+    assert cells.shape == (10, 9, 20, 10)
+    assert np.shares_memory(cells, RANDOM_IMAGE_260x220)
+    img_segments = segment_image_to_grid(RANDOM_IMAGE_260x220, grid_params=grid_params)
+    assert all(np.array_equal(cells[r, c], img_segments[r][c]) for r in range(10) for c in range(9))
+
+    # Cell sizes are rounded down when the image is not a multiple of the grid shape:
+    cells = segment_image_to_grid_array(RANDOM_IMAGE_160x90, grid_params=(None, None, None, None, (3, 4)))
+    assert cells.shape == (3, 4, 53, 22)
+    assert np.array_equal(cells[2, 3], RANDOM_IMAGE_160x90[106:159, 66:88])
 
 
 def test_scan_lid_barcode():
@@ -70,6 +95,18 @@ def test_scan_lid_barcode():
     assert barcode_str == '20190729 RS123d1 Sample Test description'
 
 
+def test_scan_lid_region():
+    # Use the top tube in the 4x image as "lid barcode":
+    expected = scan_barcodes_in_grid(datamatrix_4x_image, grid_params=(10, -1, 20, -10, (4, 1)))[0][0]
+    region = (10, 240, 20, -10)
+    assert scan_lid_region(datamatrix_4x_image, region) == expected
+    assert scan_lid_region(datamatrix_4x_image, (0, 5, 0, 5)) is None
+    assert scan_lid_region(datamatrix_1x_image, None) == '20190729 RS123d1 Sample Test description'
+    assert BoxScanner({}).scan_box_lid_barcode(datamatrix_4x_image) is None  # No lid region configured.
+    boxscanner = BoxScanner({'boxscanner_lid_barcode_region': list(region)})
+    assert boxscanner.scan_box_lid_barcode(datamatrix_4x_image) == expected
+
+
 def test_scan_barcodes_in_grid():
     # `top`, `bottom`, `left`, `right`, `shape`
     grid_params = (10, -1, 20, -10, (4, 1))  # rows, cols
@@ -88,6 +125,232 @@ def test_scan_barcodes_in_grid():
     assert barcodes_grid == expected
 
 
+def test_scan_barcodes_in_grid_executor():
+    # Parallel decoding must give the same grid (in the same order) as serial decoding:
+    grid_params = (10, -1, 20, -10, (4, 1))  # rows, cols
+    expected = scan_barcodes_in_grid(datamatrix_4x_image, grid_params=grid_params)
+    for executor_type in ('thread', 'process'):
+        with get_decode_executor(executor_type, max_workers=2) as executor:
+            barcodes_grid = scan_barcodes_in_grid(datamatrix_4x_image, grid_params=grid_params, executor=executor)
+        assert barcodes_grid == expected
+
+    config = {
+        'boxscanner_box_margin': (10, -1, 20, -10),
+        'boxscanner_box_grid': (4, 1),
+        'boxscanner_decode_executor': 'thread',
+    }
+    scanner = BoxScanner(config)
+    assert scanner.scan_box_image_grid(datamatrix_4x_image) == expected
+    scanner.close()
+
+
+def test_map_cells_deadline():
+    calls = []
+
+    def slow_cell(cell, timeout=None):
+        calls.append(cell)
+        time.sleep(0.2)
+        return cell, timeout
+
+    # With a single worker, the second cell waits in the queue until after the deadline.
+    # It is then skipped by the worker, instead of being decoded after the deadline:
+    with get_decode_executor('thread', max_workers=1) as executor:
+        assert map_cells(slow_cell, {(0, 0): 'a', (0, 1): 'b'}, executor, deadline=time.perf_counter() + 0.1) == {}
+    assert calls == ['a']
+    assert map_cells(slow_cell, {(0, 0): 'a'}) == {(0, 0): ('a', None)}
+
+
+def test_decode_kwargs_for_rung():
+    rung = {'shrink': 2, 'max_count': 1, 'timeout': 50, 'edge_limits': (0.25, 1.0)}
+    decode_kwargs = decode_kwargs_for_rung(rung, (100, 80))
+    assert 'edge_limits' not in decode_kwargs
+    assert decode_kwargs['min_edge'] == 10  # 80 * 0.25 / shrink
+    assert decode_kwargs['max_edge'] == 101
+    assert decode_kwargs['timeout'] == 50
+    # The timeout is limited by the time remaining:
+    assert decode_kwargs_for_rung(rung, (100, 80), timeout=20)['timeout'] == 20
+    assert decode_kwargs_for_rung(rung, (100, 80), timeout=200)['timeout'] == 50
+    assert decode_kwargs_for_rung({}, (100, 80), timeout=0.2)['timeout'] == 1
+    assert decode_kwargs_for_rung({}, (100, 80)) == {}
+    # The rung itself must not be modified:
+    assert 'edge_limits' in rung
+    # Every default rung has a bounded timeout:
+    assert all(rung.get('timeout') for rung in DEFAULT_DECODE_LADDER)
+
+
+def test_scan_box_grid_ladder():
+    grid_params = (10, -1, 20, -10, (4, 1))  # rows, cols
+    expected = scan_barcodes_in_grid(datamatrix_4x_image, grid_params=grid_params)
+    scan_result = scan_box_grid(datamatrix_4x_image, grid_params=grid_params, ladder=DEFAULT_DECODE_LADDER)
+    assert scan_result.barcodes == expected
+    for barcodes_row, rungs_row in zip(scan_result.barcodes, scan_result.rungs):
+        for barcode, rung in zip(barcodes_row, rungs_row):
+            assert (barcode is None) == (rung is None)
+            assert rung is None or 0 <= rung < len(DEFAULT_DECODE_LADDER)
+
+    # An exhausted time budget should not decode anything:
+    scan_result = scan_box_grid(datamatrix_4x_image, grid_params=grid_params, time_budget=0)
+    assert scan_result.barcodes == [[None], [None], [None], [None]]
+
+
+def test_grid_cell_from_point():
+    # Same cell boundaries as segment_image_to_grid():
+    assert grid_cell_from_point(0, 0, 100, 50, (10, 5)) == (0, 0)
+    assert grid_cell_from_point(9.9, 9.9, 100, 50, (10, 5)) == (0, 0)
+    assert grid_cell_from_point(10, 10, 100, 50, (10, 5)) == (1, 1)
+    assert grid_cell_from_point(49, 99, 100, 50, (10, 5)) == (9, 4)
+    assert grid_cell_from_point(50, 99, 100, 50, (10, 5)) is None
+    assert grid_cell_from_point(-1, 0, 100, 50, (10, 5)) is None
+    # libdmtx rects have origin in the bottom left corner:
+    rect = namedtuple('Rect', 'left top width height')(10, 20, 30, 40)
+    assert rect_center(rect, image_height=100) == (25, 60)
+
+
+def test_scan_box_grid_whole_image():
+    grid_params = (10, -1, 20, -10, (4, 1))  # rows, cols
+    expected = scan_barcodes_in_grid(datamatrix_4x_image, grid_params=grid_params)
+    scan_result = scan_box_grid(datamatrix_4x_image, grid_params=grid_params, whole_image=True, fallback=True)
+    for expected_row, barcodes_row, rungs_row in zip(expected, scan_result.barcodes, scan_result.rungs):
+        for expected_barcode, barcode, rung in zip(expected_row, barcodes_row, rungs_row):
+            # The whole-image pass must assign each barcode to the correct cell:
+            if rung == WHOLE_IMAGE_RUNG and expected_barcode is not None:
+                assert barcode == expected_barcode
+            # Cells not found by the whole-image pass are found by the per-cell fallback:
+            if expected_barcode is not None:
+                assert barcode is not None
+
+
+def test_scan_box_grid_skip_empty():
+    grid_params = (10, -1, 20, -10, (4, 1))  # rows, cols
+    expected = scan_barcodes_in_grid(datamatrix_4x_image, grid_params=grid_params)
+    scan_result = scan_box_grid(datamatrix_4x_image, grid_params=grid_params, skip_empty=True)
+    # None of the cells in this image are empty:
+    assert all(status != 'empty' for row in scan_result.cell_status for status in row)
+    assert scan_result.barcodes == expected
+    # Cells classified as empty are not decoded:
+    blank_image = np.full((100, 100), 200, dtype=np.uint8)
+    scan_result = scan_box_grid(blank_image, grid_params=(None, None, None, None, 2), skip_empty=True)
+    assert scan_result.cell_status == [['empty', 'empty'], ['empty', 'empty']]
+    assert scan_result.rungs == [[None, None], [None, None]]
+
+
+def test_scan_box_grid_decode_cache():
+    grid_params = (10, -1, 20, -10, (4, 1))  # rows, cols
+    cache = DecodeCache()
+    first = scan_box_grid(datamatrix_4x_image, grid_params=grid_params, ladder=DEFAULT_DECODE_LADDER, cache=cache)
+    misses = cache.info()['misses']
+    assert misses > 0
+    assert cache.info()['hits'] == 0
+    # Re-scanning the same image only uses cached results:
+    second = scan_box_grid(datamatrix_4x_image, grid_params=grid_params, ladder=DEFAULT_DECODE_LADDER, cache=cache)
+    assert second == first
+    assert cache.info()['misses'] == misses
+    assert cache.info()['hits'] == misses
+
+
+def test_scan_box_grid_with_prior():
+    # Box with barcodes in the first column and empty wells in the second column:
+    blank = 200 + np.random.RandomState(0).randint(-2, 3, datamatrix_4x_image.shape)
+    box_image = np.hstack([datamatrix_4x_image, blank.astype(np.uint8)])
+    grid_params = (10, -1, 20, -10, (4, 2))  # rows, cols
+    full = scan_box_grid(box_image, grid_params=grid_params)
+    prior = {(row, col): barcode for row, cols in enumerate(full.barcodes)
+             for col, barcode in enumerate(cols) if barcode is not None}
+    assert len(prior) >= 3
+    # Unchanged box: Only the previously occupied cells are decoded (one cache entry per decoded cell):
+    cache = DecodeCache()
+    result = scan_box_grid_with_prior(box_image, prior, grid_params=grid_params, cache=cache, verify_fraction=0)
+    assert result.confirmed is True
+    assert result.barcodes == full.barcodes
+    assert len(cache) == len(prior)
+    # A random sample of the empty wells is verified:
+    cache = DecodeCache()
+    result = scan_box_grid_with_prior(
+        box_image, val_pos_dict_from_grid(full.barcodes), grid_params=grid_params, cache=cache,
+        verify_fraction=0.5, random_state=0)
+    assert result.confirmed is True
+    assert len(cache) == len(prior) + 2
+    # Changed box: All remaining cells are checked:
+    changed_prior = {cell: barcode + '-old' for cell, barcode in prior.items()}
+    result = scan_box_grid_with_prior(box_image, changed_prior, grid_params=grid_params)
+    assert result.confirmed is False
+    assert result.barcodes == full.barcodes
+    # The AggregatingBoxScanner also accepts a prior:
+    scanner = AggregatingBoxScanner({'boxscanner_box_margin': grid_params[:4], 'boxscanner_box_grid': grid_params[4]})
+    assert scanner.scan_box_image_grid(box_image, prior=prior) == full.barcodes
+    assert scanner.last_scan_result.confirmed is True
+
+
+def test_iter_scan_box_grid():
+    grid_params = (10, -1, 20, -10, (4, 1))  # rows, cols
+    expected = scan_barcodes_in_grid(datamatrix_4x_image, grid_params=grid_params)
+    events = list(iter_scan_box_grid(datamatrix_4x_image, grid_params=grid_params))
+    assert all(isinstance(event, ScanEvent) for event in events)
+    assert [(event.row, event.col) for event in events] == [(row, 0) for row in range(4)]
+    assert [event.barcode for event in events] == [row[0] for row in expected]
+    assert all(a.timing <= b.timing for a, b in zip(events, events[1:]))
+    with get_decode_executor('thread', max_workers=2) as executor:
+        events = list(iter_scan_box_grid(datamatrix_4x_image, grid_params=grid_params, executor=executor))
+        assert sorted((event.row, event.barcode) for event in events) == sorted(
+            (row, barcodes[0]) for row, barcodes in enumerate(expected))
+        # Cancellation, either by closing the generator or using a cancel event:
+        scan = iter_scan_box_grid(datamatrix_4x_image, grid_params=grid_params, executor=executor)
+        next(scan)
+        scan.close()
+    cancel_event = threading.Event()
+    cancel_event.set()
+    assert list(iter_scan_box_grid(datamatrix_4x_image, grid_params=grid_params, cancel_event=cancel_event)) == []
+
+
+def test_iter_scan_box_grid_process_executor_with_cache():
+    # The cache holds a lock and cannot be pickled, so it must only be used in the calling process:
+    grid_params = (10, -1, 20, -10, (4, 1))  # rows, cols
+    expected = scan_barcodes_in_grid(datamatrix_4x_image, grid_params=grid_params)
+    cache = DecodeCache()
+    with get_decode_executor('process', max_workers=2) as executor:
+        events = list(iter_scan_box_grid(datamatrix_4x_image, grid_params=grid_params, executor=executor, cache=cache))
+        assert sorted((event.row, event.barcode) for event in events) == sorted(
+            (row, barcodes[0]) for row, barcodes in enumerate(expected))
+        assert len(cache) > 0
+        hits = cache.hits
+        events = list(iter_scan_box_grid(datamatrix_4x_image, grid_params=grid_params, executor=executor, cache=cache))
+        assert sorted((event.row, event.barcode) for event in events) == sorted(
+            (row, barcodes[0]) for row, barcodes in enumerate(expected))
+        assert cache.hits > hits
+
+
+def test_aiter_scan_box_grid():
+    grid_params = (10, -1, 20, -10, (4, 1))  # rows, cols
+    expected = scan_barcodes_in_grid(datamatrix_4x_image, grid_params=grid_params)
+
+    async def collect():
+        return [event async for event in aiter_scan_box_grid(datamatrix_4x_image, grid_params=grid_params)]
+    events = asyncio.new_event_loop().run_until_complete(collect())
+    assert sorted((event.row, event.barcode) for event in events) == sorted(
+        (row, barcodes[0]) for row, barcodes in enumerate(expected))
+
+
+def test_aggregating_box_scanner():
+    grid_params = (10, -1, 20, -10, (4, 1))  # rows, cols
+    expected = scan_barcodes_in_grid(datamatrix_4x_image, grid_params=grid_params)
+    config = {
+        'boxscanner_box_margin': (10, -1, 20, -10),
+        'boxscanner_box_grid': (4, 1),
+        'aggregatingboxscanner_stable_frames': 2,
+    }
+    scanner = AggregatingBoxScanner(config)
+    assert scanner.scan_frames([datamatrix_4x_image] * 10) == expected
+    # The grid is not complete (one cell doesn't scan), so it stops after 2 frames without new barcodes:
+    assert scanner.frames_scanned == 3
+    assert scanner.known_cells == {(row, 0) for row in range(4) if expected[row][0] is not None}
+
+    # Regular BoxScanner can also be used repeatedly:
+    scanner = BoxScanner(config)
+    scanner.scan_box_image_grid(datamatrix_4x_image)
+    assert scanner.scan_box_image_grid(datamatrix_4x_image) == expected
+    assert scanner.best_box_scan == expected
+
+
 def adhoc():
 
     imshow(datamatrix_4x_image)
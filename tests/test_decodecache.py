@@ -0,0 +1,47 @@
+# Copyright 2019, Rasmus Sorensen <rasmusscholer@gmail.com>
+"""
+
+
+"""
+
+import numpy as np
+
+from zepto_lims.scanners.decodecache import DecodeCache, cell_hash, decode_args_key
+
+
+def test_cell_hash():
+    image = np.random.randint(0, 256, (100, 100)).astype(np.uint8)
+    # Views with the same pixels have the same hash, regardless of memory layout:
+    assert cell_hash(image[10:20, 30:40]) == cell_hash(image[10:20, 30:40].copy())
+    assert cell_hash(image[10:20, 30:40]) != cell_hash(image[10:20, 31:41])
+    # Shape and dtype are part of the hash:
+    assert cell_hash(image[:10, :10]) != cell_hash(image[:10, :10].reshape(1, 100))
+    assert cell_hash(image) != cell_hash(image.astype(np.int8))
+
+
+def test_decode_args_key():
+    assert decode_args_key({'shrink': 2, 'timeout': 50}) == decode_args_key({'timeout': 50, 'shrink': 2})
+    assert decode_args_key({'edge_limits': [0.25, 1.0]}) != decode_args_key({'edge_limits': [0.25, 0.9]})
+
+
+def test_decode_cache():
+    cache = DecodeCache(maxsize=2)
+    assert cache.lookup('a') == (False, None)
+    cache.put('a', 'barcode-a')
+    cache.put('b', None)  # Cached "no barcode found".
+    assert cache.lookup('a') == (True, 'barcode-a')
+    assert cache.lookup('b') == (True, None)
+    # 'a' is now the least-recently used and is evicted:
+    cache.lookup('b')
+    cache.put('c', 'barcode-c')
+    assert cache.lookup('a') == (False, None)
+    assert cache.lookup('c') == (True, 'barcode-c')
+    assert cache.info() == {'hits': 4, 'misses': 2, 'size': 2, 'maxsize': 2}
+    cache.clear()
+    assert len(cache) == 0
+    assert cache.info()['hits'] == 0
+
+    # maxsize=0 disables the cache:
+    cache = DecodeCache(maxsize=0)
+    cache.put('a', 'barcode-a')
+    assert cache.lookup('a') == (False, None)
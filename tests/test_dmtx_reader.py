@@ -0,0 +1,113 @@
+# Copyright 2019, Rasmus Sorensen <rasmusscholer@gmail.com>
+"""
+
+
+"""
+
+from pathlib import Path
+import numpy as np
+import pytest
+
+from zepto_lims.utils.image import imread
+from zepto_lims.scanners import dmtx_reader
+from zepto_lims.scanners.boxscanner import BoxScanner
+from zepto_lims.scanners.dmtx_reader import (
+    Decoded, Rect, register_decoder_backend, load_decoder_backend, available_decoder_backends,
+    select_decoder_backend, decode_barcodes_from_image,
+    decode_barcode_from_image, unregister_decoder_backend, DECODER_BACKENDS, DEFAULT_DECODE_LADDER,
+)
+
+TEST_DATA_DIR = Path(__file__).parent / 'testdata'
+
+
+def make_backend(name, data, calls):
+    """ Return loader for a test backend, which returns `data` for bright images and records each call. """
+    def loader():
+        def decode(image, **decode_kwargs):
+            calls.append(name)
+            return [Decoded(data, Rect(0, 0, 10, 10))] if np.mean(image) > 128 else []
+        return decode
+    return loader
+
+
+def missing_backend():
+    raise ImportError("Backend not installed.")
+
+
+@pytest.fixture
+def test_backends():
+    calls = []
+    register_decoder_backend('test_a', make_backend('test_a', b'A', calls))
+    register_decoder_backend('test_b', make_backend('test_b', b'B', calls))
+    register_decoder_backend('test_missing', missing_backend)
+    yield calls
+    for name in ('test_a', 'test_b', 'test_missing'):
+        unregister_decoder_backend(name)
+
+
+def test_decoder_backends(test_backends):
+    calls = test_backends
+    bright, dark = np.full((20, 20), 200, np.uint8), np.zeros((20, 20), np.uint8)
+    assert load_decoder_backend('test_a') is load_decoder_backend('test_a')  # Only loaded once.
+    with pytest.raises(ImportError):
+        load_decoder_backend('test_missing')
+    with pytest.raises(ValueError):
+        load_decoder_backend('unregistered')
+    assert {'test_a', 'test_b'} <= set(available_decoder_backends())
+    assert 'test_missing' not in available_decoder_backends()
+
+    assert decode_barcode_from_image(bright, backend='test_b') == 'B'
+    assert decode_barcode_from_image(bright, backend='test_a') == 'A'
+
+    # Fallback chain: The second backend is only tried if the first one fails:
+    del calls[:]
+    assert decode_barcodes_from_image(bright, backend=('test_a', 'test_b'))[0].data == b'A'
+    assert calls == ['test_a']
+    del calls[:]
+    assert decode_barcodes_from_image(dark, backend=('test_a', 'test_b')) == []
+    assert calls == ['test_a', 'test_b']
+    with pytest.raises(ValueError):
+        decode_barcodes_from_image(bright, backend='unregistered')
+
+
+def test_unregister_decoder_backend(test_backends):
+    load_decoder_backend('test_a')
+    unregister_decoder_backend('test_a')
+    assert 'test_a' not in DECODER_BACKENDS
+    assert 'test_a' not in dmtx_reader._loaded_backends
+    with pytest.raises(ValueError):
+        load_decoder_backend('test_a')
+
+
+def test_select_decoder_backend(test_backends):
+    bright = np.full((20, 20), 200, np.uint8)
+    best, timings = select_decoder_backend(bright, 'B', backends=['test_a', 'test_b'])
+    assert best == 'test_b'
+    assert set(timings) == {'test_b'}
+    assert select_decoder_backend(bright, 'C', backends=['test_a', 'test_b']) == (None, {})
+
+
+def test_select_decoder_backend_installed():
+    image = imread(TEST_DATA_DIR / 'images' / 'datamatrix_x1_02_25pct-q90.jpg')
+    best, timings = select_decoder_backend(image, '20190729 RS123d1 Sample Test description')
+    assert set(timings) <= set(available_decoder_backends())
+    if timings:
+        assert best == min(timings, key=timings.get)
+
+
+def test_box_scanner_decoder_backend(test_backends):
+    # The backend is added to the scanner's decode arguments, without changing the default backend:
+    with pytest.warns(UserWarning):
+        scanner = BoxScanner({'boxscanner_decoder_backend': ['test_missing', 'test_b']})
+    assert scanner.selected_decoder_backend == ('test_b',)
+    assert all(rung['backend'] == ('test_b',) for rung in scanner.decode_ladder)
+    assert scanner.rung_with_backend({'backend': 'test_a'}) == {'backend': 'test_a'}
+    assert BoxScanner({}).decode_ladder == tuple(DEFAULT_DECODE_LADDER)
+    bright = np.full((20, 20), 200, np.uint8)
+    assert scanner.scan_box_lid_barcode(bright) is None  # No lid barcode region configured.
+    scanner.config['boxscanner_lid_barcode_region'] = (None, None, None, None)
+    assert scanner.scan_box_lid_barcode(bright) == 'B'
+    with pytest.warns(UserWarning):
+        assert BoxScanner({'boxscanner_decoder_backend': 'test_missing'}).selected_decoder_backend is None
+    with pytest.raises(ValueError):
+        BoxScanner({'boxscanner_decoder_backend': 'unregistered'})
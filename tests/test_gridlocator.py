@@ -0,0 +1,72 @@
+# Copyright 2019, Rasmus Sorensen <rasmusscholer@gmail.com>
+"""
+
+
+"""
+
+import numpy as np
+
+from zepto_lims.scanners.gridlocator import (
+    GridParams, GridCalibrationCache, locate_box_grid, validate_box_grid, box_grid_score
+)
+from zepto_lims.scanners.boxscanner import BoxScanner, estimate_box_grid_params
+
+
+def make_box_image(shape=(700, 600), top=40, left=55, pitch=(55.3, 48.7), grid_shape=(10, 10), seed=0):
+    """ Make a synthetic box image with dark 3-px dividers and random "barcodes" in some of the cells. """
+    rng = np.random.RandomState(seed)
+    image = rng.normal(170, 8, shape)
+    nrows, ncols = grid_shape
+    bottom, right = int(top + nrows * pitch[0]) + 3, int(left + ncols * pitch[1]) + 3
+    for row in range(nrows + 1):
+        y = int(round(top + row * pitch[0]))
+        image[y:y+3, left:right] = 40
+    for col in range(ncols + 1):
+        x = int(round(left + col * pitch[1]))
+        image[top:bottom, x:x+3] = 40
+    size = int(min(pitch) * 0.3)
+    for row in range(nrows):
+        for col in range(ncols):
+            if rng.rand() < 0.6:
+                y, x = int(top + (row + 0.5) * pitch[0]), int(left + (col + 0.5) * pitch[1])
+                image[y-size:y+size, x-size:x+size] = rng.choice([20, 240], (2*size, 2*size))
+    return image.clip(0, 255).astype(np.uint8)
+
+
+def test_locate_box_grid():
+    for seed, (top, left) in enumerate([(40, 55), (61, 40), (20, 90)]):
+        image = make_box_image(top=top, left=left, seed=seed)
+        grid_params, score = locate_box_grid(image, grid_shape=(10, 10))
+        assert isinstance(grid_params, GridParams)
+        expected = (top, int(round(top + 10 * 55.3)), left, int(round(left + 10 * 48.7)))
+        assert np.all(np.abs(np.array(grid_params[:4]) - expected) <= 3)
+        assert score == box_grid_score(image, grid_params)
+        assert validate_box_grid(image, grid_params, min_score=0.7*score)
+        # Shifting the grid by half a cell should fail the validation:
+        shifted = grid_params._replace(top=grid_params.top + 27, bottom=grid_params.bottom + 27)
+        assert not validate_box_grid(image, shifted, min_score=0.7*score)
+    assert estimate_box_grid_params(image, 10) == grid_params
+
+
+def test_grid_calibration_cache(tmp_path):
+    filepath = tmp_path / 'grid_calibrations.json'
+    cache = GridCalibrationCache(filepath)
+    assert cache.get('cam1', '10x10') is None
+    grid_params = GridParams(40, 593, 55, 542, (10, 10))
+    cache.set('cam1', '10x10', grid_params, 7.5)
+    assert GridCalibrationCache(filepath).get('cam1', '10x10') == (grid_params, 7.5)
+    assert GridCalibrationCache(filepath).get('cam2', '10x10') is None
+
+
+def test_box_scanner_auto_grid():
+    scanner = BoxScanner({'boxscanner_box_margin': 'auto', 'boxscanner_box_grid': (10, 10)})
+    image = make_box_image()
+    grid_params = scanner.get_box_grid_params(image)
+    assert scanner.grid_calibrations.get('default', '10x10')[0] == grid_params
+    # Cached calibration is re-used for a new image of the same box position:
+    calibration = scanner.grid_calibrations.get('default', '10x10')
+    assert scanner.get_box_grid_params(make_box_image(seed=5)) == grid_params
+    assert scanner.grid_calibrations.get('default', '10x10') == calibration
+    # ... but re-located if the box has moved:
+    moved = scanner.get_box_grid_params(make_box_image(top=80, left=20))
+    assert abs(moved.top - 80) <= 3 and abs(moved.left - 20) <= 3
@@ -0,0 +1,69 @@
+# Copyright 2019, Rasmus Sorensen <rasmusscholer@gmail.com>
+"""
+
+Module for testing the tube history index (point-in-time queries).
+
+"""
+
+from datetime import datetime
+import pandas as pd
+
+from zepto_lims.trackers.history import TubeHistoryIndex, TubeLocation
+from zepto_lims.trackers.tubetracker import TubeTrackerDf
+from tests.test_journal_csv_df_store import make_datastore
+
+
+EVENTS = pd.DataFrame([
+    # timestamp, scan_id, barcode, old_boxname, old_pos, new_boxname, new_pos
+    ('2019-01-01T10:00:00', 's1', 'tube1', '', '', 'box1', 'A01'),
+    ('2019-01-01T10:00:00', 's1', 'tube2', '', '', 'box1', 'A02'),
+    ('2019-02-01T10:00:00', 's2', 'tube1', 'box1', 'A01', 'box2', 'B01'),
+    ('2019-02-01T10:00:00', 's2', 'tube3', 'box3', 'C03', 'box2', 'B02'),
+    ('2019-03-01T10:00:00', 's3', 'tube2', 'box1', 'A02', 'box1', 'H12'),
+], columns=['timestamp', 'scan_id', 'barcode', 'old_boxname', 'old_pos', 'new_boxname', 'new_pos'])
+
+
+def test_tube_history_index():
+    index = TubeHistoryIndex(EVENTS.iloc[:4])
+    index.extend(EVENTS.iloc[4:])
+    assert len(index) == 5
+    assert index.location_at('tube1', '2018-12-31') is None  # Did not exist yet.
+    assert index.location_at('tube1', '2019-01-15') == TubeLocation('box1', 'A01', pd.Timestamp('2019-01-01T10:00'))
+    assert index.location_at('tube1', '2019-02-01T10:00')[:2] == ('box2', 'B01')
+    # Before its first event, tube3 was at the old location of that event:
+    assert index.location_at('tube3', '2019-01-15') == TubeLocation('box3', 'C03', None)
+    assert index.location_at('unknown', '2019-01-15') is None
+
+    assert index.box_contents_at('box1', '2018-12-31') == {}
+    assert index.box_contents_at('box1', '2019-01-15') == {'tube1': 'A01', 'tube2': 'A02'}
+    assert index.box_contents_at('box1', '2019-02-15') == {'tube2': 'A02'}
+    assert index.box_contents_at('box1', '2019-03-15') == {'tube2': 'H12'}
+    assert index.box_contents_at('box2', '2019-02-15') == {'tube1': 'B01', 'tube3': 'B02'}
+    assert index.box_contents_at('box3', '2019-01-15') == {'tube3': 'C03'}
+    assert index.box_contents_at('box3', '2019-02-15') == {}
+
+    assert index.get_barcode_timeline('tube1')['new_boxname'].tolist() == ['box1', 'box2']
+    assert index.get_box_timeline('box1')['barcode'].tolist() == ['tube1', 'tube2', 'tube1', 'tube2']
+    assert index.get_box_timeline('box4').empty
+
+
+def test_tubetracker_as_of_queries(tmp_path):
+    make_datastore(tmp_path)
+    config = {'datastore_type': 'journal', 'datastore_root_dir': str(tmp_path)}
+    tracker = TubeTrackerDf(config)
+    before = datetime.now()
+    tracker.update_tubes_from_barcodes('box1', {'tube1': 'A01', 'tube3': 'B01'})
+    assert tracker.get_tube_location_at('tube3', before)[:2] == ('box2', 'A01')
+    assert tracker.get_tube_location_at('tube3', datetime.now())[:2] == ('box1', 'B01')
+    # tube1 has not moved, so it is at its current location:
+    assert tracker.get_tube_location_at('tube1', before) == TubeLocation('box1', 'A01', None)
+    assert tracker.get_tube_location_at('unknown', before) is None
+    assert tracker.get_box_contents_at('box1', before) == {'tube1': 'A01', 'tube2': 'B01'}
+    assert tracker.get_box_contents_at('box1', datetime.now()) == {'tube1': 'A01', 'tube3': 'B01'}
+
+    # A new tracker builds the history index from the journal; the index is extended with new scans:
+    tracker = TubeTrackerDf(config)
+    assert len(tracker.get_history_index()) == 2
+    tracker.update_tubes_from_barcodes('box2', {'tube2': 'A01'})
+    assert len(tracker.get_history_index()) == 3
+    assert tracker.get_tube_timeline('tube2')['new_boxname'].tolist() == ['(missing)', 'box2']
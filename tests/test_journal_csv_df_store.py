@@ -0,0 +1,141 @@
+# Copyright 2019, Rasmus Sorensen <rasmusscholer@gmail.com>
+"""
+
+Module for testing the journaling CSV datastore.
+
+"""
+
+import pandas as pd
+
+from zepto_lims.datastores.journal_csv_df_store import JournalCsvDfStore, read_journal, replay_journal
+from zepto_lims.trackers.tubetracker import TubeTrackerDf
+
+
+def make_datastore(folder):
+    pd.DataFrame({'boxname': ['box1', 'box2']}).to_csv(folder / 'Default_boxes.csv', index=False)
+    pd.DataFrame({
+        'boxname': ['box1', 'box1', 'box2'],
+        'barcode': ['tube1', 'tube2', 'tube3'],
+        'pos': ['A01', 'B01', 'A01'],
+    }).to_csv(folder / 'Default_tubes.csv', index=False)
+    return folder
+
+
+def make_tracker(folder, **config):
+    config = dict({'datastore_type': 'journal', 'datastore_root_dir': str(folder)}, **config)
+    return TubeTrackerDf(config)
+
+
+def test_replay_journal():
+    df = pd.DataFrame({'boxname': ['box1', 'box1'], 'barcode': ['tube1', 'tube2'], 'pos': ['A01', 'B01']})
+    events = pd.DataFrame({
+        'barcode': ['tube1', 'tube3', 'tube1'],
+        'new_boxname': ['box2', 'box2', 'box3'],
+        'new_pos': ['A01', 'A02', 'C03'],
+    })
+    replayed = replay_journal(df, events)
+    assert replayed.values.tolist() == [['box3', 'tube1', 'C03'], ['box1', 'tube2', 'B01'], ['box2', 'tube3', 'A02']]
+    assert df['boxname'].tolist() == ['box1', 'box1']  # Not modified in-place.
+    assert replay_journal(df, events.iloc[:0]) is df
+    # All rows of a duplicated barcode are updated:
+    df = pd.DataFrame({'boxname': ['box1', 'box2'], 'barcode': ['tube1', 'tube1'], 'pos': ['A01', 'B01']})
+    assert replay_journal(df, events).values.tolist() == [
+        ['box3', 'tube1', 'C03'], ['box3', 'tube1', 'C03'], ['box2', 'tube3', 'A02']]
+
+
+def test_journal_datastore(tmp_path):
+    make_datastore(tmp_path)
+    tracker = make_tracker(tmp_path, datastore_journal_compaction_events=100)
+    assert isinstance(tracker.data_client.datastore, JournalCsvDfStore)
+    snapshot = (tmp_path / 'Default_tubes.csv').read_text()
+    # tube2 removed, tube3 moved in, tube4 is new:
+    tracker.update_tubes_from_barcodes('box1', {'tube1': 'A01', 'tube3': 'B01', 'tube4': 'C01'}, scan_id='scan1')
+    # The snapshot is not rewritten, only the changes are appended to the journal:
+    assert (tmp_path / 'Default_tubes.csv').read_text() == snapshot
+    journal = read_journal(tmp_path / 'Default_tubes.journal.csv')
+    assert sorted(journal['barcode']) == ['tube2', 'tube3', 'tube4']
+    assert set(journal['scan_id']) == {'scan1'}
+    assert journal.set_index('barcode').loc['tube3', ['old_boxname', 'new_boxname', 'new_pos']].tolist() == [
+        'box2', 'box1', 'B01']
+
+    # A new tracker (e.g. after restarting the app) replays the journal on top of the snapshot:
+    expected = tracker.get_tubes_data().sort_values('barcode').reset_index(drop=True)
+    reloaded = make_tracker(tmp_path).get_tubes_data().sort_values('barcode').reset_index(drop=True)
+    pd.testing.assert_frame_equal(reloaded, expected)
+
+    # Compaction writes a new snapshot and archives the journal:
+    datastore = tracker.data_client.datastore
+    datastore.compact('Default_tubes', background=True).join()
+    assert not (tmp_path / 'Default_tubes.journal.csv').exists()
+    assert len(list((tmp_path / 'journal_archive').glob('Default_tubes.journal.*.csv'))) == 1
+    compacted = pd.read_csv(tmp_path / 'Default_tubes.csv', keep_default_na=False)
+    pd.testing.assert_frame_equal(compacted.sort_values('barcode').reset_index(drop=True), expected)
+    # OBS: As with the CsvDfStore, 'N/A' values are read from the snapshot as NaN:
+    reloaded = make_tracker(tmp_path).get_tubes_data().sort_values('barcode').reset_index(drop=True)
+    pd.testing.assert_frame_equal(reloaded.fillna('N/A'), expected)
+
+
+def test_journal_datastore_auto_compaction(tmp_path):
+    make_datastore(tmp_path)
+    tracker = make_tracker(tmp_path, datastore_journal_compaction_events=2, datastore_journal_archive=False)
+    tracker.update_tubes_from_barcodes('box2', {'tube3': 'B02'}, flush=False)
+    assert not (tmp_path / 'Default_tubes.journal.csv').exists()
+    tracker.flush()
+    assert len(read_journal(tmp_path / 'Default_tubes.journal.csv')) == 1
+    # Unchanged tubes are not journaled:
+    tracker.update_tubes_from_barcodes('box2', {'tube3': 'B02'})
+    assert len(read_journal(tmp_path / 'Default_tubes.journal.csv')) == 1
+    tracker.update_tubes_from_barcodes('box2', {'tube3': 'C02'})
+    tracker.data_client.datastore.wait_for_compaction()
+    assert not (tmp_path / 'Default_tubes.journal.csv').exists()
+    assert not (tmp_path / 'journal_archive').exists()
+    assert pd.read_csv(tmp_path / 'Default_tubes.csv').set_index('barcode').loc['tube3', 'pos'] == 'C02'
+
+
+def test_journal_datastore_unjournaled_changes(tmp_path):
+    make_datastore(tmp_path)
+    tracker = make_tracker(tmp_path)
+    datastore = tracker.data_client.datastore
+    tracker.update_tubes_from_barcodes('box1', {'tube1': 'A01', 'tube3': 'B01'}, scan_id='scan1')
+    # Changes without journal events (a new column, a deleted row) are written as a new snapshot:
+    tubes_df = tracker.get_tubes_data()
+    tubes_df['note'] = 'x'
+    tracker.save_tubes_data(tubes_df.iloc[1:].reset_index(drop=True), flush=True)
+    assert datastore.snapshot_tables == set()
+    assert not (tmp_path / 'Default_tubes.journal.csv').exists()
+    reloaded = make_tracker(tmp_path).get_tubes_data()
+    assert 'note' in reloaded and 'tube1' not in reloaded['barcode'].values
+    # Archived segments are numbered in sequence:
+    tracker.update_tubes_from_barcodes('box2', {'tube2': 'C01'}, scan_id='scan2')
+    datastore.compact('Default_tubes')
+    archived = datastore.get_journal_archive_filepaths('Default_tubes')
+    assert [filepath.name for filepath in archived] == ['Default_tubes.journal.0.csv', 'Default_tubes.journal.1.csv']
+    assert list(datastore.read_events('Default_tubes')['scan_id']) == ['scan1'] * 2 + ['scan2']
+
+
+def test_journal_datastore_numeric_barcodes(tmp_path):
+    # Numeric barcodes (with leading zeros) in the snapshot must match the same barcodes in the journal:
+    pd.DataFrame({'boxname': ['box1', 'box2']}).to_csv(tmp_path / 'Default_boxes.csv', index=False)
+    pd.DataFrame({
+        'boxname': ['box1', 'box1', 'box2'],
+        'barcode': ['0012', '0034', '0056'],
+        'pos': ['A01', 'B01', 'A01'],
+    }).to_csv(tmp_path / 'Default_tubes.csv', index=False)
+    tracker = make_tracker(tmp_path, datastore_journal_compaction_events=100)
+    tracker.update_tubes_from_barcodes('box1', {'0012': 'A01', '0056': 'B01'}, scan_id='scan1')
+    reloaded = make_tracker(tmp_path).get_tubes_data()
+    assert sorted(reloaded['barcode']) == ['0012', '0034', '0056']
+    assert reloaded.set_index('barcode').loc['0056', ['boxname', 'pos']].tolist() == ['box1', 'B01']
+
+
+def test_datastore_old_files_with_index(tmp_path):
+    # Files saved by older versions include the DataFrame index as an unnamed first column:
+    make_datastore(tmp_path)
+    for table in ('Default_boxes', 'Default_tubes'):
+        pd.read_csv(tmp_path / (table + '.csv')).to_csv(tmp_path / (table + '.csv'))
+    for datastore_type in ('csv', 'journal'):
+        tracker = make_tracker(tmp_path, datastore_type=datastore_type)
+        assert list(tracker.get_boxes_data().columns) == ['boxname']
+        assert list(tracker.get_tubes_data().columns) == ['boxname', 'barcode', 'pos']
+    tracker.data_client.datastore.compact('Default_tubes')
+    assert (tmp_path / 'Default_tubes.csv').read_text().splitlines()[0] == 'boxname,barcode,pos'
@@ -0,0 +1,62 @@
+# Copyright 2019, Rasmus Sorensen <rasmusscholer@gmail.com>
+"""
+
+
+"""
+
+import threading
+import time
+import numpy as np
+import pytest
+
+from zepto_lims.cameras.opencv_webcam import OpencvWebcam
+
+
+class FrameSource:
+    """ Stand-in for a `cv2.VideoCapture`, producing numbered color frames at a fixed frame rate. """
+
+    def __init__(self, n_frames=None, interval=0.005):
+        self.n_frames = n_frames
+        self.interval = interval
+        self.count = 0
+        self.released = threading.Event()
+
+    def read(self):
+        if self.n_frames is not None and self.count >= self.n_frames:
+            return False, None
+        time.sleep(self.interval)
+        frame = np.full((8, 8, 3), self.count % 256, dtype=np.uint8)
+        self.count += 1
+        return True, frame
+
+    def release(self):
+        self.released.set()
+
+
+def test_opencv_webcam_newest_frame():
+    source = FrameSource()
+    with OpencvWebcam({'opencvwebcam_buffer_size': 2}, capture=source) as camera:
+        frame_id, timestamp, image = camera.get_frame()
+        assert image.shape == (8, 8)  # Converted to grayscale in the capture thread.
+        time.sleep(0.1)  # "Decoding" while the camera keeps capturing.
+        next_id, next_timestamp, image = camera.get_frame()
+        # We get the newest frame, not the next one, and the stale frames are dropped:
+        assert next_id > frame_id + 2
+        assert camera.frames_dropped > 0
+        assert len(camera.frames) <= 1
+        images = list(camera.iter_images(max_frames=3))
+        assert len(images) == 3
+    assert source.released.is_set()
+    assert not camera.is_running
+
+
+def test_opencv_webcam_end_of_stream():
+    camera = OpencvWebcam({}, capture=FrameSource(n_frames=1, interval=0))
+    camera.get_image()
+    start = time.perf_counter()
+    with pytest.raises(IOError):
+        camera.get_image()
+    # The end of stream is reported right away, not after the frame timeout:
+    assert time.perf_counter() - start < 1
+    assert camera.capture_stopped
+    camera.stop()
@@ -0,0 +1,72 @@
+# Copyright 2019, Rasmus Sorensen <rasmusscholer@gmail.com>
+"""
+
+
+"""
+
+from pathlib import Path
+import numpy as np
+import pytest
+from click.testing import CliRunner
+
+from zepto_lims.utils.image import imread
+from zepto_lims.scanners.preprocessing import (
+    build_pipeline, parse_step, preprocess_image, chain_name, select_preprocessing_chain,
+    benchmark_preprocessing_chains, main,
+)
+
+TEST_DATA_DIR = Path(__file__).parent / 'testdata'
+
+
+def test_parse_step():
+    assert parse_step('sharpen') == ('sharpen', {})
+    assert parse_step(('resize', {'scale': 0.5})) == ('resize', {'scale': 0.5})
+    assert parse_step(['resize', {'scale': 0.5}]) == ('resize', {'scale': 0.5})
+    assert parse_step({'step': 'gaussian_blur', 'ksize': 5}) == ('gaussian_blur', {'ksize': 5})
+    with pytest.raises(ValueError):
+        parse_step('unknown_step')
+
+
+def test_build_pipeline():
+    assert build_pipeline(None) is None
+    assert build_pipeline([]) is None
+    image = np.random.randint(0, 256, (100, 80, 3)).astype(np.uint8)
+    pipeline = build_pipeline(['grayscale', ('resize', {'scale': 0.5}), {'step': 'gaussian_blur', 'ksize': 3}])
+    result = pipeline(image)
+    assert result.shape == (50, 40)
+    assert result.dtype == np.uint8
+    binary = preprocess_image(result, ['adaptive_threshold'])
+    assert set(np.unique(binary)) <= {0, 255}
+    assert preprocess_image(result, ['sharpen']).shape == result.shape
+    assert preprocess_image(result, None) is result
+    assert chain_name(['grayscale', ('resize', {'scale': 0.5})]) == 'grayscale+resize(scale=0.5)'
+    assert chain_name(()) == 'none'
+
+
+def test_select_preprocessing_chain():
+    results = [
+        {'name': 'none', 'barcodes': 4, 'time': 0.8},
+        {'name': 'resize', 'barcodes': 4, 'time': 0.3},
+        {'name': 'blur', 'barcodes': 3, 'time': 0.1},
+    ]
+    assert select_preprocessing_chain(results)['name'] == 'resize'
+    assert select_preprocessing_chain(results, min_barcodes=3)['name'] == 'blur'
+    assert select_preprocessing_chain(results, min_barcodes=5) is None
+    assert select_preprocessing_chain([]) is None
+
+
+def test_preprocessing_main_no_images(tmp_path):
+    result = CliRunner().invoke(main, [str(tmp_path)])
+    assert result.exit_code == 0
+    assert "No chain reached the full decode rate" in result.output
+    assert CliRunner().invoke(main, [str(tmp_path), '--target', 'box']).exit_code == 2
+
+
+def test_benchmark_preprocessing_chains():
+    image = imread(TEST_DATA_DIR / 'images' / 'datamatrix_x4_50pct-90.jpg')
+    grid_params = (10, -1, 20, -10, (4, 1))
+    chains = [(), [('resize', {'scale': 0.5})]]
+    results = benchmark_preprocessing_chains([image], chains=chains, grid_params=grid_params)
+    assert [result['name'] for result in results] == ['none', 'resize(scale=0.5)']
+    assert all(result['time'] > 0 for result in results)
+    assert select_preprocessing_chain(results)['barcodes'] == max(result['barcodes'] for result in results)
@@ -5,10 +5,12 @@ Module for testing the tubetracker module.
 
 """
 
+import json
 import pandas as pd
 from io import StringIO
 import pytest
 import numpy as np
+from click.testing import CliRunner
 
 from tests.testdata.table_data import (
     BOXES_DATA_01,
@@ -16,6 +18,7 @@ from tests.testdata.table_data import (
     TUBES_DATA_CSV_MULTI, TUBES_DATA_CSV_MULTI_MOD1
 )
 from zepto_lims.trackers import tubetracker
+from zepto_lims.trackers.benchmark import make_tubes_df, make_tracker, make_box_scan, benchmark_update_tubes, main
 from zepto_lims.utils.gridpos import val_pos_dict_from_grid
 from tests.testdata.boxscans import (TEST_GRID_3x3_rot90, TEST_GRID_3x3_mod1)
 
@@ -73,10 +76,23 @@ def test_tubetracker():
 
     # avg_dist, rotation, global_shift
     assert t.get_best_box_rotation('box1', val_pos_dict_from_grid(TEST_GRID_3x3_rot90))[1] == 1
+    alignment, rotation, flipped = t.get_best_box_transform('box1', val_pos_dict_from_grid(TEST_GRID_3x3_rot90))
+    assert (alignment.error, rotation, flipped) == (0, 1, False)
+    # Only the boxes sharing barcodes with the scan are aligned by default:
+    assert set(t.get_best_box_transforms(val_pos_dict_from_grid(TEST_GRID_3x3_rot90))) == {'box1'}
+    assert set(t.get_best_box_transforms({'First': 'A01', 'One': 'B02', 'unknown': 'C03'})) == {'box1', 'box3'}
+    # No barcodes in common with the box, or no tubes in the box at all:
+    alignment, rotation, flipped = t.get_best_box_transform('box3', val_pos_dict_from_grid(TEST_GRID_3x3_rot90))
+    assert (alignment.transform, rotation, flipped) == (-1, 0, False)
+    assert len(alignment.inliers) == 0
+    alignment, rotation, flipped = t.get_best_box_transform('empty_box', val_pos_dict_from_grid(TEST_GRID_3x3_rot90))
+    assert (alignment.transform, rotation, flipped) == (-1, 0, False)
+    assert t.get_moved_tubes('box1', val_pos_dict_from_grid(TEST_GRID_3x3_rot90)) == []
+    assert t.get_moved_tubes('box1', {'First': 'A01', 'Second': 'A02', 'Third': 'B02', 'Fourth': 'C03'}) == ['Third']
 
     # test update_tubes_from_barcodes:
     t.save_boxes_data = lambda df, flush: None
-    t.save_tubes_data = lambda df, flush: None
+    t.save_tubes_data = lambda df, flush, journaled=False: None
     t.add_box = lambda boxname: None
 
     # valpos_dict = val_pos_dict_from_grid(TEST_GRID_3x3_mod1)
@@ -109,5 +125,174 @@ def test_tubetracker():
     print("df.value comparison:")
     print((tubes_df_multi.values == tubes_df_multi_mod1.values))
     assert np.all(tubes_df_multi.values == tubes_df_multi_mod1.values)
+    # The barcode index was updated incrementally, and matches an index built from the updated table:
+    assert t._barcode_index.box_of == tubetracker.BarcodeBoxIndex.from_tubes_df(tubes_df_multi).box_of
+    assert t.get_barcode_index() is t._barcode_index
 
 
+
+
+def test_identify_box_by_lid_barcode():
+    t = tubetracker.TubeTrackerDf(config={})
+    boxes_df = pd.read_csv(StringIO(BOXES_DATA_01))
+    tubes_df_multi = pd.read_csv(StringIO(TUBES_DATA_CSV_MULTI))
+    t.get_boxes_data = lambda: boxes_df
+    t.get_tubes_data = lambda: tubes_df_multi
+    t.save_boxes_data = lambda df, flush: None
+
+    assert t.get_lid_barcode_index() == {}  # No lid barcode column yet.
+    t.set_box_lid_barcode('box2', 'LID-002')
+    t.set_box_lid_barcode('box3', 'LID-003')
+    assert t.get_lid_barcode_index() == {'LID-002': 'box2', 'LID-003': 'box3'}
+    assert t.get_box_by_lid_barcode('LID-002') == 'box2'
+    assert t.get_box_by_lid_barcode('LID-999') is None
+    with pytest.raises(ValueError):
+        t.set_box_lid_barcode('box1', 'LID-002')  # Already assigned to box2.
+    with pytest.raises(ValueError):
+        t.set_box_lid_barcode('box9', 'LID-009')
+
+    # Lid lookup, with tube barcodes as consistency check:
+    assert t.identify_box({'tube1', 'tube2'}, lid_barcode='LID-002') == ('box2', 'lid', True)
+    assert t.identify_box({'First', 'Second'}, lid_barcode='LID-003') == ('box3', 'lid', False)
+    assert t.identify_box({'First', 'Second'}, lid_barcode='LID-003', check_consistency=False) == (
+        'box3', 'lid', None)
+    # Fall back to tube barcode matching:
+    assert t.identify_box({'First', 'Second'}, lid_barcode='LID-999') == ('box1', 'tubes', None)
+    assert t.identify_box({'First', 'Second'}) == ('box1', 'tubes', None)
+
+
+def test_update_tubes_from_barcodes_new_tubes():
+    t = make_tracker(make_tubes_df(1000))
+    scan = make_box_scan(t, 'box000003', n_removed=2, n_moved_in=3, n_new=4, rng=0)
+    new_barcodes = [barcode for barcode in scan if barcode.startswith('new-')]
+    assert len(new_barcodes) == 4
+    t.update_tubes_from_barcodes('box000003', scan, flush=False)
+    tubes_df = t.get_tubes_data()
+    assert len(tubes_df) == 1004
+    assert t.get_barcode_val_pos_for_box('box000003') == scan
+    assert (tubes_df['boxname'] == '(missing)').sum() == 9  # The tubes in the positions of moved-in/new tubes.
+    # The incrementally-updated index matches an index built from the updated table:
+    index = t.get_barcode_index()
+    rebuilt = tubetracker.BarcodeBoxIndex.from_tubes_df(tubes_df)
+    assert index.box_of == rebuilt.box_of
+    assert index.rows == rebuilt.rows
+
+    # Saving a (modified) tubes table invalidates the index, even if it is the same DataFrame object:
+    tubes_df.loc[tubes_df['barcode'] == new_barcodes[0], 'boxname'] = 'box-other'
+    t.save_tubes_data(tubes_df, flush=False)
+    assert t.get_barcode_index().get_box(new_barcodes[0]) == 'box-other'
+
+    # Without adding new tubes:
+    t = make_tracker(make_tubes_df(1000))
+    t.update_tubes_from_barcodes('box000003', scan, add_new_tubes=False, flush=False)
+    assert len(t.get_tubes_data()) == 1000
+
+
+def test_update_tubes_duplicate_barcodes():
+    tubes_df = make_tubes_df(200)
+    tubes_df.loc[0, 'barcode'] = tubes_df.loc[150, 'barcode']  # Same barcode in box000000 and box000001.
+    tubes_df.loc[1, 'pos'] = np.nan
+    t = make_tracker(tubes_df)
+    barcode = tubes_df.loc[150, 'barcode']
+    assert t.get_barcode_index().get_rows([barcode]) == ([barcode, barcode], [0, 150])
+    t.get_history_index()  # Without a journal, the history only has the events recorded from now on.
+    # All rows of the duplicated barcode are moved:
+    t.update_tubes_from_barcodes(
+        'box-new', {barcode: 'A01', tubes_df.loc[1, 'barcode']: 'A02'}, create_box_if_nonexisting=False, flush=False)
+    tubes_df = t.get_tubes_data()
+    assert tubes_df.loc[[0, 150], ['boxname', 'pos']].values.tolist() == [['box-new', 'A01']] * 2
+    # Missing values are recorded as '', not 'nan':
+    events = t.get_tube_timeline(tubes_df.loc[1, 'barcode'])
+    assert events[['old_boxname', 'old_pos', 'new_pos']].values.tolist() == [['box000000', '', 'A02']]
+
+    result = t.reconcile_box_scans({'box-other': {barcode: 'B01'}}, flush=False)
+    assert len(result.events) == 2
+    assert t.get_tubes_data().loc[[0, 150], ['boxname', 'pos']].values.tolist() == [['box-other', 'B01']] * 2
+
+
+def test_benchmark_update_tubes():
+    results = benchmark_update_tubes(n_tubes=10000, repeats=2)
+    assert results['update_ms']['min'] <= results['update_ms']['max']
+    assert set(results) == {'n_tubes', 'n_scanned', 'index_build_ms', 'update_ms', 'update_with_new_ms'}
+
+
+def test_benchmark_update_tubes_cli(tmp_path):
+    output = tmp_path / 'results.json'
+    result = CliRunner().invoke(main, ['--tubes', '1000', '--repeats', '1', '--output', str(output)])
+    assert result.exit_code == 0, result.output
+    assert "Tubes table: 1000 tubes" in result.output
+    assert json.loads(output.read_text())['n_tubes'] == 1000
+
+
+def test_reconcile_box_scans():
+    t = make_tracker(make_tubes_df(1000))
+    box1, box2 = t.get_barcode_val_pos_for_box('box000001'), t.get_barcode_val_pos_for_box('box000002')
+    # Swap two tubes between box1 and box2, remove a tube from box1, add a new tube and a new box,
+    # and scan a tube from box0 in both box1 and box2:
+    box1['tube00000200'] = box1.pop('tube00000101')
+    box1['tube00000000'] = box1.pop('tube00000102')
+    box2['tube00000101'] = box2.pop('tube00000200')
+    box2['tube00000000'] = 'K01'
+    box2['new-tube'] = 'K02'
+    scans = {'box000001': box1, 'box000002': box2, 'box-new': {'tube00000300': 'H12'}}
+    result = t.reconcile_box_scans(scans, flush=False)
+    assert result.conflicts == {'tube00000000': ['box000001', 'box000002']}
+    assert result.added == ['new-tube']
+    # A tube moved to another scanned box is not removed:
+    assert result.removed == ['tube00000102']
+    assert len(result.events) == 5  # 1 removed, 3 moved, and 1 new tube.
+    assert result.events['scan_id'].nunique() == 1
+    # The conflicting tube is left where it was:
+    assert t.get_tube_location_at('tube00000000', '2100-01-01')[:2] == ('box000000', 'A01')
+    assert t.get_barcode_val_pos_for_box('box000001') == {k: v for k, v in box1.items() if k != 'tube00000000'}
+    assert t.get_barcode_val_pos_for_box('box000002') == {k: v for k, v in box2.items() if k != 'tube00000000'}
+    assert t.get_barcode_val_pos_for_box('box-new') == {'tube00000300': 'H12'}
+    assert 'box-new' in t.get_boxes_data()['boxname'].values
+    # The incrementally-updated index matches an index built from the updated table:
+    rebuilt = tubetracker.BarcodeBoxIndex.from_tubes_df(t.get_tubes_data())
+    assert t.get_barcode_index().box_of == rebuilt.box_of
+    assert t.get_barcode_index().rows == rebuilt.rows
+
+    with pytest.raises(ValueError):
+        t.reconcile_box_scans(scans, on_conflict='raise', flush=False)
+    t.reconcile_box_scans(scans, on_conflict='last', flush=False)
+    assert t.get_barcode_val_pos_for_box('box000002')['tube00000000'] == 'K01'
+
+
+def test_reconcile_box_scans_unknown_boxes_and_write_errors():
+    t = make_tracker(make_tubes_df(1000))
+    box1 = t.get_barcode_val_pos_for_box('box000001')
+    box1['tube00000200'] = box1.pop('tube00000101')
+    scans = {'box000001': box1, 'box-new': {'tube00000300': 'H12'}}
+    # Scans of boxes that are not in the boxes table are skipped:
+    result = t.reconcile_box_scans(scans, create_box_if_nonexisting=False, flush=False)
+    assert 'box-new' not in t.get_boxes_data()['boxname'].values
+    assert t.get_tube_location_at('tube00000300', '2100-01-01')[:2] == ('box000003', 'A01')
+    assert result.removed == ['tube00000101']
+    assert t.get_barcode_val_pos_for_box('box000001') == box1
+
+    # If writing the tables fails, the current tables and the barcode index are unchanged:
+    def save_tables(tables):
+        raise OSError("Disk full")
+    t.data_client.datastore.save_tables = save_tables
+    tubes_df, index = t.get_tubes_data(), t.get_barcode_index()
+    expected = tubes_df.copy()
+    with pytest.raises(OSError):
+        t.reconcile_box_scans(scans, flush=True)
+    assert t.get_tubes_data() is tubes_df
+    pd.testing.assert_frame_equal(tubes_df, expected)
+    assert t.get_barcode_index() is index
+    assert index.get_box('tube00000300') == 'box000003'
+    assert 'box-new' not in t.get_boxes_data()['boxname'].values
+
+
+def test_reconcile_box_scans_single_flush(tmp_path):
+    pd.DataFrame({'boxname': ['box1', 'box2']}).to_csv(tmp_path / 'Default_boxes.csv', index=False)
+    pd.DataFrame({'boxname': ['box1', 'box2'], 'barcode': ['tube1', 'tube2'], 'pos': ['A01', 'A01']}).to_csv(
+        tmp_path / 'Default_tubes.csv', index=False)
+    t = tubetracker.TubeTrackerDf({'datastore_root_dir': str(tmp_path)})
+    t.reconcile_box_scans({'box1': {'tube2': 'B01'}, 'box2': {'tube1': 'B02'}, 'box3': {'tube3': 'C03'}})
+    tubes_df = pd.read_csv(tmp_path / 'Default_tubes.csv')
+    assert tubes_df.values.tolist() == [['box2', 'tube1', 'B02'], ['box1', 'tube2', 'B01'], ['box3', 'tube3', 'C03']]
+    assert pd.read_csv(tmp_path / 'Default_boxes.csv')['boxname'].tolist() == ['box1', 'box2', 'box3']
+    assert not list(tmp_path.glob('*.tmp'))
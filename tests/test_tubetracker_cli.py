@@ -0,0 +1,125 @@
+# Copyright 2019, Rasmus Sorensen <rasmusscholer@gmail.com>
+"""
+
+
+"""
+
+import json
+import shutil
+from pathlib import Path
+import pandas as pd
+import pytest
+from click.testing import CliRunner
+
+from zepto_lims.apps.tubetracker_cli import (
+    find_image_files, boxname_from_mapping, BatchScanManifest, batch_scan_boxes, write_report, main,
+    scan_image_file,
+)
+from zepto_lims.trackers.tubetracker import TubeTrackerDf
+from zepto_lims.scanners.boxscanner import BoxScanner
+
+TEST_DATA_DIR = Path(__file__).parent / 'testdata'
+BOX_IMAGE = TEST_DATA_DIR / 'images' / 'datamatrix_x4_50pct-90.jpg'
+SCANNER_CONFIG = {'boxscanner_box_margin': (10, -1, 20, -10), 'boxscanner_box_grid': (4, 1)}
+
+
+def make_datastore(folder):
+    folder.mkdir(exist_ok=True)
+    pd.DataFrame({'boxname': ['box1', 'box2']}).to_csv(folder / 'Default_boxes.csv', index=False)
+    pd.DataFrame({
+        'boxname': ['box1', 'box1', 'box2'],
+        'barcode': ['190728 RS123d2 S2Descr', 'old-tube', 'other-tube'],
+        'pos': ['A01', 'B01', 'A01'],
+    }).to_csv(folder / 'Default_tubes.csv', index=False)
+    return folder
+
+
+def test_find_image_files(tmp_path):
+    for name in ('a.jpg', 'b.png', 'c.txt'):
+        (tmp_path / name).touch()
+    assert [p.name for p in find_image_files([tmp_path])] == ['a.jpg', 'b.png']
+    assert [p.name for p in find_image_files([str(tmp_path / '*.jpg')])] == ['a.jpg']
+    assert boxname_from_mapping(tmp_path / 'a.jpg', {'a': 'box1'}) == 'box1'
+    assert boxname_from_mapping(tmp_path / 'a.jpg', {'a.jpg': 'box2'}) == 'box2'
+    assert boxname_from_mapping(tmp_path / 'a.jpg', {}) is None
+
+
+def test_batch_scan_boxes(tmp_path):
+    datastore_dir = make_datastore(tmp_path / 'datastore')
+    image_file = tmp_path / 'box1_scan.jpg'
+    shutil.copy(BOX_IMAGE, image_file)
+    config = dict(SCANNER_CONFIG, datastore_root_dir=str(datastore_dir))
+    tracker = TubeTrackerDf(config)
+    manifest = BatchScanManifest(tmp_path / 'manifest.jsonl')
+    report = batch_scan_boxes([image_file], tracker, BoxScanner(config), box_mapping={'box1_scan': 'box1'},
+                              manifest=manifest, workers=2)
+    assert len(report) == 1
+    row = report[0]
+    assert row['status'] == 'applied'
+    assert row['boxname'] == 'box1'
+    assert row['removed'] == 1  # 'old-tube'
+    # The tubes table was flushed to disk:
+    tubes_df = pd.read_csv(datastore_dir / 'Default_tubes.csv')
+    assert tubes_df.loc[tubes_df['barcode'] == 'old-tube', 'boxname'].iloc[0] == '(missing)'
+
+    # Re-running with the manifest skips the already-flushed image:
+    manifest = BatchScanManifest(tmp_path / 'manifest.jsonl')
+    assert manifest.get_scan(image_file)['barcodes']
+    report = batch_scan_boxes([image_file], TubeTrackerDf(config), BoxScanner(config),
+                              box_mapping={'box1_scan': 'box1'}, manifest=manifest)
+    assert report[0]['status'] == 'already-flushed'
+
+    write_report(report, tmp_path / 'report.json')
+    assert json.loads((tmp_path / 'report.json').read_text())[0]['image'] == str(image_file)
+    write_report(report, tmp_path / 'report.csv')
+    assert pd.read_csv(tmp_path / 'report.csv')['status'][0] == 'already-flushed'
+
+
+def test_batch_scan_boxes_duplicate_box(tmp_path):
+    datastore_dir = make_datastore(tmp_path / 'datastore')
+    image_files = [tmp_path / 'scan_a.jpg', tmp_path / 'scan_b.jpg']
+    for image_file in image_files:
+        shutil.copy(BOX_IMAGE, image_file)
+    config = dict(SCANNER_CONFIG, datastore_root_dir=str(datastore_dir))
+    tubes_csv = (datastore_dir / 'Default_tubes.csv').read_text()
+    report = batch_scan_boxes(image_files, TubeTrackerDf(config), BoxScanner(config),
+                              box_mapping={'scan_a': 'box1', 'scan_b': 'box1'}, workers=1)
+    assert [row['status'] for row in report] == ['duplicate-box', 'duplicate-box']
+    assert (datastore_dir / 'Default_tubes.csv').read_text() == tubes_csv
+
+
+def test_scan_image_file_errors(tmp_path):
+    unreadable = tmp_path / 'unreadable.jpg'
+    unreadable.write_bytes(b'not an image')
+    entry = scan_image_file(unreadable, BoxScanner(SCANNER_CONFIG))
+    assert entry['error'].startswith('OSError')
+
+    # Unexpected errors (e.g. programming errors) are not swallowed:
+    class BrokenScanner:
+        def scan_box_image(self, image):
+            raise AttributeError("bug")
+    with pytest.raises(AttributeError):
+        scan_image_file(BOX_IMAGE, BrokenScanner())
+
+
+def test_tubetracker_cli_dry_run(tmp_path):
+    datastore_dir = make_datastore(tmp_path / 'datastore')
+    image_file = tmp_path / 'box1.jpg'
+    shutil.copy(BOX_IMAGE, image_file)
+    report_file = tmp_path / 'report.json'
+    config_args = [f"{key}={json.dumps(value)}" for key, value in SCANNER_CONFIG.items()]
+    config_args.append(f"datastore_root_dir={datastore_dir}")
+    args = [str(tmp_path / '*.jpg'), '--auto-identify', '--dry-run', '--report', str(report_file)]
+    for config_arg in config_args:
+        args += ['--config', config_arg]
+    result = CliRunner().invoke(main, args)
+    assert result.exit_code == 0, result.output
+    report = json.loads(report_file.read_text())
+    assert report[0]['status'] == 'dry-run'
+    assert report[0]['boxname'] == 'box1'
+    assert Path(str(report_file) + '.manifest.jsonl').exists()
+
+    # Without a box mapping, boxes must be identified automatically:
+    result = CliRunner().invoke(main, [str(image_file)])
+    assert result.exit_code == 2
+    assert '--auto-identify' in result.output
@@ -5,6 +5,8 @@
 """
 
 import numpy as np
+import pandas as pd
+import pytest
 
 from tests.testdata.boxscans import TEST_GRID_3x3_empty, TEST_GRID_3x3, TEST_GRID_3x3_values, TEST_GRID_3x3_coords, \
     TEST_GRID_3x3_valpos, TEST_GRID_3x3_rot90, TEST_GRID_3x3_rot90_values, TEST_GRID_3x3_rot90_coords, \
@@ -16,6 +18,7 @@ from zepto_lims.utils.gridpos import val_pos_dict_from_grid
 from zepto_lims.utils.gridpos import pos_val_dict_from_grid
 from zepto_lims.utils.gridpos import values_coords_tup_from_grid
 from zepto_lims.utils.gridpos import values_coords_tup_from_val_pos
+from zepto_lims.utils.gridpos import PositionCodec, get_position_codec
 
 
 
@@ -143,4 +146,37 @@ def test_values_coords_tup_from_val_pos():
 
     values, coords = values_coords_tup_from_val_pos(TEST_GRID_3x3_rot90_valpos)
     assert values == TEST_GRID_3x3_rot90_values
-    assert np.all(coords == TEST_GRID_3x3_rot90_coords)
\ No newline at end of file
+    assert np.all(coords == TEST_GRID_3x3_rot90_coords)
+
+def test_position_codec():
+    codec = get_position_codec((8, 12))
+    assert get_position_codec((8, 12)) is codec  # Codecs are only built once.
+    assert list(codec.encode([0, 7], [0, 11])) == ['A01', 'H12']
+    assert list(codec.encode(np.array([[1, 2]]))) == ['B03']
+    coords = codec.decode(['A01', 'H12', 'B3'])
+    assert coords.tolist() == [[0, 0], [7, 11], [1, 2]]
+    with pytest.raises(ValueError):
+        codec.decode(['A01', 'Z99'])
+    assert codec.decode(['Z99'], errors='coerce').tolist() == [[-1, -1]]
+
+    # pandas Series are decoded/encoded in a single operation, keeping the index:
+    positions = pd.Series(['C04', 'A01'], index=[10, 20])
+    coords_df = codec.decode(positions)
+    assert coords_df.index.tolist() == [10, 20]
+    assert coords_df[['row', 'col']].values.tolist() == [[2, 3], [0, 0]]
+    assert codec.encode(coords_df['row'], coords_df['col']).equals(positions)
+
+    transposed = PositionCodec((3, 3), transpose=True)
+    assert transposed.encode(0, 2) == 'C01'
+    assert transposed.decode(['C01']).tolist() == [[0, 2]]
+
+
+def test_values_coords_tup_from_val_pos():
+    values, coords = values_coords_tup_from_val_pos(TEST_GRID_3x3_valpos)
+    assert values == tuple(TEST_GRID_3x3_valpos.keys())
+    assert coords.tolist() == [[0, 0], [0, 1], [0, 2], [2, 2]]
+    values, coords = values_coords_tup_from_val_pos({'x': 'B03', 'y': 'A1'}, a01_coord=(1, 2), transpose=True)
+    assert coords.tolist() == [[4, 2], [2, 1]]
+    # A custom pos_regex is always used, even for positions the codec could decode:
+    values, coords = values_coords_tup_from_val_pos({'x': 'A12', 'y': 'B21'}, pos_regex=r"(?P<row>[A-z])\d(?P<col>\d+)")
+    assert coords.tolist() == [[0, 1], [1, 0]]
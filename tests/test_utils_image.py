@@ -0,0 +1,72 @@
+# Copyright 2019, Rasmus Sorensen <rasmusscholer@gmail.com>
+"""
+
+
+"""
+
+import os
+from pathlib import Path
+import numpy as np
+import pytest
+
+from zepto_lims.utils import image as image_utils
+from zepto_lims.utils.image import imread, read_pgm, read_raw, ImageCache
+from zepto_lims.cameras.dummyfilecamera import DummyFileCamera
+
+TEST_DATA_DIR = Path(__file__).parent / 'testdata'
+TEST_IMAGE_FILE = TEST_DATA_DIR / 'images' / 'datamatrix_x4_50pct-90.jpg'
+
+
+def test_imread_reduced():
+    image = imread(TEST_IMAGE_FILE)
+    assert image.ndim == 2 and image.dtype == np.uint8
+    for reduce in (2, 4):
+        reduced = imread(TEST_IMAGE_FILE, reduce=reduce)
+        assert reduced.shape == tuple(-(-n // reduce) for n in image.shape)
+    with pytest.raises(ValueError):
+        imread(TEST_IMAGE_FILE, reduce=3)
+
+
+def test_imread_pil():
+    pytest.importorskip('PIL')
+    image = image_utils._imread_pil(TEST_IMAGE_FILE, as_gray=True, reduce=1)
+    assert image.shape == imread(TEST_IMAGE_FILE).shape
+    reduced = image_utils._imread_pil(TEST_IMAGE_FILE, as_gray=True, reduce=2)
+    assert reduced.shape == (image.shape[0] // 2, image.shape[1] // 2)
+
+
+def test_read_pgm_and_raw(tmp_path):
+    image = np.random.randint(0, 256, (30, 20)).astype(np.uint8)
+    pgm_file = tmp_path / 'frame.pgm'
+    pgm_file.write_bytes(b'P5\n# comment\n20 30\n255\n' + image.tobytes())
+    pgm = read_pgm(pgm_file)
+    assert isinstance(pgm, np.memmap)
+    assert np.array_equal(pgm, image)
+    assert not pgm.flags.writeable
+    assert np.array_equal(imread(pgm_file, reduce=2), image[::2, ::2])
+
+    raw_file = tmp_path / 'frame.raw'
+    raw_file.write_bytes(bytes(16) + image.tobytes())
+    assert np.array_equal(read_raw(raw_file, shape=(30, 20), offset=16), image)
+
+
+def test_image_cache(tmp_path):
+    image_file = tmp_path / 'frame.pgm'
+    image_file.write_bytes(b'P5 2 2 255\n' + bytes([1, 2, 3, 4]))
+    cache = ImageCache(maxsize=2)
+    first = cache.imread(image_file)
+    assert cache.imread(image_file) is first
+    assert cache.info() == {'hits': 1, 'misses': 1, 'size': 1, 'maxsize': 2}
+    assert not first.flags.writeable
+    # Modified files are read again:
+    image_file.write_bytes(b'P5 2 2 255\n' + bytes([5, 6, 7, 8]))
+    os.utime(image_file, ns=(0, 10**9))
+    assert cache.imread(image_file)[0, 0] == 5
+    cache.imread(TEST_IMAGE_FILE)
+    assert len(cache) == 2
+
+
+def test_dummyfilecamera_cache():
+    camera = DummyFileCamera({'dummyfilecamera_image_filepath': TEST_IMAGE_FILE})
+    assert camera.get_image() is camera.get_image()
+    assert camera.image_cache.info()['hits'] == 1
@@ -5,9 +5,13 @@
 """
 
 import numpy as np
+import pytest
 
 from zepto_lims.utils.transformation import calc_best_grid_rotation_result, align_coords_by_values
 from zepto_lims.utils.transformation import rot_90deg, rotate_coords
+from zepto_lims.utils.transformation import (
+    transform_coords, calc_best_coords_transform_result, calc_best_values_coords_transform_batch, DIHEDRAL_TRANSFORMS,
+)
 from zepto_lims.utils.gridpos import values_coords_tup_from_grid
 
 from tests.testdata.boxscans import TEST_GRID_3x3, TEST_GRID_3x3_values, TEST_GRID_3x3_coords, TEST_GRID_3x3_rot90, \
@@ -111,3 +115,67 @@ def test_calc_best_grid_rotation_result():
     print(avg_dist, rotation, global_shift)
     assert avg_dist == 0
     assert rotation == 0  # Rotation is in units of 90° (counter-clockwise)
+
+
+def test_transform_coords():
+    # Transforms 0-3 are the rotations:
+    for rotation in range(4):
+        assert np.all(transform_coords(TEST_GRID_3x3_coords, rotation) == rotate_coords(TEST_GRID_3x3_coords, rotation))
+    # Transform 4 mirrors left-right:
+    assert np.all(transform_coords(np.array([[1, 2]]), 4) == [[1, -2]])
+    assert DIHEDRAL_TRANSFORMS[4] == (0, True)
+
+
+def test_calc_best_coords_transform_result():
+    coords = np.array([(0, 0), (0, 1), (0, 2), (2, 2), (1, 0)])
+    for transform in range(8):
+        # The box was transformed (and shifted), so undo with the inverse transform:
+        scanned = transform_coords(coords, transform) + (3, -1)
+        result = calc_best_coords_transform_result(coords, scanned)
+        assert result.error == 0
+        assert np.all(transform_coords(scanned, result.transform) - result.translation == coords)
+        assert result.errors.shape == (5,)
+
+    # A flipped box is only found when the flips are included:
+    flipped = transform_coords(coords, 4)
+    assert calc_best_coords_transform_result(coords, flipped).transform == 4
+    assert calc_best_coords_transform_result(coords, flipped, transforms=range(4)).error > 0
+
+    # The best transform of the grid is the same as the best rotation:
+    avg_dist, rotation, global_shift = calc_best_grid_rotation_result(TEST_GRID_3x3, TEST_GRID_3x3_rot90)
+    coords1, coords2 = align_coords_by_values(
+        TEST_GRID_3x3_values, TEST_GRID_3x3_coords, TEST_GRID_3x3_rot90_values, TEST_GRID_3x3_rot90_coords)
+    assert calc_best_coords_transform_result(coords1, coords2).transform == rotation
+
+
+def test_calc_best_values_coords_transform_batch():
+    values = ['a', 'b', 'c', 'd']
+    coords = np.array([(0, 0), (0, 1), (2, 2), (1, 0)])
+    candidates = [
+        (['a', 'b', 'x'], coords[[0, 1, 3]]),  # Partial overlap, no transform.
+        (['y'], coords[:1]),  # Nothing in common.
+        (values, transform_coords(coords, 6) + (1, 1)),  # Flipped and shifted.
+    ]
+    results = calc_best_values_coords_transform_batch(values, coords, candidates)
+    assert [result.transform for result in results] == [0, -1, 6]
+    assert results[0].error == 0 and len(results[0].errors) == 2
+    assert np.isnan(results[1].error) and len(results[1].errors) == 0
+    assert results[2].error == 0 and list(results[2].translation) == [-1, -1]
+
+
+def test_calc_best_coords_transform_vote():
+    coords = np.array([(row, col) for row in range(5) for col in range(5)])
+    scanned = transform_coords(coords, 3) + (2, 7)
+    # Move a few tubes: swap two tubes, and move one to another position:
+    scanned[[1, 5]] = scanned[[5, 1]]
+    scanned[[7, 8, 9, 10]] += (4, 4)
+    result = calc_best_coords_transform_result(coords, scanned)
+    assert result.transform == 1  # Inverse of transform 3.
+    assert list(result.translation) == [7, -2]
+    assert np.all((transform_coords(scanned, result.transform) - result.translation == coords)[result.inliers])
+    assert list(np.flatnonzero(~result.inliers)) == [1, 5, 7, 8, 9, 10]
+    # The mean displacement is skewed by the moved tubes:
+    mean_result = calc_best_coords_transform_result(coords, scanned, method='mean')
+    assert mean_result.inliers.sum() < result.inliers.sum()
+    with pytest.raises(ValueError):
+        calc_best_coords_transform_result(coords, scanned, method='median')
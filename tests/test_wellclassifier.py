@@ -0,0 +1,58 @@
+# Copyright 2019, Rasmus Sorensen <rasmusscholer@gmail.com>
+"""
+
+Test the empty-well classifier against the example images.
+
+"""
+
+from pathlib import Path
+import numpy as np
+
+import zepto_lims
+from zepto_lims.utils.image import imread
+from zepto_lims.scanners.wellclassifier import classify_cells, CELL_EMPTY, CELL_TUBE, CELL_UNCERTAIN
+
+EXAMPLE_IMAGES_DIR = Path(zepto_lims.__file__).parent / 'examples' / 'example_data' / 'images'
+
+# Single-barcode images, cropped to the barcode:
+BARCODE_IMAGE_FILES = sorted(EXAMPLE_IMAGES_DIR.glob('datamatrix_x1*.jpg')) + [
+    EXAMPLE_IMAGES_DIR / 'datamatrix_01.jpg',
+    EXAMPLE_IMAGES_DIR / 'datamatrix_02.jpg',
+    EXAMPLE_IMAGES_DIR / 'datamatrix_03.jpg',
+]
+
+
+def as_cells(image, grid_shape=(1, 1)):
+    """ Return 4D (nrows, ncols, height, width) view of image. """
+    nrows, ncols = grid_shape
+    height, width = image.shape[0] // nrows, image.shape[1] // ncols
+    return image[:nrows*height, :ncols*width].reshape(nrows, height, ncols, width).swapaxes(1, 2)
+
+
+def test_classify_barcode_images():
+    assert len(BARCODE_IMAGE_FILES) > 20
+    for filepath in BARCODE_IMAGE_FILES:
+        image = imread(filepath)
+        assert image is not None
+        status = classify_cells(as_cells(image))
+        assert status[0, 0] == CELL_TUBE, filepath.name
+
+
+def test_classify_empty_cells():
+    rng = np.random.RandomState(0)
+    # Uniform cells with a bit of sensor noise:
+    blank = (rng.normal(200, 3, (300, 300))).clip(0, 255).astype(np.uint8)
+    assert np.all(classify_cells(as_cells(blank, (3, 3))) == CELL_EMPTY)
+    dark = (rng.normal(20, 3, (300, 300))).clip(0, 255).astype(np.uint8)
+    assert np.all(classify_cells(as_cells(dark, (3, 3))) == CELL_EMPTY)
+
+    # Box with a single barcode in cell (0, 1):
+    barcode = imread(EXAMPLE_IMAGES_DIR / 'datamatrix_x1_02_25pct-q90.jpg')[:100, :100]
+    box = (rng.normal(200, 3, (200, 200))).clip(0, 255).astype(np.uint8)
+    box[0:100, 100:200] = barcode
+    status = classify_cells(as_cells(box, (2, 2)))
+    assert status.tolist() == [[CELL_EMPTY, CELL_TUBE], [CELL_EMPTY, CELL_EMPTY]]
+
+    # Thresholds are tunable:
+    status = classify_cells(as_cells(box, (2, 2)), thresholds={'tube_min_edge_density': 1.0})
+    assert status.tolist() == [[CELL_EMPTY, CELL_UNCERTAIN], [CELL_EMPTY, CELL_EMPTY]]
@@ -8,9 +8,15 @@ from zepto_lims.trackers.tubetracker import TubeTrackerDf
 from zepto_lims.scanners.boxscanner import BoxScanner
 from zepto_lims.utils.gridpos import val_pos_dict_from_grid
 from zepto_lims.cameras.dummyfilecamera import DummyFileCamera
+from zepto_lims.cameras.opencv_webcam import OpencvWebcam
 from zepto_lims.configs.config import ZeptoAppConfig
 from zepto_lims.configs.default_config import DEFAULTS
 
+CAMERAS = {
+    'dummyfile': DummyFileCamera,
+    'opencv_webcam': OpencvWebcam,
+}
+
 
 class TubeTrackerAppBase:
 
@@ -20,14 +26,25 @@ class TubeTrackerAppBase:
         self.config = config
         self.tubetracker = TubeTrackerDf(config)
         self.boxscanner = BoxScanner(config)
-        self.camera = DummyFileCamera(config)
+        camera_type = config.get('tubetracker_camera', 'dummyfile')
+        try:
+            camera_cls = CAMERAS[camera_type]
+        except KeyError:
+            raise ValueError(f"Unrecognized `tubetracker_camera` '{camera_type}'; must be one of {list(CAMERAS)}.")
+        self.camera = camera_cls(config)
 
     def scan_and_update_box(self):
+        # A streaming camera (e.g. OpencvWebcam) keeps capturing in the background while we decode,
+        # so `get_image()` returns the newest frame without waiting for a full camera exposure.
         image = self.camera.get_image()
         barcodes_grid = self.boxscanner.scan_box_image_grid(image)
         barcodes_dict = val_pos_dict_from_grid(barcodes_grid)  # {barcode: pos} dict
         barcodes_set = set(barcodes_dict.keys())   # Using .keys() is not strictly needed.
-        best_box_match = self.tubetracker.get_best_matching_box(barcodes_set)
+        # If the box has a lid barcode in the frame, the box is identified by a direct lookup,
+        # and the tube barcodes are only used as a consistency check:
+        lid_barcode = self.boxscanner.scan_box_lid_barcode(image)
+        identification = self.tubetracker.identify_box(barcodes_set, lid_barcode=lid_barcode)
+        best_box_match = identification.boxname
         answer = input(f"Is the scanned box '{best_box_match}'? [Y/n]").lower()
         if answer and answer[0] == 'n':
             print("OK. These are the existing freezer boxes:")
@@ -35,22 +52,49 @@ class TubeTrackerAppBase:
             boxname = input("Please type the name of the box: ")
         else:
             boxname = best_box_match
-            avg_dist, rotation, global_shift = self.tubetracker.get_best_box_rotation(
+            alignment, rotation, flipped = self.tubetracker.get_best_box_transform(
                 boxname=best_box_match, barcodes_val_pos_dict=barcodes_dict
             )
-            if rotation != 0:
+            if flipped:
+                print("WARNING: The scanned box appears flipped (mirrored), e.g. scanned from the underside.")
+            if rotation != 0 or flipped:
                 print("The scanned box was rotated since it was last scanned.")
-                print("avg_dist, rotation, global_shift:", [avg_dist, rotation, global_shift])
+                print("avg_dist, rotation, flipped, translation:",
+                      [alignment.error, rotation, flipped, alignment.translation])
                 old_or_new = input("Would you like to use OLD rotation or NEW rotation? [o/N]  ").lower() or 'n'
                 use_old_rotation = (old_or_new[0] == 'o')
                 if use_old_rotation:
                     # This requires rotating the barcodes_grid,
                     print("Sorry, using old rotation is not yet supported.")
+            n_moved = len(alignment.inliers) - alignment.inliers.sum()
+            if n_moved:
+                print(f"{n_moved} tubes were moved within the box.")
+        self.tubetracker.update_tubes_from_barcodes(boxname, barcodes_dict)
+
+    def rescan_box(self, boxname):
+        """ Re-scan a known box and update its tubes.
+
+        The tube positions from the previous scan of the box are used as a prior, so only the previously
+        occupied cells are decoded if the box is unchanged (see `boxscanner.scan_box_grid_with_prior()`).
+        """
+        prior = self.tubetracker.get_barcode_val_pos_for_box(boxname)
+        image = self.camera.get_image()
+        scan_result = self.boxscanner.scan_box_image(image, prior=prior)
+        if scan_result.confirmed:
+            print(f"Box '{boxname}' confirmed; all {len(prior)} previously scanned tubes are in place.")
+        barcodes_dict = val_pos_dict_from_grid(scan_result.barcodes)
         self.tubetracker.update_tubes_from_barcodes(boxname, barcodes_dict)
+        return scan_result
 
     def add_box(self, boxname):
         self.tubetracker.add_box(boxname)
 
+    def close(self):
+        """ Stop the camera capture thread (for streaming cameras) and the box scanner's decode executor. """
+        if hasattr(self.camera, 'stop'):
+            self.camera.stop()
+        self.boxscanner.close()
+
     # def scan_box_barcodes_and_update_database(self):
     #     image = self.camera.
 
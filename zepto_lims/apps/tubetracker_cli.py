@@ -1,7 +1,332 @@
 # Copyright 2019, Rasmus Sorensen <rasmusscholer@gmail.com>
 """
 
+Headless (non-interactive) batch box-scan CLI.
 
+Scans a directory (or glob) of box images, e.g. from an overnight re-inventory of a whole freezer,
+and updates the tube locations for all boxes in one job:
 
+    zepto-batch-scan "scans/*.jpg" --boxes boxes.csv --report report.csv
+
+(or `python -m zepto_lims.apps.tubetracker_cli ...`, if the package is not installed.)
+
+* Box names are given by a mapping file (CSV with `image,boxname` columns, or a JSON dict),
+    keyed by image filename, stem, or path. Use `--auto-identify` to identify boxes not in the mapping
+    by their lid barcode (if `boxscanner_lid_barcode_region` is configured) or their tube barcodes
+    (see `TubeTrackerDf.identify_box()`).
+* Images are decoded in parallel (`--workers`).
+* All updates are applied together with `TubeTrackerDf.reconcile_box_scans()`, as a single transaction
+    with a single flush at the end of the job. Barcodes found in more than one box are not moved,
+    but counted in the report's `conflicts` field.
+* Multiple images resolving to the same box are reported with status `duplicate-box`, and not applied.
+* A report with one row per image is written to JSON or CSV (by file extension).
+* A resume manifest (JSON-lines) records the scan result of each image as soon as it is decoded,
+    and which images have been flushed. If the job is interrupted, re-running the same command
+    skips the images that were already flushed, and re-uses the decoded barcodes for the rest.
 
 """
+
+import csv
+import glob
+import json
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+import click
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+from zepto_lims.trackers.tubetracker import TubeTrackerDf
+from zepto_lims.scanners.boxscanner import BoxScanner
+from zepto_lims.utils.gridpos import val_pos_dict_from_grid
+from zepto_lims.utils.image import imread
+from zepto_lims.configs.config import ZeptoAppConfig
+from zepto_lims.configs.default_config import DEFAULTS
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp', '.pgm')
+
+# Expected failures when scanning a single image (unreadable image files and decode errors).
+# These are recorded in the report; any other exception (e.g. a programming error) aborts the batch scan.
+SCAN_ERRORS = (OSError, ValueError) + ((cv2.error,) if cv2 is not None else ())
+
+REPORT_FIELDS = ('image', 'boxname', 'identified_by', 'status', 'n_barcodes', 'added', 'removed',
+                 'conflicts', 'lid_barcode', 'scan_time', 'error')
+
+
+def find_image_files(paths):
+    """ Return sorted list of image files from a list of directories, files, and/or glob patterns. """
+    image_files = set()
+    for path in paths:
+        if Path(path).is_dir():
+            image_files.update(p for p in Path(path).iterdir() if p.suffix.lower() in IMAGE_EXTENSIONS)
+        else:
+            image_files.update(Path(p) for p in glob.glob(str(path)))
+    return sorted(image_files)
+
+
+def load_box_mapping(filepath):
+    """ Load mapping of image to boxname, from a CSV file (with `image` and `boxname` columns) or a JSON dict. """
+    filepath = Path(filepath)
+    if filepath.suffix.lower() == '.json':
+        with open(filepath) as fp:
+            return json.load(fp)
+    with open(filepath, newline='') as fp:
+        return {row['image']: row['boxname'] for row in csv.DictReader(fp)}
+
+
+def boxname_from_mapping(image_file, box_mapping):
+    """ Look up the boxname for an image file by its path, filename, or stem. Returns None if not found. """
+    image_file = Path(image_file)
+    for key in (str(image_file), image_file.name, image_file.stem):
+        if key in box_mapping:
+            return box_mapping[key]
+    return None
+
+
+class BatchScanManifest:
+    """ Resume manifest for batch scans, stored as a JSON-lines file.
+
+    Two kinds of entries are appended to the file:
+        {"image": ..., "mtime": ..., "barcodes": {...}, "scan_time": ..., "error": ...}
+            when an image has been scanned, and
+        {"flushed": [image, ...]}
+            when the updates from those images have been written to the datastore.
+
+    Entries for an image are only used if the image file's modification time is unchanged.
+    """
+
+    def __init__(self, filepath=None):
+        self.filepath = Path(filepath) if filepath else None
+        self.scanned = {}
+        self.flushed = set()
+        if self.filepath is not None and self.filepath.exists():
+            self.load()
+
+    def load(self):
+        with open(self.filepath) as fp:
+            for line in fp:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if 'flushed' in entry:
+                    self.flushed.update(entry['flushed'])
+                else:
+                    self.scanned[entry['image']] = entry
+
+    def _append(self, entry):
+        if self.filepath is not None:
+            with open(self.filepath, 'a') as fp:
+                fp.write(json.dumps(entry) + '\n')
+
+    def get_scan(self, image_file):
+        """ Return the recorded (successful) scan entry for an unchanged image file, or None. """
+        entry = self.scanned.get(str(image_file))
+        if entry is not None and not entry.get('error') and entry['mtime'] == Path(image_file).stat().st_mtime:
+            return entry
+        return None
+
+    def is_flushed(self, image_file):
+        return str(image_file) in self.flushed and self.get_scan(image_file) is not None
+
+    def record_scan(self, entry):
+        self.scanned[entry['image']] = entry
+        self._append(entry)
+
+    def record_flushed(self, image_files):
+        image_files = [str(image_file) for image_file in image_files]
+        self.flushed.update(image_files)
+        self._append({'flushed': image_files, 'timestamp': time.strftime('%Y-%m-%d %H:%M:%S')})
+
+
+def scan_image_file(image_file, boxscanner):
+    """ Scan a single box image file, returning a manifest entry dict with the barcodes as {barcode: pos}
+    (and the lid barcode, if any). """
+    entry = {'image': str(image_file), 'mtime': Path(image_file).stat().st_mtime, 'barcodes': {},
+             'lid_barcode': None, 'error': None}
+    start = time.perf_counter()
+    try:
+        image = imread(image_file)
+        if image is None:
+            raise IOError(f"Could not read image file {image_file}.")
+        grid_barcodes = boxscanner.scan_box_image(image).barcodes
+        entry['barcodes'] = val_pos_dict_from_grid(grid_barcodes)
+        entry['lid_barcode'] = boxscanner.scan_box_lid_barcode(image)
+    except SCAN_ERRORS as exc:
+        entry['error'] = f"{type(exc).__name__}: {exc}"
+    entry['scan_time'] = time.perf_counter() - start
+    return entry
+
+
+def batch_scan_boxes(
+        image_files, tracker, boxscanner, box_mapping=None, auto_identify=False,
+        manifest=None, workers=None, dry_run=False, create_box_if_nonexisting=True,
+):
+    """ Scan a batch of box images and update the tube locations, with a single flush at the end.
+
+    Args:
+        image_files: List of box image files.
+        tracker: TubeTrackerDf instance.
+        boxscanner: BoxScanner instance.
+        box_mapping: Dict mapping image (path, filename, or stem) to boxname.
+        auto_identify: Identify boxes not in `box_mapping` by their lid barcode or tube barcodes.
+        manifest: Optional BatchScanManifest, used to resume an interrupted batch scan.
+        workers: Number of images decoded in parallel. Defaults to the number of CPUs.
+        dry_run: If True, only scan the images and create the report, without updating the database.
+        create_box_if_nonexisting: Passed on to `reconcile_box_scans()`.
+
+    Returns:
+        List of report rows (dicts with `REPORT_FIELDS` items), one for each image, in the given order.
+    """
+    box_mapping = box_mapping or {}
+    if manifest is None:
+        manifest = BatchScanManifest()
+    entries = {}
+    to_scan = []
+    for image_file in image_files:
+        entry = manifest.get_scan(image_file)
+        if entry is not None:
+            entries[str(image_file)] = entry
+        else:
+            to_scan.append(image_file)
+    if to_scan:
+        print(f"Scanning {len(to_scan)} images ({len(entries)} already scanned)...")
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(scan_image_file, image_file, boxscanner) for image_file in to_scan]
+            for future in as_completed(futures):
+                entry = future.result()
+                manifest.record_scan(entry)
+                entries[entry['image']] = entry
+
+    report = []
+    pending = []
+    for image_file in image_files:
+        entry = entries[str(image_file)]
+        barcodes = entry['barcodes']
+        row = dict.fromkeys(REPORT_FIELDS)
+        row.update(image=str(image_file), n_barcodes=len(barcodes), lid_barcode=entry.get('lid_barcode'),
+                   scan_time=entry.get('scan_time'), error=entry.get('error'))
+        report.append(row)
+        if manifest.is_flushed(image_file):
+            row['status'] = 'already-flushed'
+            continue
+        if entry.get('error'):
+            row['status'] = 'error'
+            continue
+        if not barcodes:
+            row['status'] = 'no-barcodes'
+            continue
+        boxname = boxname_from_mapping(image_file, box_mapping)
+        row['identified_by'] = 'mapping'
+        if boxname is None and auto_identify:
+            boxname, method, consistent = tracker.identify_box(set(barcodes), lid_barcode=entry.get('lid_barcode'))
+            row['identified_by'] = 'lid' if method == 'lid' else 'auto'
+            if consistent is False:
+                row.update(boxname=boxname, status='lid-mismatch')
+                continue
+        if boxname is None:
+            row.update(status='unknown-box', identified_by=None)
+            continue
+        previous = set(tracker.get_barcode_val_pos_for_box(boxname))
+        row.update(boxname=boxname, added=len(set(barcodes) - previous), removed=len(previous - set(barcodes)))
+        if dry_run:
+            row['status'] = 'dry-run'
+            continue
+        pending.append((image_file, row, boxname, barcodes))
+
+    # Multiple images resolving to the same box are conflicting scans; none of them are applied:
+    counts = Counter(boxname for image_file, row, boxname, barcodes in pending)
+    duplicates = {boxname for boxname, count in counts.items() if count > 1}
+    if duplicates:
+        print("WARNING: Multiple images for the same box; not updating these boxes:", sorted(duplicates))
+    applied = []
+    for image_file, row, boxname, barcodes in pending:
+        if boxname in duplicates:
+            row['status'] = 'duplicate-box'
+        else:
+            row['status'] = 'applied'
+            applied.append((image_file, row, boxname, barcodes))
+
+    if applied:
+        scans = [(boxname, barcodes) for image_file, row, boxname, barcodes in applied]
+        result = tracker.reconcile_box_scans(scans, create_box_if_nonexisting=create_box_if_nonexisting, flush=True)
+        for image_file, row, boxname, barcodes in applied:
+            row['conflicts'] = sum(barcode in result.conflicts for barcode in barcodes)
+        manifest.record_flushed([image_file for image_file, row, boxname, barcodes in applied])
+        print(f"Updated {len(applied)} boxes.")
+    return report
+
+
+def write_report(report, filepath):
+    """ Write batch scan report to a JSON or CSV file (by file extension). """
+    filepath = Path(filepath)
+    if filepath.suffix.lower() == '.json':
+        with open(filepath, 'w') as fp:
+            json.dump(report, fp, indent=2)
+    else:
+        with open(filepath, 'w', newline='') as fp:
+            writer = csv.DictWriter(fp, fieldnames=REPORT_FIELDS)
+            writer.writeheader()
+            writer.writerows(report)
+
+
+def parse_config_args(config_args):
+    """ Parse a list of 'key=value' strings (values parsed as JSON, if possible) into a dict. """
+    config = {}
+    for config_arg in config_args or ():
+        key, value = config_arg.split('=', 1)
+        try:
+            value = json.loads(value)
+        except ValueError:
+            pass
+        config[key] = value
+    return config
+
+
+@click.command()
+@click.argument('images', nargs=-1, required=True)
+@click.option('--boxes', help="CSV (image,boxname) or JSON file mapping images to box names.")
+@click.option('--auto-identify', is_flag=True,
+              help="Identify boxes not in the --boxes mapping by their lid or tube barcodes.")
+@click.option('--report', help="Write report to this JSON or CSV file.")
+@click.option('--manifest', help="Resume manifest file. Defaults to <report>.manifest.jsonl.")
+@click.option('--workers', type=int, help="Number of images decoded in parallel.")
+@click.option('--dry-run', is_flag=True, help="Scan and report, but don't update the database.")
+@click.option('--no-create-boxes', is_flag=True, help="Don't create boxes missing in the database.")
+@click.option('--config', 'config_args', multiple=True, metavar='KEY=VALUE', help="Override config value.")
+def main(images, boxes, auto_identify, report, manifest, workers, dry_run, no_create_boxes, config_args):
+    """ Scan a batch of box images and update tube locations, without any user interaction.
+
+    IMAGES are image files, directories, or glob patterns.
+    """
+    config = ZeptoAppConfig(runtime=parse_config_args(config_args), default=DEFAULTS)
+    image_files = find_image_files(images)
+    if not image_files:
+        raise click.ClickException("No images found.")
+    box_mapping = load_box_mapping(boxes) if boxes else {}
+    if not box_mapping and not auto_identify:
+        raise click.UsageError("Please provide a --boxes mapping file and/or use --auto-identify.")
+    manifest_file = manifest or (report + '.manifest.jsonl' if report else None)
+    tracker = TubeTrackerDf(config)
+    boxscanner = BoxScanner(config)
+    try:
+        report_rows = batch_scan_boxes(
+            image_files, tracker, boxscanner, box_mapping=box_mapping, auto_identify=auto_identify,
+            manifest=BatchScanManifest(manifest_file), workers=workers, dry_run=dry_run,
+            create_box_if_nonexisting=not no_create_boxes,
+        )
+    finally:
+        boxscanner.close()
+    if report:
+        write_report(report_rows, report)
+        print(f"Report written to {report}")
+    for row in report_rows:
+        print(f"{row['status']:<16} {row['boxname'] or '-':<20} {row['n_barcodes']:4} barcodes  {row['image']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -3,17 +3,34 @@
 
 A dummy camera that only returns a pre-defined image file.
 
+The decoded image is cached (keyed by file path and modification time),
+so repeated scans of the same image file don't decode the image again.
+
 """
 
 from .basecamera import BaseCamera
-from zepto_lims.utils.image import imread
+from zepto_lims.utils.image import ImageCache
 
 
 class DummyFileCamera(BaseCamera):
 
+    def __init__(self, config):
+        super().__init__(config)
+        self.image_cache = ImageCache(maxsize=self.cache_size)
+
     @property
     def image_filepath(self):
         return self.config['dummyfilecamera_image_filepath']
 
+    @property
+    def cache_size(self):
+        """ Return the number of decoded images to cache, as defined by the config. Defaults to 4. """
+        return self.config.get('dummyfilecamera_cache_size', 4)
+
+    @property
+    def reduce(self):
+        """ Return the image resolution reduction factor (1, 2, 4, or 8), as defined by the config. Defaults to 1. """
+        return self.config.get('dummyfilecamera_reduce', 1)
+
     def get_image(self):
-        return imread(self.image_filepath)
+        return self.image_cache.imread(self.image_filepath, reduce=self.reduce)
@@ -1,5 +1,196 @@
 # Copyright 2019, Rasmus Sorensen <rasmusscholer@gmail.com>
 """
 
+Streaming camera using OpenCV's `VideoCapture` (e.g. a USB webcam).
+
+Frames are captured continuously on a background thread into a small, bounded ring buffer,
+and `get_image()` always returns the newest frame, dropping any stale frames.
+Since the camera keeps capturing while the scanner is decoding the previous frame,
+the scan latency is set by the decode time, rather than camera plus decode time.
+
+Grayscale conversion is done in the capture thread, so the scanner gets frames ready for decoding.
 
 """
+
+from collections import deque
+import threading
+import time
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+from .basecamera import BaseCamera
+
+
+class OpencvWebcam(BaseCamera):
+    """ Streaming OpenCV camera with a background capture thread.
+
+    The capture thread is started on the first call to `get_image()` (or explicitly with `start()`),
+    and should be stopped with `stop()` when done, or use the camera as a context manager.
+
+    Args:
+        config: The app config.
+        capture: Optional, already-opened capture object with `read()` and `release()` methods,
+            e.g. a `cv2.VideoCapture`. If not given, a `cv2.VideoCapture` is opened for the configured device.
+    """
+
+    def __init__(self, config, capture=None):
+        super().__init__(config)
+        self.capture = capture
+        self.frames = deque(maxlen=self.buffer_size)
+        self.frame_available = threading.Condition()
+        self.frames_captured = 0
+        self.frames_dropped = 0
+        self.last_frame_id = None
+        self.capture_error = None
+        # Set (under the `frame_available` condition) when the capture thread has stopped capturing:
+        self.capture_stopped = True
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def device(self):
+        """ Return the camera device index (or video file/stream URL), as defined by the config. Defaults to 0. """
+        return self.config.get('opencvwebcam_device', 0)
+
+    @property
+    def buffer_size(self):
+        """ Return the number of frames kept in the ring buffer, as defined by the config. Defaults to 2. """
+        return self.config.get('opencvwebcam_buffer_size', 2)
+
+    @property
+    def grayscale(self):
+        """ Return whether frames are converted to grayscale in the capture thread. Defaults to True. """
+        return self.config.get('opencvwebcam_grayscale', True)
+
+    @property
+    def frame_size(self):
+        """ Return the requested (width, height) frame size, as defined by the config.
+        Defaults to None (the camera's default resolution). """
+        return self.config.get('opencvwebcam_frame_size', None)
+
+    @property
+    def frame_timeout(self):
+        """ Return the maximum time (in seconds) to wait for a new frame, as defined by the config. Defaults to 5. """
+        return self.config.get('opencvwebcam_frame_timeout', 5.0)
+
+    @property
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def open_capture(self):
+        """ Open the OpenCV VideoCapture for the configured device. """
+        if cv2 is None:
+            raise ImportError("OpencvWebcam requires OpenCV (cv2), which could not be imported.")
+        capture = cv2.VideoCapture(self.device)
+        if not capture.isOpened():
+            raise IOError(f"Could not open camera device {self.device!r}.")
+        if self.frame_size is not None:
+            width, height = self.frame_size
+            capture.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+            capture.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+        # Don't let the driver queue up stale frames either, if supported:
+        capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        return capture
+
+    def start(self):
+        """ Start the background capture thread (if not already running). """
+        if self.is_running:
+            return
+        if self.capture is None:
+            self.capture = self.open_capture()
+        self._stop_event.clear()
+        self.capture_error = None
+        with self.frame_available:
+            self.capture_stopped = False
+        self._thread = threading.Thread(target=self._capture_loop, name='OpencvWebcam-capture', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Stop the capture thread and release the camera. """
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.capture is not None:
+            self.capture.release()
+            self.capture = None
+        with self.frame_available:
+            self.frames.clear()
+            self.capture_stopped = True
+            self.frame_available.notify_all()
+
+    def _capture_loop(self):
+        while not self._stop_event.is_set():
+            try:
+                ret, frame = self.capture.read()
+            except Exception as exc:
+                self.capture_error = exc
+                break
+            if not ret:
+                self.capture_error = IOError("Could not read frame from camera (end of stream?).")
+                break
+            if self.grayscale and frame.ndim == 3:
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            with self.frame_available:
+                if len(self.frames) == self.frames.maxlen:
+                    self.frames_dropped += 1
+                self.frames.append((self.frames_captured, time.perf_counter(), frame))
+                self.frames_captured += 1
+                self.frame_available.notify_all()
+        # Set the flag before the final notify, so a consumer can't miss it (the thread may still be alive):
+        with self.frame_available:
+            self.capture_stopped = True
+            self.frame_available.notify_all()
+
+    def get_frame(self, timeout=None):
+        """ Return the newest frame not already returned, as a (frame_id, timestamp, image) tuple.
+
+        Blocks until a new frame is available. Any older frames in the buffer are dropped.
+
+        Args:
+            timeout: Maximum time to wait for a new frame, in seconds. Defaults to `frame_timeout`.
+
+        Raises:
+            TimeoutError, if no new frame was captured within the timeout.
+            IOError, if the capture thread stopped because the camera could not be read.
+        """
+        if not self.is_running:
+            self.start()
+        if timeout is None:
+            timeout = self.frame_timeout
+        with self.frame_available:
+            ready = self.frame_available.wait_for(
+                lambda: self.frames or self.capture_stopped, timeout=timeout)
+            if not self.frames:
+                if self.capture_error is not None:
+                    raise IOError(f"Camera capture stopped: {self.capture_error}")
+                if not ready:
+                    raise TimeoutError(f"No new frame from camera within {timeout} seconds.")
+                raise IOError("Camera capture has been stopped.")
+            frame_id, timestamp, image = self.frames.pop()
+            self.frames_dropped += len(self.frames)
+            self.frames.clear()
+        self.last_frame_id = frame_id
+        return frame_id, timestamp, image
+
+    def get_image(self):
+        """ Return the newest captured (grayscale) image. """
+        return self.get_frame()[2]
+
+    def iter_images(self, max_frames=None):
+        """ Generator yielding the newest image each time the consumer is ready for the next frame,
+        e.g. for `AggregatingBoxScanner.scan_frames()`. """
+        n = 0
+        while max_frames is None or n < max_frames:
+            yield self.get_image()
+            n += 1
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
@@ -5,9 +5,10 @@
 """
 
 import pathlib
-import zepto_lims.examples
+import zepto_lims
 
-example_data_dir = pathlib.Path(zepto_lims.examples.__file__) / 'example_data'
+# OBS: `zepto_lims.examples` is a namespace package (no __init__.py), so it doesn't have a `__file__`.
+example_data_dir = pathlib.Path(zepto_lims.__file__).parent / 'examples' / 'example_data'
 
 
 DEFAULTS = {
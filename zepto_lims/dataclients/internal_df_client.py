@@ -7,6 +7,14 @@
 """
 
 from zepto_lims.datastores.csv_df_store import CsvDfStore
+from zepto_lims.datastores.journal_csv_df_store import JournalCsvDfStore
+
+
+# Datastores available through the `datastore_type` config key:
+DATASTORES = {
+    'csv': CsvDfStore,
+    'journal': JournalCsvDfStore,
+}
 
 
 class InternalDfClient:
@@ -19,14 +27,29 @@ class InternalDfClient:
     """
 
     def __init__(self, config):
-        # Initialize config-defined data-store. For now, we just always use the CsvDfStore.
-        self.datastore = CsvDfStore(config)
+        # Initialize config-defined data-store, defaulting to the CsvDfStore:
+        datastore_type = (config.get('datastore_type') if config is not None else None) or 'csv'
+        self.datastore = DATASTORES[datastore_type](config)
 
     def get_table(self, table):
         return self.datastore.get_table(table)
 
-    def set_table(self, table, df, *, flush):
-        self.datastore.set_table(table, df, flush=flush)
+    def set_table(self, table, df, *, flush, journaled=False):
+        self.datastore.set_table(table, df, flush=flush, journaled=journaled)
+
+    def set_tables(self, tables, *, flush, journaled=False):
+        self.datastore.set_tables(tables, flush=flush, journaled=journaled)
 
     def append_row(self, table, row):
         self.datastore.append_row(table, row)
+
+    def append_events(self, table, events, *, flush):
+        """ Record movement events for changes made to the table (only used by journaling datastores). """
+        append_events = getattr(self.datastore, 'append_events', None)
+        if append_events is not None:
+            append_events(table, events, flush=flush)
+
+    def read_events(self, table):
+        """ Return all recorded events for the table, or None if the datastore does not record events. """
+        read_events = getattr(self.datastore, 'read_events', None)
+        return read_events(table) if read_events is not None else None
@@ -28,11 +28,24 @@ source of truth.
 
 """
 
+import os
 from pathlib import Path
 import pandas as pd
 from datetime import datetime
 
 
+def read_table_csv(filepath, **kwargs) -> pd.DataFrame:
+    """ Read a table CSV file, with keyword arguments passed to `pd.read_csv()`.
+
+    Tables are saved without the DataFrame index (see `CsvDfStore.to_disk()`).
+    Files saved by older versions have the index as an unnamed first column, which is dropped.
+    """
+    df = pd.read_csv(filepath, **kwargs)
+    if len(df.columns) and df.columns[0] == 'Unnamed: 0':
+        df = df.drop(columns=df.columns[0])
+    return df
+
+
 class CsvDfStore:
 
     def __init__(self, config):
@@ -61,11 +74,13 @@ class CsvDfStore:
                 by=self.config.get('datastore_sort_by_columns'),
                 ascending=self.config.get('datastore_sort_ascending', True),
             )
-        df.to_csv(filename)
+        # OBS: The index is not saved, since `load_table` doesn't read it back.
+        # Otherwise, every load/save cycle would add another unnamed column to the file.
+        df.to_csv(filename, index=False)
 
     def load_table(self, table: str):
         """ Load table from disk. """
-        return pd.read_csv(self.get_table_filepath(table))
+        return read_table_csv(self.get_table_filepath(table))
 
     def save_table(self, table: str):
         """ Save table to disk.
@@ -76,6 +91,25 @@ class CsvDfStore:
         df = self.table_cache[table]
         self.to_disk(df, self.get_table_filepath(table))
 
+    def save_tables(self, tables):
+        """ Save multiple (cached) tables to disk, as one transaction:
+        All tables are first written to temporary files, which are then moved in place,
+        so if writing any of the tables fails, none of the tables on disk are changed.
+        """
+        tmp_filepaths = {}
+        try:
+            for table in tables:
+                filepath = self.get_table_filepath(table)
+                tmp_filepaths[table] = filepath.with_name(filepath.name + ".tmp")
+                self.to_disk(self.table_cache[table], tmp_filepaths[table])
+        except Exception:
+            for tmp_filepath in tmp_filepaths.values():
+                if tmp_filepath.exists():
+                    tmp_filepath.unlink()
+            raise
+        for table, tmp_filepath in tmp_filepaths.items():
+            os.replace(tmp_filepath, self.get_table_filepath(table))
+
     def save_table_if_loaded(self, table: str):
         """ Save table to disk. OBS: The table name must be loaded into memory (cached). """
         try:
@@ -124,14 +158,23 @@ class CsvDfStore:
             self.table_cache[table] = self.load_table(table)
         return self.table_cache[table]
 
-    def set_table(self, table: str, df: pd.DataFrame, *, flush=None):
-        """ Set a specific table, overwriting the current content. """
+    def set_table(self, table: str, df: pd.DataFrame, *, flush=None, journaled=False):
+        """ Set a specific table, overwriting the current content.
+        `journaled` is only used by journaling datastores, see `JournalCsvDfStore.set_table()`. """
         self.table_cache[table] = df
         if flush is None:
             flush = self.config.get('datastore_autoflush')
         if flush:
             self.save_table(table)
 
+    def set_tables(self, tables: dict, *, flush=None, journaled=False):
+        """ Set multiple tables, given as {table: df}, flushing them together (see `save_tables`). """
+        self.table_cache.update(tables)
+        if flush is None:
+            flush = self.config.get('datastore_autoflush')
+        if flush:
+            self.save_tables(list(tables))
+
     def update_table(self, table: str, data: pd.DataFrame):
         """ Update a table with the given data, updating
         Initially, this should probably be only implemented on the client side,
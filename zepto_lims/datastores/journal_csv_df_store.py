@@ -0,0 +1,337 @@
+# Copyright 2019, Rasmus Sorensen <rasmusscholer@gmail.com>
+"""
+
+Journaling version of the CsvDfStore.
+
+With the plain CsvDfStore, every flush rewrites the whole table CSV file, even if a box scan only
+moved a handful of tubes. For large tubes tables, that is by far the most expensive part of a scan.
+
+The JournalCsvDfStore instead keeps each journaled table (by default, the tubes tables) as:
+
+* A snapshot, `{table}.csv` - the same file as used by the CsvDfStore.
+* An append-only journal, `{table}.journal.csv`, with one line per tube movement event:
+    timestamp, scan_id, barcode, old_boxname, old_pos, new_boxname, new_pos
+
+A scan only appends the events for the tubes that actually changed, i.e. O(changed tubes) bytes.
+When the table is loaded, the snapshot is read and the journal is replayed on top of it.
+Both are read as strings (without converting empty values to NaN), so the values in the snapshot
+and the journal compare equal, e.g. for numeric barcodes.
+
+This requires that all changes to the table are described by the events, which the caller declares
+by setting the table with `journaled=True`. Tables set without it (e.g. with edited columns or deleted rows)
+are written as a new snapshot when flushed, the same as a compaction.
+
+Every `datastore_journal_compaction_events` events, the journal is compacted in a background thread:
+The current journal is rotated to a closed "segment" file (`{table}.journal.{n}.csv`), and the
+table (as of the rotation) is written to a new snapshot, which then replaces the old snapshot atomically.
+The closed segment is then moved to the journal archive folder (or deleted, if archiving is disabled),
+where segments are numbered in sequence.
+Events are "absolute" (they set a tube's box and position), so replaying a segment that is already
+included in the snapshot (e.g. if the app was closed during compaction) gives the same result.
+
+Config keys:
+    datastore_journal_tables                Table name patterns (fnmatch) to journal. Default: ['*_tubes'].
+    datastore_journal_compaction_events     Compact the journal after this many events. Default: 10000.
+    datastore_journal_background_compaction Compact in a background thread. Default: True.
+    datastore_journal_archive               Keep compacted journal segments in the archive folder. Default: True.
+    datastore_journal_archive_dir           The archive folder. Default: `journal_archive` in the datastore folder.
+
+Tables that are not journaled (e.g. the boxes tables) are saved exactly as with the CsvDfStore.
+
+"""
+
+import fnmatch
+import os
+import threading
+from pathlib import Path
+import pandas as pd
+
+from .csv_df_store import CsvDfStore, read_table_csv
+
+
+JOURNAL_COLUMNS = ('timestamp', 'scan_id', 'barcode', 'old_boxname', 'old_pos', 'new_boxname', 'new_pos')
+
+
+def read_journal(filepath):
+    """ Read a journal (or journal segment) file as a DataFrame with JOURNAL_COLUMNS (all strings). """
+    try:
+        return pd.read_csv(filepath, dtype=str, keep_default_na=False)
+    except (FileNotFoundError, pd.errors.EmptyDataError):
+        return pd.DataFrame(columns=list(JOURNAL_COLUMNS), dtype=str)
+
+
+def replay_journal(df, events):
+    """ Apply journal events to a table, returning the updated table.
+
+    Only the last event for each barcode is applied, so the replay is a single bulk update:
+    Tubes already in the table have their `boxname` and `pos` updated with one `iloc` assignment,
+    and tubes not in the table are appended with one `concat`.
+    """
+    if len(events) == 0:
+        return df
+    df = df.copy()
+    for column in ('barcode', 'boxname', 'pos'):
+        if column not in df:
+            df[column] = 'N/A'
+    last = events.drop_duplicates('barcode', keep='last').set_index('barcode')
+    # All rows of each barcode are updated (a barcode can occur in multiple rows, see `BarcodeBoxIndex`):
+    in_events = df['barcode'].isin(last.index).values
+    if in_events.any():
+        columns = [df.columns.get_loc('boxname'), df.columns.get_loc('pos')]
+        df.iloc[in_events.nonzero()[0], columns] = last.loc[
+            df['barcode'].values[in_events], ['new_boxname', 'new_pos']].values
+    existing = last.index.isin(df['barcode'].values)
+    if (~existing).any():
+        new = last[~existing].reset_index()
+        new_df = pd.DataFrame({
+            'boxname': new['new_boxname'].values, 'barcode': new['barcode'].values, 'pos': new['new_pos'].values,
+        }, columns=df.columns)
+        df = pd.concat([df, new_df], ignore_index=True)
+    return df
+
+
+class JournalCsvDfStore(CsvDfStore):
+    """ CsvDfStore where table changes are appended to a journal, see the module docstring. """
+
+    def __init__(self, config):
+        super().__init__(config)
+        # Events not yet written to the journal, {table: [events DataFrame, ...]}:
+        self.pending_events = {}
+        # Number of events in the current journal file, {table: n_events}:
+        self.journal_event_counts = {}
+        # Journaled tables with changes that are not described by journal events, which need a new snapshot:
+        self.snapshot_tables = set()
+        self._lock = threading.RLock()
+        self._compaction_threads = {}
+
+    @property
+    def journal_table_patterns(self):
+        return self.config.get('datastore_journal_tables', ['*_tubes'])
+
+    @property
+    def compaction_events(self):
+        """ Return the number of journal events after which the journal is compacted. Defaults to 10000. """
+        return self.config.get('datastore_journal_compaction_events', 10000)
+
+    @property
+    def background_compaction(self):
+        return self.config.get('datastore_journal_background_compaction', True)
+
+    @property
+    def journal_archive_dir(self):
+        """ Return the folder where compacted journal segments are kept, or None if they are not kept. """
+        if not self.config.get('datastore_journal_archive', True):
+            return None
+        archive_dir = self.config.get('datastore_journal_archive_dir')
+        return Path(archive_dir) if archive_dir else self.datastore_root_dir / 'journal_archive'
+
+    def is_journaled(self, table: str):
+        return any(fnmatch.fnmatchcase(table, pattern) for pattern in self.journal_table_patterns)
+
+    def get_journal_filepath(self, table: str):
+        return self.datastore_root_dir / (table + ".journal.csv")
+
+    def get_journal_segment_filepaths(self, table: str):
+        """ Return the closed (not yet archived) journal segments of the table, oldest first. """
+        segments = self.datastore_root_dir.glob(table + ".journal.*.csv")
+        return sorted(segments, key=lambda filepath: int(filepath.suffixes[-2].lstrip('.')))
+
+    def load_table(self, table: str):
+        """ Load table from disk: Read the snapshot and replay the journal (including closed segments). """
+        if not self.is_journaled(table):
+            return super().load_table(table)
+        with self._lock:
+            filepath = self.get_table_filepath(table)
+            # The snapshot is read as strings, the same as the journal, so e.g. numeric barcodes match:
+            if filepath.exists():
+                df = read_table_csv(filepath, dtype=str, keep_default_na=False)
+            else:
+                df = pd.DataFrame(columns=['boxname', 'barcode', 'pos'])
+            journal = read_journal(self.get_journal_filepath(table))
+            self.journal_event_counts[table] = len(journal)
+            segments = [read_journal(segment) for segment in self.get_journal_segment_filepaths(table)]
+            return replay_journal(df, pd.concat(segments + [journal], ignore_index=True))
+
+    def get_journal_archive_filepaths(self, table: str):
+        """ Return the archived journal segments of the table, oldest first. """
+        archive_dir = self.journal_archive_dir
+        if archive_dir is None or not archive_dir.exists():
+            return []
+        segments = archive_dir.glob(table + ".journal.*.csv")
+        return sorted(segments, key=lambda filepath: int(filepath.suffixes[-2].lstrip('.')))
+
+    def read_events(self, table: str):
+        """ Return all recorded events of the table, oldest first, as a DataFrame with JOURNAL_COLUMNS.
+        This includes the archived journal segments, the current journal, and events not yet flushed.
+        """
+        with self._lock:
+            filepaths = (self.get_journal_archive_filepaths(table) + self.get_journal_segment_filepaths(table)
+                         + [self.get_journal_filepath(table)])
+            events = [read_journal(filepath) for filepath in filepaths] + self.pending_events.get(table, [])
+        return pd.concat(events, ignore_index=True).reindex(columns=list(JOURNAL_COLUMNS))
+
+    def set_table(self, table: str, df: pd.DataFrame, *, flush=None, journaled=False):
+        """ Set a specific table, overwriting the current content.
+
+        For journaled tables, flushing writes the pending journal events, not the table itself,
+        if `journaled` is True, i.e. if all changes to the table are described by events (see `append_events()`).
+        Otherwise, flushing writes a new snapshot of the table (see `compact()`).
+        """
+        if not self.is_journaled(table):
+            return super().set_table(table, df, flush=flush)
+        with self._lock:
+            self.table_cache[table] = df
+            if not journaled:
+                self.snapshot_tables.add(table)
+        if flush is None:
+            flush = self.config.get('datastore_autoflush')
+        if flush:
+            self.flush_journal(table)
+
+    def set_tables(self, tables: dict, *, flush=None, journaled=False):
+        """ Set multiple tables, given as {table: df}. The non-journaled tables are flushed together
+        (see `CsvDfStore.save_tables`), and then the journaled tables are flushed (see `set_table()`). """
+        if flush is None:
+            flush = self.config.get('datastore_autoflush')
+        journal_tables = [table for table in tables if self.is_journaled(table)]
+        with self._lock:
+            self.table_cache.update({table: tables[table] for table in journal_tables})
+            if not journaled:
+                self.snapshot_tables.update(journal_tables)
+        super().set_tables({table: df for table, df in tables.items() if table not in journal_tables}, flush=flush)
+        if flush:
+            for table in journal_tables:
+                self.flush_journal(table)
+
+    def save_table(self, table: str):
+        """ Save table to disk. For journaled tables, write pending events, and compact the journal. """
+        if not self.is_journaled(table):
+            return super().save_table(table)
+        self.flush_journal(table)
+        self.compact(table, background=False)
+
+    def save_table_if_loaded(self, table: str):
+        if table in self.table_cache or not self.is_journaled(table):
+            return super().save_table_if_loaded(table)
+        print(f"Table '{table}' is not loaded/cached.")
+
+    def append_events(self, table: str, events: pd.DataFrame, *, flush=None):
+        """ Add movement events (DataFrame with JOURNAL_COLUMNS) for changes already made to the cached table.
+
+        Args:
+            table: The table the events belong to.
+            events: The events. Only the JOURNAL_COLUMNS are written to the journal.
+            flush: Write the events to the journal now. If False, the events are written
+                by the next flush. Defaults to the `datastore_autoflush` config value.
+        """
+        if not self.is_journaled(table) or len(events) == 0:
+            return
+        with self._lock:
+            self.pending_events.setdefault(table, []).append(events.reindex(columns=list(JOURNAL_COLUMNS)))
+        if flush is None:
+            flush = self.config.get('datastore_autoflush')
+        if flush:
+            self.flush_journal(table)
+
+    def flush_journal(self, table: str):
+        """ Append pending events to the table's journal file, starting a compaction if the journal is long
+        (or writing a new snapshot, if the table has changes that are not described by events). """
+        with self._lock:
+            self._write_pending_events(table)
+            compact = (self.journal_event_counts.get(table, 0) >= self.compaction_events
+                       or table in self.snapshot_tables)
+        if compact:
+            self.compact(table, background=self.background_compaction)
+
+    def _write_pending_events(self, table):
+        # OBS: Must be called while holding the lock.
+        pending = self.pending_events.pop(table, [])
+        if not pending:
+            return
+        events = pd.concat(pending, ignore_index=True)
+        filepath = self.get_journal_filepath(table)
+        write_header = not filepath.exists() or filepath.stat().st_size == 0
+        with open(filepath, 'a', newline='') as fp:
+            events.to_csv(fp, header=write_header, index=False)
+            fp.flush()
+            os.fsync(fp.fileno())
+        self.journal_event_counts[table] = self.journal_event_counts.get(table, 0) + len(events)
+
+    def compact(self, table: str, background=False):
+        """ Write a new snapshot of the table, and retire the journal events included in the snapshot.
+
+        The journal is rotated (and the table copied) while holding the lock, which only takes O(changed) time
+        plus an in-memory copy of the table. Writing the snapshot is done without holding the lock,
+        optionally in a background thread, so scans can keep appending events to the new journal.
+
+        If the table has changes that are not described by journal events (see `set_table()`),
+        the snapshot is always written before returning, since it is the only record of those changes.
+
+        Returns:
+            The compaction thread, if `background` is True, otherwise None.
+        """
+        if background and table in self.snapshot_tables:
+            background = False
+        if background and self.is_compacting(table):
+            return self._compaction_threads[table]
+        self.wait_for_compaction(table)
+        with self._lock:
+            if table not in self.table_cache:
+                return None
+            self._write_pending_events(table)
+            df = self.table_cache[table].copy()
+            snapshot_needed = table in self.snapshot_tables
+            self.snapshot_tables.discard(table)
+            journal_filepath = self.get_journal_filepath(table)
+            segments = self.get_journal_segment_filepaths(table)
+            if journal_filepath.exists():
+                n = int(segments[-1].suffixes[-2].lstrip('.')) + 1 if segments else 0
+                segment = journal_filepath.with_name(f"{table}.journal.{n}.csv")
+                os.replace(journal_filepath, segment)
+                segments.append(segment)
+            self.journal_event_counts[table] = 0
+            if not background:
+                try:
+                    self._write_snapshot(table, df, segments)
+                except Exception:
+                    if snapshot_needed:
+                        self.snapshot_tables.add(table)
+                    raise
+                return None
+            thread = threading.Thread(
+                target=self._write_snapshot, args=(table, df, segments), name=f"compact-{table}", daemon=True)
+            self._compaction_threads[table] = thread
+            thread.start()
+            return thread
+
+    def _write_snapshot(self, table, df, segments):
+        filepath = self.get_table_filepath(table)
+        tmp_filepath = filepath.with_name(filepath.name + ".tmp")
+        self.to_disk(df, tmp_filepath)
+        os.replace(tmp_filepath, filepath)
+        archive_dir = self.journal_archive_dir
+        if archive_dir is not None:
+            archive_dir.mkdir(parents=True, exist_ok=True)
+        # Hold the lock, so `read_events()` sees each segment either before or after it is archived:
+        with self._lock:
+            # Archived segments are numbered in sequence (after the existing archived segments):
+            archived = self.get_journal_archive_filepaths(table)
+            n = int(archived[-1].suffixes[-2].lstrip('.')) + 1 if archived else 0
+            for segment in segments:
+                if archive_dir is None:
+                    segment.unlink()
+                else:
+                    os.replace(segment, archive_dir / f"{table}.journal.{n}.csv")
+                    n += 1
+
+    def is_compacting(self, table: str):
+        thread = self._compaction_threads.get(table)
+        return thread is not None and thread.is_alive()
+
+    def wait_for_compaction(self, table: str = None):
+        """ Wait for a background compaction of the given table (or all tables) to finish. """
+        tables = [table] if table is not None else list(self._compaction_threads)
+        for table in tables:
+            thread = self._compaction_threads.pop(table, None)
+            if thread is not None:
+                thread.join()
@@ -0,0 +1,274 @@
+# Copyright 2019, Rasmus Sorensen <rasmusscholer@gmail.com>
+"""
+
+Decode performance benchmark over the bundled example images.
+
+For each image and each decoder configuration, the benchmark reports:
+
+* `images_per_s`    - Throughput, based on the best of `repeats` full scans.
+* `cell_latency_ms` - Per-cell decode latency percentiles (p50, p90, p99),
+                      measured by decoding each cell on its own, serially.
+* `success_rate`    - Fraction of cells with a decoded barcode (or of the expected number of barcodes).
+* `peak_memory_mb`  - Peak Python/numpy memory allocated during a scan (measured with `tracemalloc`;
+                      memory allocated by libdmtx itself is not included).
+
+Results are written to JSON, so runs can be compared. `compare_benchmark_results()` compares a run
+against a baseline and reports configurations where throughput dropped by more than a threshold.
+
+Command line usage:
+
+    python -m zepto_lims.scanners.benchmark --output results.json --baseline baseline.json --threshold 0.2
+
+The command exits with status 1 if any configuration regressed.
+The benchmark can also be run from pytest, see `tests/test_benchmark.py`.
+
+"""
+
+import fnmatch
+import json
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+import click
+import numpy as np
+
+from zepto_lims.utils.image import imread
+from .boxscanner import (
+    scan_box_grid, scan_lid_barcode, segment_image_to_grid, get_decode_executor,
+)
+from .dmtx_reader import DEFAULT_DECODE_LADDER
+
+
+EXAMPLE_IMAGES_DIR = Path(__file__).parent.parent / 'examples' / 'example_data' / 'images'
+
+# Grid parameters used for the example images, by filename pattern (first match is used).
+# Images not matching any pattern are scanned as a single cell.
+EXAMPLE_GRID_PARAMS = (
+    ('datamatrix_x4*', (10, -1, 20, -10, (4, 1))),
+    ('*', (0, None, 0, None, (1, 1))),
+)
+
+# Decoder configurations: Keyword arguments for `scan_box_grid()`, or {'mode': 'lid'} to benchmark
+# `scan_lid_barcode()` on the whole image. `executor` can be given as an executor type, e.g. 'thread'.
+DEFAULT_BENCHMARK_CONFIGS = {
+    'lid': {'mode': 'lid'},
+    'grid': {},
+    'grid_first_rung': {'ladder': DEFAULT_DECODE_LADDER[:1]},
+    'grid_threads': {'executor': 'thread'},
+}
+
+LATENCY_PERCENTILES = (50, 90, 99)
+
+# Grid parameters for scanning a single cell image as a 1x1 grid:
+SINGLE_CELL_GRID_PARAMS = (0, None, 0, None, (1, 1))
+
+
+def grid_params_for_image(image_file, grid_params_by_pattern=EXAMPLE_GRID_PARAMS):
+    """ Return the grid params for an image file, using the first matching filename pattern. """
+    for pattern, grid_params in grid_params_by_pattern:
+        if fnmatch.fnmatch(Path(image_file).name, pattern):
+            return grid_params
+    return None
+
+
+def latency_percentiles(latencies):
+    """ Return dict with latency percentiles, in milliseconds. """
+    if not len(latencies):
+        return {f"p{q}": None for q in LATENCY_PERCENTILES}
+    values = np.percentile(np.asarray(latencies) * 1000, LATENCY_PERCENTILES)
+    return {f"p{q}": float(value) for q, value in zip(LATENCY_PERCENTILES, values)}
+
+
+def run_scan(image, grid_params, config, executor=None):
+    """ Scan image once using the given decoder config, returning a list of decoded barcodes (or None). """
+    config = dict(config)
+    if config.pop('mode', 'grid') == 'lid':
+        return [scan_lid_barcode(image, max_count=1, **config)]
+    config.pop('executor', None)
+    scan_result = scan_box_grid(image, grid_params=grid_params, executor=executor, **config)
+    return [barcode for row in scan_result.barcodes for barcode in row]
+
+
+def measure_cell_latencies(image, grid_params, config):
+    """ Decode each cell on its own, serially, returning a list of per-cell decode times, in seconds.
+
+    Each cell is scanned with `scan_box_grid()` as a 1x1 grid, using all the keyword arguments in `config`,
+    except `executor` (cells are decoded one at a time, so the latency doesn't include any queueing).
+    """
+    config = dict(config)
+    config.pop('executor', None)
+    if config.pop('mode', 'grid') == 'lid':
+        start = time.perf_counter()
+        scan_lid_barcode(image, max_count=1, **config)
+        return [time.perf_counter() - start]
+    latencies = []
+    for row in segment_image_to_grid(image, grid_params):
+        for cell_image in row:
+            start = time.perf_counter()
+            scan_box_grid(cell_image, grid_params=SINGLE_CELL_GRID_PARAMS, **config)
+            latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def benchmark_image(image, grid_params, config, repeats=3, expected=None):
+    """ Benchmark a single image with a single decoder configuration.
+
+    Args:
+        image: The (grayscale) image.
+        grid_params: Grid parameters, see `boxscanner.segment_image_to_grid()`.
+        config: Decoder configuration, see `DEFAULT_BENCHMARK_CONFIGS`.
+        repeats: Number of full scans; the fastest is used for the throughput.
+        expected: The expected number of barcodes in the image.
+            Defaults to the number of cells (i.e. all cells are expected to have a barcode).
+
+    Returns:
+        Dict with benchmark results for the image.
+    """
+    executor = get_decode_executor(config['executor']) if config.get('executor') else None
+    try:
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            barcodes = run_scan(image, grid_params, config, executor=executor)
+            times.append(time.perf_counter() - start)
+        tracemalloc.start()
+        try:
+            run_scan(image, grid_params, config, executor=executor)
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    latencies = measure_cell_latencies(image, grid_params, config)
+    n_decoded = sum(barcode is not None for barcode in barcodes)
+    n_expected = len(barcodes) if expected is None else expected
+    return {
+        'time': min(times),
+        'cells': len(barcodes),
+        'decoded': n_decoded,
+        'success_rate': n_decoded / n_expected if n_expected else 1.0,
+        'cell_latency_ms': latency_percentiles(latencies),
+        'cell_latencies': latencies,
+        'peak_memory_mb': peak / 2**20,
+    }
+
+
+def run_benchmark(image_files=None, configs=None, repeats=3, expected=None, grid_params_by_pattern=EXAMPLE_GRID_PARAMS):
+    """ Run the benchmark over a set of images and decoder configurations.
+
+    Args:
+        image_files: List of image files. Defaults to all images in `EXAMPLE_IMAGES_DIR`.
+        configs: Dict with decoder configurations. Defaults to `DEFAULT_BENCHMARK_CONFIGS`.
+        repeats: Number of full scans of each image (the fastest is used for the throughput).
+        expected: Optional dict with the expected number of barcodes, by image filename.
+        grid_params_by_pattern: Sequence of (filename pattern, grid_params) two-tuples.
+
+    Returns:
+        Dict with benchmark results, with per-image results and a summary for each configuration.
+    """
+    if image_files is None:
+        image_files = sorted(EXAMPLE_IMAGES_DIR.glob('*.jpg'))
+    if configs is None:
+        configs = DEFAULT_BENCHMARK_CONFIGS
+    expected = expected or {}
+    images = {Path(image_file).name: imread(image_file) for image_file in image_files}
+    results = {'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'), 'repeats': repeats, 'configs': {}}
+    for config_name, config in configs.items():
+        image_results = {
+            name: benchmark_image(
+                image, grid_params_for_image(name, grid_params_by_pattern), config,
+                repeats=repeats, expected=expected.get(name))
+            for name, image in images.items()
+        }
+        total_time = sum(res['time'] for res in image_results.values())
+        latencies = [latency for res in image_results.values() for latency in res.pop('cell_latencies')]
+        results['configs'][config_name] = {
+            'config': {key: list(value) if isinstance(value, tuple) else value for key, value in config.items()},
+            'images_per_s': len(image_results) / total_time if total_time else None,
+            'cell_latency_ms': latency_percentiles(latencies),
+            'success_rate': float(np.mean([res['success_rate'] for res in image_results.values()])),
+            'peak_memory_mb': max(res['peak_memory_mb'] for res in image_results.values()),
+            'images': image_results,
+        }
+    return results
+
+
+def compare_benchmark_results(results, baseline, threshold=0.2):
+    """ Compare benchmark results against a baseline run.
+
+    Args:
+        results: Benchmark results, from `run_benchmark()`.
+        baseline: Baseline benchmark results (e.g. loaded from a previous run's JSON file).
+        threshold: Maximum allowed relative drop in throughput (images/s), e.g. 0.2 for 20%.
+
+    Returns:
+        List of (config_name, images_per_s, baseline_images_per_s) tuples for configurations where
+        the throughput dropped more than `threshold`. Configurations not in the baseline are ignored.
+    """
+    regressions = []
+    for config_name, summary in results['configs'].items():
+        baseline_summary = baseline.get('configs', {}).get(config_name)
+        if not baseline_summary or not baseline_summary.get('images_per_s'):
+            continue
+        if summary['images_per_s'] < baseline_summary['images_per_s'] * (1 - threshold):
+            regressions.append((config_name, summary['images_per_s'], baseline_summary['images_per_s']))
+    return regressions
+
+
+def format_value(value, spec):
+    """ Format a value with the given format spec, or as 'n/a' (with the same width) if the value is None. """
+    if value is None:
+        width = spec.split('.')[0].rstrip('%f')
+        return f"{'n/a':>{width}}"
+    return format(value, spec)
+
+
+def print_benchmark_results(results):
+    """ Print a summary table of the benchmark results. Missing values (e.g. no decoded cells) are shown as n/a. """
+    print(f"{'config':<20} {'images/s':>9} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'success':>8} {'peak MB':>8}")
+    for config_name, summary in results['configs'].items():
+        latency = summary['cell_latency_ms']
+        print(f"{config_name:<20} {format_value(summary['images_per_s'], '9.2f')} "
+              f"{format_value(latency['p50'], '8.1f')} {format_value(latency['p90'], '8.1f')} "
+              f"{format_value(latency['p99'], '8.1f')} {format_value(summary['success_rate'], '8.1%')} "
+              f"{format_value(summary['peak_memory_mb'], '8.1f')}")
+
+
+@click.command()
+@click.argument('images', nargs=-1, type=click.Path(exists=True, dir_okay=False))
+@click.option('--configs', type=click.Path(exists=True, dir_okay=False),
+              help="JSON file with a dict of decoder configurations.")
+@click.option('--repeats', type=int, default=3, show_default=True)
+@click.option('--output', help="Write the benchmark results to this JSON file.")
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False),
+              help="Compare against the results in this JSON file.")
+@click.option('--threshold', type=float, default=0.2, show_default=True,
+              help="Max allowed relative throughput drop.")
+def main(images, configs, repeats, output, baseline, threshold):
+    """ Run the decode benchmark over the example images and write the results to JSON.
+
+    IMAGES are the image files to scan. Defaults to the bundled example images.
+    """
+    if configs:
+        with open(configs) as fp:
+            configs = json.load(fp)
+    results = run_benchmark(list(images) or None, configs=configs, repeats=repeats)
+    print_benchmark_results(results)
+    if output:
+        with open(output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+        print(f"\nBenchmark results written to {output}")
+    if baseline:
+        with open(baseline) as fp:
+            baseline = json.load(fp)
+        regressions = compare_benchmark_results(results, baseline, threshold=threshold)
+        for config_name, images_per_s, baseline_images_per_s in regressions:
+            print(f"REGRESSION: {config_name}: {images_per_s:.2f} images/s vs {baseline_images_per_s:.2f} in baseline.")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -12,6 +12,14 @@ TODO: from which all barcodes can be properly read.
 """
 
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, as_completed
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+import asyncio
+from bisect import bisect_right
+from functools import partial
+from pathlib import Path
+import time
+import warnings
 import numpy as np
 
 try:
@@ -26,16 +34,70 @@ else:
         return isinstance(image, PilImageFile)
 
 
-from .dmtx_reader import decode_barcode_from_image
+from .wellclassifier import classify_cells, CELL_EMPTY
+from .decodecache import DecodeCache, cell_hash, decode_args_key
+from .gridlocator import GridParams, GridCalibrationCache, locate_box_grid, validate_box_grid
+from .preprocessing import build_pipeline, PREPROCESSING_TARGETS
+from .dmtx_reader import (
+    decode_barcode_from_image, decode_barcodes_from_image, decode_kwargs_for_rung, DEFAULT_DECODE_LADDER,
+    DECODER_BACKENDS, load_decoder_backend, select_decoder_backend,
+)
+from zepto_lims.utils.image import imread
+from zepto_lims.utils.gridpos import values_coords_tup_from_val_pos
 
 
-def estimate_box_grid_params(image):
-    # Returns a named GridParams tuple that locates the "box divider" grid on the box image.
-    # This basically just performs some image pattern recognition by template matching to a square.
-    # Template matching with scaling and maybe rotation.
-    # Alternatively, just keep the grid parameters fix/pre-defined,
-    # and let the user acquire a suitable image.
-    pass
+# Executors available for decoding grid cells in parallel.
+# pylibdmtx calls libdmtx through ctypes, which releases the GIL during the decode,
+# so a thread pool is usually sufficient (and avoids pickling the cell images).
+DECODE_EXECUTORS = {
+    'thread': ThreadPoolExecutor,
+    'process': ProcessPoolExecutor,
+}
+
+# `confirmed` is only used by prior-guided scans, see `scan_box_grid_with_prior()`.
+GridScanResult = namedtuple('GridScanResult', 'barcodes rungs cell_status confirmed')
+GridScanResult.__new__.__defaults__ = (None,)
+
+# Event yielded for each cell by the progressive scan API (see `iter_scan_box_grid()`),
+# where `timing` is the time (in seconds) from the start of the scan until the cell was done.
+ScanEvent = namedtuple('ScanEvent', 'row col barcode timing')
+
+# Box scanning modes:
+#   'cells'         Crop the box image into cells and decode each cell separately.
+#   'whole_image'   Decode the whole (cropped) box image in a single pass, and map each barcode to a
+#                   grid cell by its position. Optionally fall back to per-cell decoding for empty cells.
+DECODE_MODES = ('cells', 'whole_image')
+
+# The rung recorded in `GridScanResult.rungs` for cells decoded by the whole-image pass:
+WHOLE_IMAGE_RUNG = -1
+
+# Reference cell image (and its barcode) used to select the decoder backend at startup,
+# when `boxscanner_decoder_backend` is 'auto':
+DEFAULT_REFERENCE_CELL_IMAGE = (
+    Path(__file__).parent.parent / 'examples' / 'example_data' / 'images' / 'datamatrix_x1_02_25pct-q90.jpg')
+DEFAULT_REFERENCE_CELL_BARCODE = '20190729 RS123d1 Sample Test description'
+
+# Decode arguments for the whole-image pass. OBS: `edge_limits` are relative to the grid *cell* size.
+DEFAULT_WHOLE_IMAGE_RUNG = {'edge_limits': (0.25, 1.0)}
+
+
+def estimate_box_grid_params(image, grid_shape=(10, 10)):
+    """ Returns a named GridParams tuple that locates the "box divider" grid on the box image.
+
+    The box border and divider pitch are located from the row and column intensity projections,
+    see `gridlocator.locate_box_grid()`.
+    Alternatively, just keep the grid parameters fix/pre-defined (`boxscanner_box_margin` config),
+    and let the user acquire a suitable image.
+
+    Args:
+        image: 2D grayscale box image.
+        grid_shape: (nrows, ncols) tuple, or an integer for a square grid.
+
+    Returns:
+        GridParams namedtuple with absolute (top, bottom, left, right) pixel coordinates and grid_shape.
+    """
+    grid_params, score = locate_box_grid(image, grid_shape=grid_shape)
+    return grid_params
 
 
 def segment_image_to_grid(image, grid_params):
@@ -45,15 +107,17 @@ def segment_image_to_grid(image, grid_params):
         image:
         grid_params: A 5-element tuple: (top, bottom, left, right, grid_shape)
             If `grid_shape` is an integer, e.g. 10, the grid_shape is a 10x10 square.
-            Otherwise, `grid_shape` is a two-tuple with (width, height).
+            Otherwise, `grid_shape` is a two-tuple with (nrows, ncols).
 
     Returns:
         Returns a list-of-lists of smaller images.
+        The smaller images are views into the original image (no pixel data is copied).
 
     Returns multiple small images as a list of lists.
     Actually, maybe this could be done by re-shaping to a 4D matrix?
     Except there may be some rounding errors because the number of pixels may not be
     a multiple of the grid shape?
+    Edit: See `segment_image_to_grid_array()`, which returns a 4D view with equally-sized cells.
 
     Grid-params is expected as one of the following:
     * A GridParams namedtuple with `top`, `bottom`, `left`, `right`, `grid_shape` attributes.
@@ -61,18 +125,32 @@ def segment_image_to_grid(image, grid_params):
     * A dict, with items: 'margin', 'shape', 'type'
         * Currently, we only support type='rectangle', but not type='square'.
     If `grid_shape` is an integer, e.g. 10, the grid_shape is a 10x10 square.
-    Otherwise, `grid_shape` is a two-tuple with (width, height).
+    Otherwise, `grid_shape` is a two-tuple with (nrows, ncols).
 
     """
+    im_cropped, grid_shape = crop_image_to_grid(image, grid_params)
+    return split_image_to_grid(im_cropped, grid_shape)
+
+
+def crop_image_to_grid(image, grid_params):
+    """ Crop image to the grid area specified by the grid parameters.
+
+    Args:
+        image: The box image.
+        grid_params: Grid parameters, see `segment_image_to_grid()`.
 
+    Returns:
+        Two-tuple of (im_cropped, grid_shape), where `grid_shape` is a (nrows, ncols) tuple.
+    """
     # if is_pil_image(image):
     #     image = np.array(image)
     # This doesn't work for opencv images from cv2.imread.
-    # Probably better to always just cast as numpy array:
-    assert image
-    image = np.array(image)
-    print("image.shape", image.shape)
-    if isinstance(grid_params, (tuple, namedtuple)):
+    # Probably better to always just cast as numpy array.
+    # np.asarray() does not copy numpy arrays (e.g. from cv2.imread), so cropping just creates a view:
+    if image is None:
+        raise ValueError("`image` is None (OBS: cv2.imread returns None if the image file could not be read).")
+    image = np.asarray(image)
+    if isinstance(grid_params, (tuple, list)):
         top, bottom, left, right, grid_shape = grid_params
     elif isinstance(grid_params, dict):
         top, bottom, left, right = grid_params['margin']
@@ -82,89 +160,751 @@ def segment_image_to_grid(image, grid_params):
         raise TypeError(f"Unrecognized type {type(grid_params)} for argument `grid_params` = {grid_params}.")
     if isinstance(grid_shape, int):
         grid_shape = (grid_shape, grid_shape)
-    original_height, original_width = image.shape
+    original_height, original_width = image.shape[:2]
     # Negative numbers for `bottom` and right` mean "margin from right/bottom".
-    # Slicing to negative works just fine, no need to convert to positive offset:
-    # if bottom < 0:
-    #     bottom = original_height + bottom
-    # if right < 0:
-    #     right = original_width + right
+    # Slicing to negative works just fine, no need to convert to positive offset.
+    # Floats between -2.0 and +2.0 are fractions of the image height/width:
     if isinstance(top, float) and -2.0 < top < +2.0:
-        print(f"Converted `top` to  {image.shape[0]} * {top} = ", end="")
-        top = int(image.shape[0] * top)
-        print(f"{top}")
+        top = int(original_height * top)
     if isinstance(bottom, float) and -2.0 < bottom < +2.0:
-        print(f"Converted `bottom` to  {image.shape[0]} * {bottom} = ", end="")
-        bottom = int(image.shape[0] * bottom)
-        print(f"{bottom}")
+        bottom = int(original_height * bottom)
     if isinstance(left, float) and -2.0 < left < +2.0:
-        print(f"Converted `left` to  {image.shape[0]} * {left} = ", end="")
-        left = int(image.shape[0] * left)
-        print(f"{left}")
+        left = int(original_width * left)
     if isinstance(right, float) and -2.0 < right < +2.0:
-        print(f"Converted `top` to  {image.shape[0]} * {right} = ", end="")
-        right = int(image.shape[0] * right)
-        print(f"{right}")
+        right = int(original_width * right)
     if top or bottom or left or right:
         # Origin is in UPPER LEFT corner.
         if bottom is not None and 0 <= bottom <= (top if top is not None else 0):
-            msg = (f"ERROR, `bottom`={bottom} is smaller than `top={top}`! "
-                   "The `top`, `bottom`, `left`, `right` parameters are ABSOLUTE coordinates "
-                   "with origin at TOP LEFT corner. If you meant to use margin offsets, use negative values for "
-                   "`bottom` and `right` arguments.")
-            print(msg)
-            raise ValueError(msg)
+            raise ValueError(
+                f"ERROR, `bottom`={bottom} is smaller than `top={top}`! "
+                "The `top`, `bottom`, `left`, `right` parameters are ABSOLUTE coordinates "
+                "with origin at TOP LEFT corner. If you meant to use margin offsets, use negative values for "
+                "`bottom` and `right` arguments.")
         if right is not None and 0 <= right <= (left if left is not None else 0):
-            msg = (f"ERROR, `right={right}` is smaller than `left`={left}! "
-                   "The `top`, `bottom`, `left`, `right` parameters are ABSOLUTE coordinates "
-                   "with origin at TOP LEFT corner. If you meant to use margin offsets, use negative values for "
-                   "`bottom` and `right` arguments.")
-            print(msg)
-            raise ValueError(msg)
+            raise ValueError(
+                f"ERROR, `right={right}` is smaller than `left`={left}! "
+                "The `top`, `bottom`, `left`, `right` parameters are ABSOLUTE coordinates "
+                "with origin at TOP LEFT corner. If you meant to use margin offsets, use negative values for "
+                "`bottom` and `right` arguments.")
         im_cropped = image[top:bottom, left:right]
     else:
         im_cropped = image
+    return im_cropped, grid_shape
+
+
+def split_image_to_grid(im_cropped, grid_shape):
+    """ Split an (already cropped) image into a list-of-lists of `grid_shape` smaller images.
+    The smaller images are views into `im_cropped` (no pixel data is copied).
+    """
     nrows, ncols = grid_shape
-    height, width = im_cropped.shape
-    print("im_cropped.shape:", im_cropped.shape)
-    print("nrows, ncols:", nrows, ncols)
-    print("image height, width:", height, width)
-
-    im_grid = [[
-            im_cropped[
-                int(height*r/nrows):int(height*(r+1)/nrows),
-                int(width*c/ncols):int(width*(c+1)/ncols)
-            ]
-            for c in range(ncols)]
-        for r in range(nrows)
-    ]
-    print("segment shapes:", [[im.shape for im in row] for row in im_grid])
+    height, width = im_cropped.shape[:2]
+    row_edges = [int(height*r/nrows) for r in range(nrows + 1)]
+    col_edges = [int(width*c/ncols) for c in range(ncols + 1)]
+    im_grid = [[im_cropped[row_edges[r]:row_edges[r+1], col_edges[c]:col_edges[c+1]]
+                for c in range(ncols)]
+               for r in range(nrows)]
     return im_grid
 
 
-def scan_lid_barcode(image):
+def segment_image_to_grid_array(image, grid_params):
+    """ Split image into a 4D (nrows, ncols, cell_height, cell_width) array view according to the grid parameters.
+
+    This is the vectorized alternative to `segment_image_to_grid()`: The returned array is a read-only,
+    strided view into the original image, so no pixel data is copied and operations can be applied
+    to all cells at once (e.g. `cells.mean(axis=(2, 3))`).
+
+    OBS: All cells must have the same size, so the cell size is rounded down to whole pixels,
+    and the last (up to nrows-1 / ncols-1) pixel rows and columns of the cropped image are not included.
+    This means the cell boundaries may differ by up to one pixel per row/col from `segment_image_to_grid()`.
+
+    Args:
+        image: The box image (2D grayscale image).
+        grid_params: Grid parameters, see `segment_image_to_grid()`.
+
+    Returns:
+        4D numpy array view with shape (nrows, ncols, cell_height, cell_width).
+    """
+    im_cropped, grid_shape = crop_image_to_grid(image, grid_params)
+    return split_image_to_grid_array(im_cropped, grid_shape)
+
+
+def split_image_to_grid_array(im_cropped, grid_shape):
+    """ Split an (already cropped) image into a 4D array view, see `segment_image_to_grid_array()`. """
+    nrows, ncols = grid_shape
+    height, width = im_cropped.shape[:2]
+    cell_height, cell_width = height // nrows, width // ncols
+    row_stride, col_stride = im_cropped.strides[:2]
+    return np.lib.stride_tricks.as_strided(
+        im_cropped,
+        shape=(nrows, ncols, cell_height, cell_width) + im_cropped.shape[2:],
+        strides=(cell_height * row_stride, cell_width * col_stride) + im_cropped.strides,
+        writeable=False,
+    )
+
+
+def scan_lid_barcode(image, **decode_kwargs):
     # Returns the barcode value from the barcode in the image.
     # This only expects the image to contain a single, easily-identifiable barcode.
     # This function may do some image filtering and processing to make it easier for
     # the barcode scanners to identify the 2D barcode.
+    # Any `decode_kwargs` (e.g. `timeout`, `shrink`) are passed on to the decoder.
     try:
-        data = decode_barcode_from_image(image, encoding=None)
+        data = decode_barcode_from_image(image, encoding=None, **decode_kwargs)
     except StopIteration:
         return None
+    return barcode_str_from_data(data)
+
+
+def scan_lid_region(image, region, **decode_kwargs):
+    """ Decode a single lid (or side) barcode from a region of the box image.
+
+    This is used to identify the box from the same frame as the tube barcodes,
+    e.g. with a label on the edge of the box that is visible next to the tube grid.
+
+    Args:
+        image: The box image.
+        region: (top, bottom, left, right) pixel slice bounds of the lid barcode region.
+            As for the grid margins, negative values are relative to the bottom/right of the image,
+            and None can be used for "all the way to the edge". If `region` is None, the whole image is used.
+        **decode_kwargs: Passed on to `scan_lid_barcode()`.
+
+    Returns:
+        The lid barcode string, or None if no barcode could be decoded.
+    """
+    if image is None:
+        raise ValueError("`image` is None (OBS: cv2.imread returns None if the image file could not be read).")
+    image = np.asarray(image)
+    if region is not None:
+        top, bottom, left, right = region
+        image = image[top:bottom, left:right]
+    if image.size == 0:
+        return None
+    return scan_lid_barcode(image, **decode_kwargs)
+
+
+def barcode_str_from_data(data):
+    """ Convert binary barcode data to a string (using utf-8, falling back to the bytes representation). """
     try:
         return data.decode('utf-8')
     except UnicodeDecodeError:
         return str(data)
 
 
-def scan_barcodes_in_grid(image, grid_params=None):
-    """ Returns a matrix of decoded barcode data (list of lists of strings).
+def rect_center(rect, image_height):
+    """ Return the (x, y) centre of a decoded barcode's `rect`, with origin in the TOP left corner.
+
+    OBS: libdmtx uses a coordinate system with origin in the BOTTOM left corner,
+    so `rect.top` is actually the distance from the bottom of the image.
+    `rect.width` and `rect.height` can be negative for rotated barcodes.
+    """
+    x = rect.left + rect.width / 2
+    y = image_height - (rect.top + rect.height / 2)
+    return x, y
+
+
+def grid_cell_from_point(x, y, height, width, grid_shape):
+    """ Return the (row, col) grid cell containing the point (x, y), or None if the point is outside the grid.
+    The cell boundaries are the same as used by `split_image_to_grid()`.
     """
+    if not (0 <= x < width and 0 <= y < height):
+        return None
+    nrows, ncols = grid_shape
+    row_edges = [int(height*r/nrows) for r in range(1, nrows)]
+    col_edges = [int(width*c/ncols) for c in range(1, ncols)]
+    return bisect_right(row_edges, y), bisect_right(col_edges, x)
+
+
+def scan_whole_image(im_cropped, grid_shape, rung=None, timeout=None):
+    """ Decode all barcodes in a (cropped) box image in a single pass, and assign each barcode to a grid cell.
+
+    This avoids setting up a separate decoder for every cell, which is faster for well-lit images
+    where the decoder is able to locate all barcodes in the full image.
+
+    Args:
+        im_cropped: The box image, cropped to the grid area (see `crop_image_to_grid()`).
+        grid_shape: (nrows, ncols) tuple.
+        rung: Dict with decode arguments, see `dmtx_reader.decode_kwargs_for_rung()`.
+            OBS: `edge_limits` are relative to the grid cell size, not the whole image.
+            Defaults to `DEFAULT_WHOLE_IMAGE_RUNG`.
+        timeout: Optional decode timeout, in milliseconds.
+
+    Returns:
+        Dict with {(row, col): barcode}, assigning each barcode by the centre of its rect.
+        If multiple barcodes are found in the same cell, only the first is used.
+    """
+    if rung is None:
+        rung = DEFAULT_WHOLE_IMAGE_RUNG
+    nrows, ncols = grid_shape
+    height, width = im_cropped.shape[:2]
+    decode_kwargs = decode_kwargs_for_rung(rung, (height / nrows, width / ncols), timeout=timeout)
+    decode_kwargs['max_count'] = nrows * ncols
+    results = {}
+    for decoded in decode_barcodes_from_image(im_cropped, **decode_kwargs):
+        x, y = rect_center(decoded.rect, image_height=height)
+        cell = grid_cell_from_point(x, y, height, width, grid_shape)
+        if cell is not None and cell not in results:
+            results[cell] = barcode_str_from_data(decoded.data)
+    return results
+
+
+def get_decode_executor(executor_type='thread', max_workers=None):
+    """ Create an executor for decoding grid cells in parallel.
+
+    Args:
+        executor_type: The type of executor, one of the keys in `DECODE_EXECUTORS` ('thread' or 'process').
+        max_workers: The number of worker threads/processes. Defaults to the number of CPUs.
+
+    Returns:
+        A `concurrent.futures.Executor` instance.
+        The caller is responsible for shutting down the executor when done.
+    """
+    try:
+        executor_cls = DECODE_EXECUTORS[executor_type]
+    except KeyError:
+        raise ValueError(f"Unrecognized decode executor type '{executor_type}'; "
+                         f"must be one of {list(DECODE_EXECUTORS)}.")
+    return executor_cls(max_workers=max_workers)
+
+
+def scan_cell_with_rung(image, rung, timeout=None):
+    """ Scan a single grid cell image using the decode arguments from a single decode-ladder rung.
+
+    Args:
+        image: The cell image.
+        rung: Dict with decode arguments, see `dmtx_reader.DEFAULT_DECODE_LADDER`.
+        timeout: Optional upper limit for the decode timeout, in milliseconds.
+
+    Returns:
+        The decoded barcode string, or None if no barcode was found.
+    """
+    return scan_lid_barcode(image, **decode_kwargs_for_rung(rung, np.shape(image), timeout=timeout))
+
+
+def map_cells(func, cells, executor=None, deadline=None):
+    """ Call `func(cell_image, timeout=...)` for each cell, optionally in parallel and within a deadline.
+
+    Args:
+        func: The function to call for each cell. Must accept a `timeout` keyword argument (milliseconds, or None).
+            If using a process pool, `func` must be picklable (e.g. a module-level function or a `partial`).
+        cells: Dict with {(row, col): cell_image}.
+        executor: Optional `concurrent.futures.Executor` used to process the cells in parallel.
+        deadline: Optional deadline, as a `time.perf_counter()` value.
+            Cells that were not processed before the deadline are not included in the output.
+
+    Returns:
+        Dict with {(row, col): func-return-value}.
+    """
+    results = {}
+    if executor is None:
+        for key, cell in cells.items():
+            timeout = None
+            if deadline is not None:
+                time_left = deadline - time.perf_counter()
+                if time_left <= 0:
+                    break
+                timeout = time_left * 1000
+            results[key] = func(cell, timeout=timeout)
+        return results
+    time_left = wall_deadline = None
+    if deadline is not None:
+        time_left = deadline - time.perf_counter()
+        if time_left <= 0:
+            return results
+        # perf_counter() values are not comparable between processes, so the workers get a wall-clock deadline:
+        wall_deadline = time.time() + time_left
+    futures = {executor.submit(_call_before_deadline, func, cell, wall_deadline): key for key, cell in cells.items()}
+    done, not_done = wait(futures, timeout=time_left)
+    for future in not_done:
+        future.cancel()
+    for future in done:
+        started, result = future.result()
+        if started:
+            results[futures[future]] = result
+    return results
+
+
+def _call_before_deadline(func, cell, wall_deadline=None):
+    """ Worker for `map_cells`: Call `func(cell, timeout=...)` with the time remaining when the worker starts.
+
+    Returns:
+        Two-tuple of (started, result). If the deadline (a `time.time()` value) has already passed
+        when the worker starts, e.g. because the cell was waiting in the executor queue,
+        the cell is skipped and (False, None) is returned.
+    """
+    timeout = None
+    if wall_deadline is not None:
+        time_left = wall_deadline - time.time()
+        if time_left <= 0:
+            return False, None
+        timeout = time_left * 1000
+    return True, func(cell, timeout=timeout)
+
+
+def scan_cells_with_ladder(cells, ladder=None, deadline=None, executor=None, cache=None):
+    """ Decode a set of grid cells using an escalating ladder of decode attempts.
+
+    All cells are first attempted with the first (cheapest) rung.
+    Only the cells that failed are attempted again with the next (more expensive) rung, and so on.
+
+    Args:
+        cells: Dict with {(row, col): cell_image}.
+        ladder: Sequence of rungs (dicts with decode arguments), see `dmtx_reader.DEFAULT_DECODE_LADDER`.
+            Defaults to a single rung without any decode arguments.
+        deadline: Optional overall deadline, as a `time.perf_counter()` value.
+            No new decode attempts are started after the deadline, and the decode timeout
+            of each attempt is limited to the time remaining before the deadline.
+        executor: Optional `concurrent.futures.Executor` used to decode the cells in parallel.
+        cache: Optional `DecodeCache`. Cells with a cached result for a rung are not decoded again.
+            Failed decodes are only cached when there is no deadline, since a decode that was
+            cut short by the deadline might have succeeded with the full rung timeout.
+
+    Returns:
+        Dict with {(row, col): (barcode, rung_index)} for all cells that were successfully decoded.
+    """
+    if ladder is None:
+        ladder = ({},)
+    results = {}
+    remaining = dict(cells)
+    # The cell hashes are calculated once and re-used for all rungs:
+    cell_hashes = {key: cell_hash(cell) for key, cell in cells.items()} if cache is not None else None
+    for rung_idx, rung in enumerate(ladder):
+        if not remaining:
+            break
+        if deadline is not None and time.perf_counter() >= deadline:
+            break
+        rung_barcodes = {}
+        to_decode = remaining
+        if cache is not None:
+            rung_key = decode_args_key(rung)
+            to_decode = {}
+            for key, cell in remaining.items():
+                found, barcode = cache.lookup((cell_hashes[key], rung_key))
+                if found:
+                    rung_barcodes[key] = barcode
+                else:
+                    to_decode[key] = cell
+        decoded = map_cells(partial(scan_cell_with_rung, rung=rung), to_decode, executor, deadline)
+        if cache is not None:
+            for key, barcode in decoded.items():
+                if barcode is not None or deadline is None:
+                    cache.put((cell_hashes[key], rung_key), barcode)
+        rung_barcodes.update(decoded)
+        for key, barcode in rung_barcodes.items():
+            if barcode is not None:
+                results[key] = (barcode, rung_idx)
+                del remaining[key]
+    return results
+
+
+def scan_box_grid(
+        image, grid_params=None, executor=None, ladder=None, time_budget=None,
+        whole_image=False, whole_image_rung=None, fallback=True,
+        skip_empty=False, empty_well_thresholds=None, cache=None, skip_cells=None,
+        preprocessing=None, preprocessing_target='cell',
+):
+    """ Scan all cells in a box image, returning a GridScanResult with both barcodes and decode-ladder rungs.
+
+    Args:
+        image: The box image.
+        grid_params: Grid parameters, see `segment_image_to_grid()`.
+        executor: Optional `concurrent.futures.Executor` used to decode the grid cells in parallel.
+            If None, the cells are decoded one after another in the calling thread.
+        ladder: Sequence of decode-ladder rungs, see `scan_cells_with_ladder()`.
+        time_budget: Optional overall time budget for the scan, in seconds.
+        whole_image: If True, first decode the whole (cropped) box image in a single pass,
+            see `scan_whole_image()`.
+        whole_image_rung: Decode arguments for the whole-image pass, see `scan_whole_image()`.
+        fallback: If `whole_image` is True, whether to decode the cells that are still empty
+            after the whole-image pass, one cell at a time.
+        skip_empty: If True, classify all cells before decoding (see `wellclassifier.classify_cells()`),
+            and skip the per-cell decoding of cells classified as empty wells.
+        empty_well_thresholds: Dict with thresholds for the empty-well classifier,
+            overriding the values in `wellclassifier.DEFAULT_EMPTY_WELL_THRESHOLDS`.
+        cache: Optional `DecodeCache` with per-cell decode results, see `scan_cells_with_ladder()`.
+        skip_cells: Optional set of (row, col) cells that should not be decoded one-by-one,
+            e.g. because the barcode is already known from a previous scan.
+        preprocessing: Optional chain of pre-processing steps applied before decoding,
+            see `preprocessing.build_pipeline()`.
+        preprocessing_target: Whether to apply the pre-processing to the whole (cropped) box 'image',
+            or to each 'cell'. The empty-well classification is always done on the original image.
+
+    Returns:
+        GridScanResult namedtuple with `barcodes`, `rungs`, and `cell_status` grids (list of lists),
+        where `rungs` contains the index of the ladder rung on which each cell was decoded,
+        `WHOLE_IMAGE_RUNG` for cells decoded by the whole-image pass,
+        or None for cells that were not decoded,
+        and `cell_status` contains the empty-well classification of each cell
+        (or is None if `skip_empty` is False).
+    """
+    deadline = None if time_budget is None else time.perf_counter() + time_budget
+    grid_shape, cell_status, cells, results = prepare_grid_cells(
+        image, grid_params, skip_empty=skip_empty, empty_well_thresholds=empty_well_thresholds,
+        skip_cells=skip_cells, preprocessing=preprocessing, preprocessing_target=preprocessing_target,
+        whole_image=whole_image, whole_image_rung=whole_image_rung, fallback=fallback, deadline=deadline)
+    nrows, ncols = grid_shape
+    if cells:
+        results.update(scan_cells_with_ladder(
+            cells, ladder=ladder, deadline=deadline, executor=executor, cache=cache))
+    grid_results = [[results.get((row, col), (None, None)) for col in range(ncols)] for row in range(nrows)]
+    return GridScanResult(
+        barcodes=[[barcode for barcode, rung in row] for row in grid_results],
+        rungs=[[rung for barcode, rung in row] for row in grid_results],
+        cell_status=None if cell_status is None else cell_status.tolist(),
+    )
+
+
+def cells_from_val_pos(val_pos_dict):
+    """ Convert a {barcode: 'A01'-pos} dict (e.g. from the tubes table) to a {(row, col): barcode} dict. """
+    if not val_pos_dict:
+        return {}
+    values, coords = values_coords_tup_from_val_pos(val_pos_dict)
+    return {(int(row), int(col)): value for value, (row, col) in zip(values, coords)}
+
+
+def scan_box_grid_with_prior(
+        image, prior, grid_params=None, executor=None, ladder=None, time_budget=None,
+        empty_well_thresholds=None, cache=None, verify_fraction=0.1, random_state=None,
+        skip_empty=True, **scan_kwargs
+):
+    """ Re-scan a known box, using the barcode positions from the previous scan as a prior.
+
+    1. The cells that were occupied in the previous scan are decoded first.
+    2. If all of them decode to the expected barcodes, the box is "confirmed" and the remaining
+        (previously empty) cells only get the cheap empty-well check (see `wellclassifier.classify_cells()`):
+        Cells that no longer look empty are decoded (a tube was added), and a random sample of
+        `verify_fraction` of the empty-looking cells is decoded to verify the classification.
+    3. Otherwise (the box has changed), all remaining cells are decoded,
+        skipping the cells classified as empty if `skip_empty` is True.
+
+    For an unchanged box, this means only the occupied cells are decoded.
+
+    Args:
+        image: The box image.
+        prior: The previous barcode positions, either as a {(row, col): barcode} dict,
+            or as a {barcode: 'A01'-pos} dict, e.g. from `TubeTrackerDf.get_barcode_val_pos_for_box()`.
+        grid_params: Grid parameters, see `segment_image_to_grid()`.
+        executor: Optional executor used to decode cells in parallel, see `scan_box_grid()`.
+        ladder: Sequence of decode-ladder rungs, see `scan_cells_with_ladder()`.
+        time_budget: Optional overall time budget for the scan, in seconds.
+        empty_well_thresholds: Thresholds for the empty-well classifier, see `scan_box_grid()`.
+        cache: Optional `DecodeCache`, see `scan_cells_with_ladder()`.
+        verify_fraction: Fraction of the empty-looking, previously-empty cells that are decoded anyway.
+        random_state: Seed or `np.random.RandomState` used to select the verification sample.
+        skip_empty: If the box is not confirmed, whether to skip decoding cells classified as empty.
+        **scan_kwargs: Other keyword arguments for `scan_box_grid()`, e.g. `preprocessing`.
+
+    Returns:
+        GridScanResult namedtuple (see `scan_box_grid()`), with `confirmed` True if all of the
+        previously occupied cells decoded to the expected barcodes.
+    """
+    deadline = None if time_budget is None else time.perf_counter() + time_budget
     if grid_params is None:
         grid_params = estimate_box_grid_params(image)
-    grid_images = segment_image_to_grid(image, grid_params)
-    grid_barcodes = [[scan_lid_barcode(tube_image) for tube_image in image_row] for image_row in grid_images]
-    return grid_barcodes
+    if prior and not isinstance(next(iter(prior)), tuple):
+        prior = cells_from_val_pos(prior)
+    prior = prior or {}
+    im_cropped, (nrows, ncols) = crop_image_to_grid(image, grid_params)
+    all_cells = {(row, col) for row in range(nrows) for col in range(ncols)}
+    occupied = set(prior) & all_cells
+
+    def remaining_time():
+        return None if deadline is None else max(deadline - time.perf_counter(), 0)
+
+    # 1. Decode the previously occupied cells:
+    first = scan_box_grid(
+        im_cropped, grid_params=(0, None, 0, None, (nrows, ncols)), executor=executor, ladder=ladder,
+        time_budget=remaining_time(), cache=cache, skip_cells=all_cells - occupied, **scan_kwargs)
+    confirmed = all(first.barcodes[row][col] == prior[(row, col)] for row, col in occupied)
+
+    # 2./3. Check the remaining cells:
+    cell_status = classify_cells(split_image_to_grid_array(im_cropped, (nrows, ncols)), empty_well_thresholds)
+    remaining = all_cells - occupied
+    empty = {cell for cell in remaining if cell_status[cell] == CELL_EMPTY}
+    if confirmed:
+        rng = random_state if isinstance(random_state, np.random.RandomState) else np.random.RandomState(random_state)
+        empty_cells = sorted(empty)
+        n_verify = int(np.ceil(len(empty_cells) * verify_fraction)) if verify_fraction else 0
+        verify = {empty_cells[idx] for idx in rng.choice(len(empty_cells), n_verify, replace=False)}
+        to_decode = (remaining - empty) | verify
+    else:
+        to_decode = remaining - empty if skip_empty else remaining
+    second = scan_box_grid(
+        im_cropped, grid_params=(0, None, 0, None, (nrows, ncols)), executor=executor, ladder=ladder,
+        time_budget=remaining_time(), cache=cache, skip_cells=all_cells - to_decode, **scan_kwargs)
+
+    def merge(grid1, grid2):
+        return [[grid1[row][col] if (row, col) in occupied else grid2[row][col] for col in range(ncols)]
+                for row in range(nrows)]
+    return GridScanResult(
+        barcodes=merge(first.barcodes, second.barcodes),
+        rungs=merge(first.rungs, second.rungs),
+        cell_status=cell_status.tolist(),
+        confirmed=confirmed,
+    )
+
+
+def prepare_grid_cells(
+        image, grid_params=None, skip_empty=False, empty_well_thresholds=None, skip_cells=None,
+        preprocessing=None, preprocessing_target='cell',
+        whole_image=False, whole_image_rung=None, fallback=True, deadline=None,
+):
+    """ Crop, classify, and (optionally) pre-process the grid cells that should be decoded.
+
+    If `whole_image` is True, the whole (cropped) box image is first decoded in a single pass
+    (see `scan_whole_image()`), and only the cells that are still empty are decoded one at a time
+    (or none of them, if `fallback` is False).
+
+    Args:
+        deadline: Optional deadline for the whole-image pass, as a `time.perf_counter()` value.
+        The remaining arguments are the same as for `scan_box_grid()`.
+
+    Returns:
+        Four-tuple of (grid_shape, cell_status, cells, results), where `cell_status` is the array of empty-well
+        classifications (or None if `skip_empty` is False), `cells` is a dict with {(row, col): cell_image}
+        for the cells to decode, in row-major order, and `results` is a dict with
+        {(row, col): (barcode, WHOLE_IMAGE_RUNG)} for the cells decoded by the whole-image pass.
+    """
+    if preprocessing_target not in PREPROCESSING_TARGETS:
+        raise ValueError(f"Unrecognized `preprocessing_target` '{preprocessing_target}'; "
+                         f"must be one of {PREPROCESSING_TARGETS}.")
+    pipeline = build_pipeline(preprocessing)
+    if grid_params is None:
+        grid_params = estimate_box_grid_params(image)
+    im_cropped, grid_shape = crop_image_to_grid(image, grid_params)
+    cell_status = None
+    if skip_empty:
+        cell_status = classify_cells(split_image_to_grid_array(im_cropped, grid_shape), empty_well_thresholds)
+    if pipeline is not None and preprocessing_target == 'image':
+        im_cropped = pipeline(im_cropped)
+    results = {}
+    if whole_image:
+        timeout = None if deadline is None else (deadline - time.perf_counter()) * 1000
+        if timeout is None or timeout > 0:
+            results = {
+                cell: (barcode, WHOLE_IMAGE_RUNG)
+                for cell, barcode in scan_whole_image(im_cropped, grid_shape, whole_image_rung, timeout).items()
+            }
+        if not fallback:
+            return grid_shape, cell_status, {}, results
+    cells = {(row, col): tube_image
+             for row, image_row in enumerate(split_image_to_grid(im_cropped, grid_shape))
+             for col, tube_image in enumerate(image_row)
+             if (row, col) not in results
+             and (skip_cells is None or (row, col) not in skip_cells)
+             and (cell_status is None or cell_status[row, col] != CELL_EMPTY)}
+    if pipeline is not None and preprocessing_target == 'cell':
+        cells = {cell: pipeline(tube_image) for cell, tube_image in cells.items()}
+    return grid_shape, cell_status, cells, results
+
+
+def lookup_cell_scan(image, ladder, cache=None):
+    """ Look up the decode-ladder results for a single cell in the cache.
+
+    This (and `finish_cell_scan()`) is called in the calling process, so that only the cell image and
+    the rungs are sent to the executor, and the cache is never pickled or shared with worker processes.
+
+    Returns:
+        Three-tuple of (image_hash, cached, rungs), where `cached` is (barcode, rung_index) for the first rung
+        with a cached barcode (or None), and `rungs` is a list of (rung_index, rung) for the rungs before it,
+        which have no cached result and still need to be decoded.
+    """
+    if cache is None:
+        return None, None, list(enumerate(ladder))
+    image_hash = cell_hash(image)
+    rungs = []
+    for rung_idx, rung in enumerate(ladder):
+        found, barcode = cache.lookup((image_hash, decode_args_key(rung)))
+        if found and barcode is not None:
+            return image_hash, (barcode, rung_idx), rungs
+        if not found:
+            rungs.append((rung_idx, rung))
+    return image_hash, None, rungs
+
+
+def scan_cell_rungs(image, rungs, wall_deadline=None):
+    """ Decode a single cell with a list of (rung_index, rung) pairs, stopping at the first rung that finds a barcode.
+
+    Args:
+        image: The cell image.
+        rungs: List of (rung_index, rung), e.g. from `lookup_cell_scan()`.
+        wall_deadline: Optional deadline, as a `time.time()` value (since `perf_counter()` values are not
+            comparable between processes). No new rung is started after the deadline.
+
+    Returns:
+        List of (rung_index, barcode) for the rungs that were attempted.
+    """
+    attempts = []
+    for rung_idx, rung in rungs:
+        timeout = None
+        if wall_deadline is not None:
+            time_left = wall_deadline - time.time()
+            if time_left <= 0:
+                break
+            timeout = time_left * 1000
+        barcode = scan_cell_with_rung(image, rung, timeout=timeout)
+        attempts.append((rung_idx, barcode))
+        if barcode is not None:
+            break
+    return attempts
+
+
+def finish_cell_scan(image_hash, cached, attempts, ladder, cache=None, deadline=None):
+    """ Add the attempted rungs to the cache, and return the (barcode, rung_index) result for the cell.
+
+    Failed decodes are only cached when there is no deadline, see `scan_cells_with_ladder()`.
+    """
+    for rung_idx, barcode in attempts:
+        if cache is not None and (barcode is not None or deadline is None):
+            cache.put((image_hash, decode_args_key(ladder[rung_idx])), barcode)
+        if barcode is not None:
+            return barcode, rung_idx
+    return cached if cached is not None else (None, None)
+
+
+def wall_deadline_from(deadline):
+    """ Convert a `time.perf_counter()` deadline to a `time.time()` deadline (None if deadline is None). """
+    return None if deadline is None else time.time() + (deadline - time.perf_counter())
+
+
+def scan_cell_event(cell, image, start, ladder=None, deadline=None, cache=None):
+    """ Decode a single cell with the decode ladder, returning a ScanEvent. """
+    ladder = ({},) if ladder is None else ladder
+    image_hash, cached, rungs = lookup_cell_scan(image, ladder, cache)
+    attempts = scan_cell_rungs(image, rungs, wall_deadline=wall_deadline_from(deadline))
+    barcode, rung = finish_cell_scan(image_hash, cached, attempts, ladder, cache=cache, deadline=deadline)
+    row, col = cell
+    return ScanEvent(row, col, barcode, time.perf_counter() - start)
+
+
+def iter_scan_box_grid(
+        image, grid_params=None, executor=None, ladder=None, time_budget=None,
+        skip_empty=False, empty_well_thresholds=None, cache=None, skip_cells=None,
+        preprocessing=None, preprocessing_target='cell', cancel_event=None,
+):
+    """ Progressive box scan: Generator yielding a `ScanEvent(row, col, barcode, timing)` as soon as each cell
+    has been decoded, e.g. to fill in the barcode grid in a GUI while the scan is running.
+
+    Each cell goes through the whole decode ladder before its event is yielded. Events are yielded for all
+    cells that are decoded (with barcode None if decoding failed); cells skipped because they were classified
+    as empty wells (or are in `skip_cells`) are not reported. With an executor, events are yielded in the order
+    the cells finish; otherwise in row-major order.
+
+    The scan can be cancelled either by closing the generator (`.close()`, or breaking out of a for-loop),
+    or by setting `cancel_event` (a `threading.Event`); cells that have not started decoding are then cancelled.
+
+    Args:
+        cancel_event: Optional `threading.Event`, which can be set from another thread to cancel the scan.
+        The remaining arguments are the same as for `scan_box_grid()`.
+
+    Yields:
+        ScanEvent namedtuples.
+    """
+    start = time.perf_counter()
+    deadline = None if time_budget is None else start + time_budget
+    grid_shape, cell_status, cells, _ = prepare_grid_cells(
+        image, grid_params, skip_empty=skip_empty, empty_well_thresholds=empty_well_thresholds,
+        skip_cells=skip_cells, preprocessing=preprocessing, preprocessing_target=preprocessing_target)
+    if executor is None:
+        for cell, cell_image in cells.items():
+            if cancel_event is not None and cancel_event.is_set():
+                return
+            if deadline is not None and time.perf_counter() >= deadline:
+                return
+            yield scan_cell_event(cell, cell_image, start, ladder=ladder, deadline=deadline, cache=cache)
+        return
+    # The cache is only used here, in the calling process; the workers just decode the remaining rungs:
+    ladder = ({},) if ladder is None else ladder
+    wall_deadline = wall_deadline_from(deadline)
+    lookups = {cell: lookup_cell_scan(cell_image, ladder, cache) for cell, cell_image in cells.items()}
+    futures = {executor.submit(scan_cell_rungs, cells[cell], rungs, wall_deadline): cell
+               for cell, (image_hash, cached, rungs) in lookups.items() if rungs}
+    try:
+        for cell, (image_hash, cached, rungs) in lookups.items():
+            if not rungs:
+                yield ScanEvent(*cell, (cached or (None, None))[0], time.perf_counter() - start)
+        for future in as_completed(futures, timeout=None if deadline is None else deadline - time.perf_counter()):
+            if cancel_event is not None and cancel_event.is_set():
+                return
+            cell = futures[future]
+            image_hash, cached, rungs = lookups[cell]
+            barcode, rung = finish_cell_scan(
+                image_hash, cached, future.result(), ladder, cache=cache, deadline=deadline)
+            yield ScanEvent(*cell, barcode, time.perf_counter() - start)
+    except FuturesTimeoutError:
+        return
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+async def aiter_scan_box_grid(
+        image, grid_params=None, executor=None, ladder=None, time_budget=None,
+        skip_empty=False, empty_well_thresholds=None, cache=None, skip_cells=None,
+        preprocessing=None, preprocessing_target='cell',
+):
+    """ Asynchronous version of `iter_scan_box_grid()`: Async generator yielding a ScanEvent as each cell is done.
+
+    The cells are decoded in `executor` (defaults to the event loop's default executor) using
+    `loop.run_in_executor()`, and events are yielded in the order the cells finish.
+    Cancel the scan by cancelling the task consuming the generator (or by closing the generator);
+    cells that have not started decoding are then cancelled.
+
+    Args:
+        The same as for `scan_box_grid()`.
+
+    Yields:
+        ScanEvent namedtuples.
+    """
+    start = time.perf_counter()
+    deadline = None if time_budget is None else start + time_budget
+    grid_shape, cell_status, cells, _ = prepare_grid_cells(
+        image, grid_params, skip_empty=skip_empty, empty_well_thresholds=empty_well_thresholds,
+        skip_cells=skip_cells, preprocessing=preprocessing, preprocessing_target=preprocessing_target)
+    loop = asyncio.get_running_loop()
+    # As in `iter_scan_box_grid()`, the cache is only used in the calling process:
+    ladder = ({},) if ladder is None else ladder
+    wall_deadline = wall_deadline_from(deadline)
+
+    async def scan_cell(cell, cell_image):
+        image_hash, cached, rungs = lookup_cell_scan(cell_image, ladder, cache)
+        attempts = []
+        if rungs:
+            attempts = await loop.run_in_executor(executor, scan_cell_rungs, cell_image, rungs, wall_deadline)
+        barcode, rung = finish_cell_scan(image_hash, cached, attempts, ladder, cache=cache, deadline=deadline)
+        return ScanEvent(*cell, barcode, time.perf_counter() - start)
+
+    tasks = [loop.create_task(scan_cell(cell, cell_image)) for cell, cell_image in cells.items()]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def count_barcodes(grid_barcodes):
+    """ Return the number of decoded barcodes (non-None values) in a grid of barcodes. """
+    return sum(barcode is not None for row in grid_barcodes for barcode in row)
+
+
+def scan_barcodes_in_grid(image, grid_params=None, executor=None, ladder=None, time_budget=None):
+    """ Returns a matrix of decoded barcode data (list of lists of strings).
+
+    Args:
+        image: The box image.
+        grid_params: Grid parameters, see `segment_image_to_grid()`.
+        executor: Optional `concurrent.futures.Executor` used to decode the grid cells in parallel.
+            If None, the cells are decoded one after another in the calling thread.
+        ladder: Optional sequence of decode-ladder rungs, see `scan_cells_with_ladder()`.
+        time_budget: Optional overall time budget for the scan, in seconds.
+
+    Returns:
+        List of lists with the decoded barcode for each grid cell (None for cells without a barcode).
+        The grid order is the same regardless of whether an executor is used.
+    """
+    return scan_box_grid(
+        image, grid_params=grid_params, executor=executor, ladder=ladder, time_budget=time_budget
+    ).barcodes
 
 
 class BoxScanner:
@@ -172,17 +912,24 @@ class BoxScanner:
     def __init__(self, config):
         self.config = config
         self.last_box_scan = None
+        self.last_scan_result = None
         self.best_box_scan = None
+        self._decode_executor = None
+        self.decode_cache = DecodeCache(maxsize=self.decode_cache_size)
+        self.grid_calibrations = GridCalibrationCache(self.grid_calibration_file)
+        # The resolved decoder backend, added to each decode-ladder rung (None for the default backend):
+        self.selected_decoder_backend = self.setup_decoder_backend() if self.decoder_backend is not None else None
 
     @property
     def box_margin(self):
-        """ Return box margin as defined by the config. Defaults to a 10 pixel margin all around."""
+        """ Return box margin as defined by the config. Defaults to a 10 pixel margin all around.
+        Use 'auto' to locate the box grid automatically, see `get_box_grid_params()`. """
         return self.config.get('boxscanner_box_margin', (10, 10, -10, -10))
 
     @property
     def box_grid(self):
         """ Return box grid as defined by the config. Defaults to a 10x10 grid."""
-        box_grid = self.config.get('boxscanner_box_margin', (10, 10))
+        box_grid = self.config.get('boxscanner_box_grid', (10, 10))
         # if isinstance(box_grid, int):
         #     box_grid = (box_grid, box_grid)
         return box_grid
@@ -190,12 +937,305 @@ class BoxScanner:
     @property
     def box_grid_params(self):
         """ grid_params is a tuple of (nmargin_top, nmargin_bottom, nmargin_left, nmargin_right, grid_shape)"""
-        return self.box_margin + (self.box_grid,)
+        return tuple(self.box_margin) + (self.box_grid,)
+
+    @property
+    def auto_grid(self):
+        """ Return whether the box grid is located automatically (`boxscanner_box_margin` config is 'auto'). """
+        return self.box_margin == 'auto'
+
+    @property
+    def camera_id(self):
+        """ Return the camera id used as key for the grid calibration, as defined by the config. """
+        return self.config.get('boxscanner_camera_id', 'default')
+
+    @property
+    def box_type(self):
+        """ Return the box type used as key for the grid calibration, as defined by the config.
+        Defaults to the box grid shape, e.g. '10x10'. """
+        box_grid = self.box_grid
+        if isinstance(box_grid, int):
+            box_grid = (box_grid, box_grid)
+        return self.config.get('boxscanner_box_type', 'x'.join(str(n) for n in box_grid))
+
+    @property
+    def grid_calibration_file(self):
+        """ Return the file where located box grids are persisted, as defined by the config.
+        Defaults to None (grid calibrations are only cached in memory). """
+        return self.config.get('boxscanner_grid_calibration_file', None)
+
+    @property
+    def grid_validation_tolerance(self):
+        """ Return the fraction of the calibration grid score an image must reach for the cached grid
+        to be re-used, as defined by the config. Defaults to 0.7. """
+        return self.config.get('boxscanner_grid_validation_tolerance', 0.7)
+
+    @property
+    def decode_executor_type(self):
+        """ Return the type of executor used to decode grid cells in parallel ('thread' or 'process'),
+        as defined by the config. Defaults to None, which decodes the cells serially. """
+        return self.config.get('boxscanner_decode_executor', None)
+
+    @property
+    def decode_workers(self):
+        """ Return the number of parallel decode workers, as defined by the config.
+        Defaults to None, which uses the number of CPUs. """
+        return self.config.get('boxscanner_decode_workers', None)
+
+    @property
+    def decode_cache_size(self):
+        """ Return the maximum number of cached per-cell decode results, as defined by the config.
+        Defaults to 1024. Use 0 to disable the decode cache. """
+        return self.config.get('boxscanner_decode_cache_size', 1024)
+
+    @property
+    def decode_executor(self):
+        """ Return the executor used for parallel decoding (created on first use), or None. """
+        if self._decode_executor is None and self.decode_executor_type:
+            self._decode_executor = get_decode_executor(self.decode_executor_type, self.decode_workers)
+        return self._decode_executor
+
+    @property
+    def decode_ladder(self):
+        """ Return the sequence of decode attempts ("rungs") used for each cell, as defined by the config.
+        Defaults to `dmtx_reader.DEFAULT_DECODE_LADDER`. The scanner's decoder backend is added to each rung. """
+        return tuple(self.rung_with_backend(rung)
+                     for rung in self.config.get('boxscanner_decode_ladder', DEFAULT_DECODE_LADDER))
+
+    def rung_with_backend(self, rung):
+        """ Return the decode arguments in `rung` with the scanner's decoder backend added
+        (unless the rung specifies its own backend, or the default backend is used). """
+        if self.selected_decoder_backend is None or 'backend' in rung:
+            return rung
+        return dict(rung, backend=self.selected_decoder_backend)
 
-    def scan_box_image_grid(self, image):
-        grid_barcodes = scan_barcodes_in_grid(image=image, grid_params=self.box_grid_params)
+    @property
+    def scan_time_budget(self):
+        """ Return the overall time budget for scanning a box, in seconds, as defined by the config.
+        Defaults to None (no time limit). """
+        return self.config.get('boxscanner_scan_time_budget', None)
+
+    @property
+    def decode_mode(self):
+        """ Return the box scanning mode, as defined by the config (one of `DECODE_MODES`).
+        Defaults to 'cells', decoding each cell separately. """
+        return self.config.get('boxscanner_decode_mode', 'cells')
+
+    @property
+    def whole_image_fallback(self):
+        """ Return whether to decode the remaining empty cells one-by-one after a whole-image scan,
+        as defined by the config. Defaults to True. """
+        return self.config.get('boxscanner_whole_image_fallback', True)
+
+    @property
+    def skip_empty_wells(self):
+        """ Return whether to classify cells before decoding and skip empty wells, as defined by the config.
+        Defaults to False. """
+        return self.config.get('boxscanner_skip_empty_wells', False)
+
+    @property
+    def empty_well_thresholds(self):
+        """ Return the empty-well classifier thresholds, as defined by the config.
+        Defaults to None, using `wellclassifier.DEFAULT_EMPTY_WELL_THRESHOLDS`. """
+        return self.config.get('boxscanner_empty_well_thresholds', None)
+
+    @property
+    def preprocessing(self):
+        """ Return the chain of image pre-processing steps applied before decoding, as defined by the config.
+        Defaults to None (no pre-processing). See `preprocessing.build_pipeline()`. """
+        return self.config.get('boxscanner_preprocessing', None)
+
+    @property
+    def preprocessing_target(self):
+        """ Return whether pre-processing is applied to the whole box 'image' or to each 'cell',
+        as defined by the config. Defaults to 'cell'. """
+        return self.config.get('boxscanner_preprocessing_target', 'cell')
+
+    @property
+    def decoder_backend(self):
+        """ Return the decoder backend (or fallback chain of backends) as defined by the config,
+        or 'auto' to select the fastest backend at startup, see `setup_decoder_backend()`.
+        Defaults to None, using `dmtx_reader.DEFAULT_DECODER_BACKEND`. """
+        return self.config.get('boxscanner_decoder_backend', None)
+
+    @property
+    def decoder_reference_image(self):
+        """ Return the reference cell image file used to select the decoder backend, as defined by the config. """
+        return self.config.get('boxscanner_decoder_reference_image', DEFAULT_REFERENCE_CELL_IMAGE)
+
+    @property
+    def decoder_reference_barcode(self):
+        """ Return the barcode in the reference cell image, as defined by the config. """
+        return self.config.get('boxscanner_decoder_reference_barcode', DEFAULT_REFERENCE_CELL_BARCODE)
+
+    def setup_decoder_backend(self):
+        """ Resolve the decoder backend defined by the config.
+
+        If `boxscanner_decoder_backend` is 'auto', all installed backends are benchmarked on the reference
+        cell image, and the backends that decode it correctly are used as a fallback chain, fastest first.
+        Backends that are not installed are left out of the chain (with a warning).
+
+        The backend is passed to the decoder with the decode arguments (see `rung_with_backend()`),
+        so it only applies to this scanner, including in decode worker processes.
+
+        Returns:
+            The decoder backend (or fallback chain of backends), or None to use the default decoder backend.
+        """
+        backend = self.decoder_backend
+        if backend == 'auto':
+            best, timings = select_decoder_backend(imread(self.decoder_reference_image), self.decoder_reference_barcode)
+            if best is None:
+                warnings.warn("None of the decoder backends could decode the reference image; "
+                              "using the default decoder backend.")
+                return None
+            backend = tuple(sorted(timings, key=timings.get))
+            print("Decoder backends (fastest first):", ", ".join(f"{name} ({timings[name]*1000:.1f} ms)"
+                                                               for name in backend))
+            return backend
+        names = [backend] if isinstance(backend, str) else list(backend)
+        installed = []
+        for name in names:
+            if name not in DECODER_BACKENDS:
+                raise ValueError(f"Unrecognized decoder backend '{name}'; must be one of {list(DECODER_BACKENDS)}.")
+            try:
+                load_decoder_backend(name)
+            except (ImportError, OSError) as exc:
+                warnings.warn(f"Decoder backend '{name}' is not installed ({exc}); skipping it.")
+                continue
+            installed.append(name)
+        if not installed:
+            warnings.warn(f"None of the decoder backends {names} are installed; using the default decoder backend.")
+            return None
+        return installed[0] if isinstance(backend, str) else tuple(installed)
+
+    @property
+    def lid_barcode_region(self):
+        """ Return the (top, bottom, left, right) region of the box image with the lid (or side) barcode,
+        as defined by the config. Defaults to None (the box images don't include a lid barcode). """
+        region = self.config.get('boxscanner_lid_barcode_region', None)
+        return tuple(region) if region is not None else None
+
+    @property
+    def lid_barcode_timeout(self):
+        """ Return the decode timeout (in milliseconds) for the lid barcode, as defined by the config.
+        Defaults to 200 ms, so a missing lid barcode doesn't hold up the scan. """
+        return self.config.get('boxscanner_lid_barcode_timeout', 200)
+
+    @property
+    def prior_verify_fraction(self):
+        """ Return the fraction of previously-empty, empty-looking cells that are decoded anyway when re-scanning
+        a known box, as defined by the config. Defaults to 0.1. See `scan_box_grid_with_prior()`. """
+        return self.config.get('boxscanner_prior_verify_fraction', 0.1)
+
+    @property
+    def prior_random_seed(self):
+        """ Return the random seed used to select the verification sample, as defined by the config.
+        Defaults to None (a different sample for each scan). """
+        return self.config.get('boxscanner_prior_random_seed', None)
+
+    def close(self):
+        """ Shut down the parallel decode executor, if one has been created. """
+        if self._decode_executor is not None:
+            self._decode_executor.shutdown()
+            self._decode_executor = None
+
+    def get_box_grid_params(self, image):
+        """ Return the grid params for the given box image.
+
+        If the box grid is located automatically (`boxscanner_box_margin` is 'auto'), the cached
+        grid calibration for the current camera and box type is used as long as it passes a cheap
+        validation on the image; otherwise the grid is re-located and the calibration is updated.
+        """
+        if not self.auto_grid:
+            return self.box_grid_params
+        image = np.asarray(image)
+        calibration = self.grid_calibrations.get(self.camera_id, self.box_type)
+        if calibration is not None:
+            grid_params, score = calibration
+            if validate_box_grid(image, grid_params, min_score=score * self.grid_validation_tolerance):
+                return grid_params
+        grid_params, score = locate_box_grid(image, grid_shape=self.box_grid)
+        self.grid_calibrations.set(self.camera_id, self.box_type, grid_params, score)
+        return grid_params
+
+    def scan_box_image(self, image, skip_cells=None, prior=None):
+        """ Scan box image using the config-defined settings, returning a GridScanResult.
+
+        Args:
+            image: The box image.
+            skip_cells: Optional set of (row, col) cells that should not be decoded.
+            prior: Optional barcode positions from the previous scan of the box, e.g. from
+                `TubeTrackerDf.get_barcode_val_pos_for_box()`. If given, the box is scanned using
+                `scan_box_grid_with_prior()` (and `skip_cells` and `boxscanner_decode_mode` are not used).
+
+        Returns:
+            GridScanResult namedtuple, see `scan_box_grid()`.
+        """
+        if prior is not None:
+            scan_result = scan_box_grid_with_prior(
+                image=image, prior=prior, grid_params=self.get_box_grid_params(image),
+                executor=self.decode_executor, ladder=self.decode_ladder, time_budget=self.scan_time_budget,
+                empty_well_thresholds=self.empty_well_thresholds,
+                cache=self.decode_cache if self.decode_cache.maxsize else None,
+                verify_fraction=self.prior_verify_fraction, random_state=self.prior_random_seed,
+                skip_empty=self.skip_empty_wells,
+                preprocessing=self.preprocessing, preprocessing_target=self.preprocessing_target,
+            )
+            self.last_scan_result = scan_result
+            return scan_result
+        decode_mode = self.decode_mode
+        if decode_mode not in DECODE_MODES:
+            raise ValueError(f"Unrecognized `boxscanner_decode_mode` '{decode_mode}'; must be one of {DECODE_MODES}.")
+        scan_result = scan_box_grid(
+            image=image, grid_params=self.get_box_grid_params(image), executor=self.decode_executor,
+            ladder=self.decode_ladder, time_budget=self.scan_time_budget,
+            whole_image=(decode_mode == 'whole_image'), fallback=self.whole_image_fallback,
+            whole_image_rung=self.rung_with_backend(DEFAULT_WHOLE_IMAGE_RUNG),
+            skip_empty=self.skip_empty_wells, empty_well_thresholds=self.empty_well_thresholds,
+            cache=self.decode_cache if self.decode_cache.maxsize else None,
+            skip_cells=skip_cells,
+            preprocessing=self.preprocessing, preprocessing_target=self.preprocessing_target,
+        )
+        self.last_scan_result = scan_result
+        return scan_result
+
+    def scan_box_lid_barcode(self, image):
+        """ Decode the lid barcode from the config-defined region of the box image (the same frame as the tubes).
+        Returns None if no lid barcode region is configured, or if the lid barcode could not be decoded. """
+        region = self.lid_barcode_region
+        if region is None:
+            return None
+        return scan_lid_region(image, region, **self.rung_with_backend({'timeout': self.lid_barcode_timeout}))
+
+    def iter_scan_box_image(self, image, cancel_event=None):
+        """ Progressive scan of a box image using the config-defined settings, yielding a ScanEvent for each cell
+        as soon as it is decoded. See `iter_scan_box_grid()`. """
+        return iter_scan_box_grid(
+            image, grid_params=self.get_box_grid_params(image), executor=self.decode_executor,
+            ladder=self.decode_ladder, time_budget=self.scan_time_budget,
+            skip_empty=self.skip_empty_wells, empty_well_thresholds=self.empty_well_thresholds,
+            cache=self.decode_cache if self.decode_cache.maxsize else None,
+            preprocessing=self.preprocessing, preprocessing_target=self.preprocessing_target,
+            cancel_event=cancel_event,
+        )
+
+    def aiter_scan_box_image(self, image):
+        """ Asynchronous progressive scan of a box image using the config-defined settings.
+        See `aiter_scan_box_grid()`. """
+        return aiter_scan_box_grid(
+            image, grid_params=self.get_box_grid_params(image), executor=self.decode_executor,
+            ladder=self.decode_ladder, time_budget=self.scan_time_budget,
+            skip_empty=self.skip_empty_wells, empty_well_thresholds=self.empty_well_thresholds,
+            cache=self.decode_cache if self.decode_cache.maxsize else None,
+            preprocessing=self.preprocessing, preprocessing_target=self.preprocessing_target,
+        )
+
+    def scan_box_image_grid(self, image, prior=None):
+        """ Scan box image, returning a grid (list of lists) with the decoded barcodes.
+        See `scan_box_image()` for the optional `prior`. """
+        grid_barcodes = self.scan_box_image(image, prior=prior).barcodes
         self.last_box_scan = grid_barcodes
-        if self.best_box_scan is None or self.best_box_scan <= len(grid_barcodes):
+        if self.best_box_scan is None or count_barcodes(self.best_box_scan) <= count_barcodes(grid_barcodes):
             self.best_box_scan = grid_barcodes
         return grid_barcodes
 
@@ -206,4 +1246,132 @@ class AggregatingBoxScanner(BoxScanner):
     building up a grid of barcodes gradually as it gains more information on barcodes and
     their relative location.
 
+    Each new frame only decodes the cells where the barcode is still unknown,
+    and newly-decoded barcodes are merged into the aggregated grid by cell.
+    This makes it possible to reach a full read of a box using a few fast frames
+    (e.g. with a short `boxscanner_scan_time_budget`) instead of one slow, exhaustive scan.
+
+    Scanning is done when either:
+    * The grid is complete, i.e. all cells are either decoded or classified as empty wells
+        (the latter requires `boxscanner_skip_empty_wells`).
+    * The grid has been stable (no new barcodes) for `aggregatingboxscanner_stable_frames` frames.
+
+    OBS: The cells are merged by position, so the box should not be moved between frames.
+
     """
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.aggregated_grid = None
+        self.aggregated_status = None
+        self.frames_scanned = 0
+        self.stable_frames_count = 0
+
+    @property
+    def stable_frames(self):
+        """ Return the number of frames without new barcodes after which scanning is done, as defined by
+        the config. Defaults to 3. """
+        return self.config.get('aggregatingboxscanner_stable_frames', 3)
+
+    @property
+    def max_frames(self):
+        """ Return the maximum number of frames to scan, as defined by the config. Defaults to None (no limit). """
+        return self.config.get('aggregatingboxscanner_max_frames', None)
+
+    def reset(self):
+        """ Reset the aggregated grid, e.g. before scanning a new box. """
+        self.aggregated_grid = None
+        self.aggregated_status = None
+        self.frames_scanned = 0
+        self.stable_frames_count = 0
+
+    @property
+    def known_cells(self):
+        """ Return set of (row, col) cells where the barcode has been decoded. """
+        if self.aggregated_grid is None:
+            return set()
+        return {(row, col)
+                for row, barcodes_row in enumerate(self.aggregated_grid)
+                for col, barcode in enumerate(barcodes_row)
+                if barcode is not None}
+
+    @property
+    def is_complete(self):
+        """ Return True if all cells are either decoded or classified as empty wells (in the latest frame). """
+        if self.aggregated_grid is None:
+            return False
+        status = self.aggregated_status
+        return all(
+            barcode is not None or (status is not None and status[row][col] == CELL_EMPTY)
+            for row, barcodes_row in enumerate(self.aggregated_grid)
+            for col, barcode in enumerate(barcodes_row)
+        )
+
+    @property
+    def is_done(self):
+        """ Return True if the grid is complete, has been stable for `stable_frames` frames,
+        or `max_frames` frames have been scanned. """
+        return (
+            self.is_complete
+            or (self.stable_frames and self.stable_frames_count >= self.stable_frames)
+            or (self.max_frames is not None and self.frames_scanned >= self.max_frames)
+        )
+
+    def add_frame(self, image, prior=None):
+        """ Scan a single frame, only decoding cells that are still unknown, and merge the result.
+
+        Args:
+            image: The frame (box image).
+            prior: Optional barcode positions from the previous scan of the box, see `BoxScanner.scan_box_image()`.
+                OBS: With a prior, the frame is scanned with `scan_box_grid_with_prior()`, which doesn't skip
+                the cells that are already known.
+
+        Returns:
+            The number of new barcodes found in this frame.
+        """
+        scan_result = self.scan_box_image(image, skip_cells=self.known_cells, prior=prior)
+        self.frames_scanned += 1
+        if scan_result.cell_status is not None:
+            self.aggregated_status = scan_result.cell_status
+        if self.aggregated_grid is None:
+            self.aggregated_grid = [list(row) for row in scan_result.barcodes]
+            n_new = count_barcodes(self.aggregated_grid)
+        else:
+            n_new = 0
+            for row, barcodes_row in enumerate(scan_result.barcodes):
+                for col, barcode in enumerate(barcodes_row):
+                    if barcode is not None and self.aggregated_grid[row][col] is None:
+                        self.aggregated_grid[row][col] = barcode
+                        n_new += 1
+        self.stable_frames_count = 0 if n_new else self.stable_frames_count + 1
+        return n_new
+
+    def scan_frames(self, frames):
+        """ Scan frames (e.g. from a camera) until the aggregated grid is done, see `is_done`.
+
+        Args:
+            frames: Iterable of images. The iterable is only consumed until scanning is done.
+
+        Returns:
+            The aggregated grid of barcodes (list of lists).
+        """
+        self.reset()
+        for image in frames:
+            self.add_frame(image)
+            if self.is_done:
+                break
+        return self.get_aggregated_grid()
+
+    def get_aggregated_grid(self):
+        """ Return a copy of the aggregated grid of barcodes. """
+        return None if self.aggregated_grid is None else [list(row) for row in self.aggregated_grid]
+
+    def scan_box_image_grid(self, image, prior=None):
+        """ Add a single frame to the aggregated grid and return the aggregated grid.
+        See `add_frame()` for the optional `prior`.
+        OBS: Use `reset()` before scanning a new box. """
+        self.add_frame(image, prior=prior)
+        grid_barcodes = self.get_aggregated_grid()
+        self.last_box_scan = grid_barcodes
+        self.best_box_scan = grid_barcodes
+        return grid_barcodes
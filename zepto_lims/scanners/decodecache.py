@@ -0,0 +1,60 @@
+# Copyright 2019, Rasmus Sorensen <rasmusscholer@gmail.com>
+"""
+
+Module with a content-addressed cache for barcode decode results.
+
+When the same box is re-scanned, or several frames of a box are captured without anything moving,
+most of the grid cells contain exactly the same pixels as last time.
+Instead of running the (slow) decoder again, we look up the result using a fast hash of the
+cell's pixel buffer plus the decode arguments.
+
+Hashing uses `xxhash` if it is installed, otherwise `hashlib.blake2b` from the standard library.
+
+"""
+
+import hashlib
+import numpy as np
+
+from zepto_lims.utils.lrucache import LRUCache
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+    def _digest(buffer):
+        return hashlib.blake2b(buffer, digest_size=16).digest()
+else:
+    def _digest(buffer):
+        return xxhash.xxh3_128_digest(buffer)
+
+
+def cell_hash(image):
+    """ Return a hash of the image pixel buffer, including its shape and dtype.
+
+    Args:
+        image: numpy array (e.g. a grid cell view). Non-contiguous views are copied before hashing.
+
+    Returns:
+        A hashable key (tuple) identifying the image content.
+    """
+    image = np.ascontiguousarray(image)
+    return image.shape, image.dtype.str, _digest(image)
+
+
+def decode_args_key(decode_args):
+    """ Return a hashable key for a dict of decode arguments (e.g. a decode-ladder rung). """
+    # Values may be un-hashable (e.g. lists from a YAML config), so we just use the repr:
+    return repr(sorted(decode_args.items()))
+
+
+class DecodeCache(LRUCache):
+    """ Size-bounded LRU cache of decode results (see `utils.lrucache.LRUCache`).
+
+    Keys are typically `(cell_hash(image), decode_args_key(rung))` tuples.
+    Values can be None (for cells where no barcode was found),
+    so use `lookup()` to distinguish between a cached None and a cache miss.
+    """
+
+    def __init__(self, maxsize=1024):
+        super().__init__(maxsize=maxsize)
@@ -12,6 +12,7 @@ libdmtx:
     * https://github.com/dmtx/dmtx-wrappers
     * https://github.com/dmtx/dmtx-wrappers/tree/master/python - "pydmtx".
 * http://libdmtx.wikidot.com/libdmtx-python-wrapper
+* https://github.com/zxing-cpp/zxing-cpp - ZXing-C++, with python bindings ("zxing-cpp" package).
 
 
 
@@ -22,19 +23,240 @@ call signature for pylibdmtx.pylibdmtx.decode():
            corrections=None, max_count=None
 
 
+Decoder backends:
+------------------
 
+The actual decoding is done by a "decoder backend". Backends are registered in `DECODER_BACKENDS`
+(or using `register_decoder_backend()`) as a loader function, which imports the backend's library
+and returns a `decode(image, **decode_kwargs)` function. Backends are only loaded when first used,
+so uninstalled backends don't prevent the module from being imported.
+
+Available backends:
+
+* 'pylibdmtx' - libdmtx via pylibdmtx (default). Supports all the libdmtx `decode()` arguments.
+* 'zxingcpp' - ZXing-C++ via the `zxing-cpp` package. Only `max_count` is used; the libdmtx-specific
+    arguments (`timeout`, `shrink`, `min_edge`, etc.) are ignored.
+
+The backend is given as the `backend` keyword argument to the decode functions, e.g. as part of a
+decode-ladder rung (which is also how `BoxScanner` applies its configured backend, so the setting is
+per scanner, and is sent along to decode worker processes). Otherwise, `DEFAULT_DECODER_BACKEND` is used.
+A backend can also be a sequence of backend names, which is used as a *fallback chain*:
+the next backend is only tried if the previous one didn't decode any barcodes.
+`select_decoder_backend()` can be used at startup to pick the fastest backend that correctly decodes
+a reference cell image.
 
 """
 
+from collections import namedtuple
+import time
+import numpy as np
+
+
+# Decode results from all backends have the same form as `pylibdmtx.pylibdmtx.Decoded`,
+# with `rect` using libdmtx's coordinate system with origin in the BOTTOM left corner.
+Decoded = namedtuple('Decoded', 'data rect')
+Rect = namedtuple('Rect', 'left top width height')
+
+
+def load_pylibdmtx():
+    from pylibdmtx.pylibdmtx import decode
+    return decode
+
+
+def load_zxingcpp():
+    import zxingcpp
+
+    def decode(image, max_count=None, **decode_kwargs):
+        # Cell images are usually non-contiguous views into the box image:
+        image = np.ascontiguousarray(image)
+        height = image.shape[0]
+        results = []
+        for barcode in zxingcpp.read_barcodes(image, formats=zxingcpp.BarcodeFormat.DataMatrix):
+            corners = (barcode.position.top_left, barcode.position.top_right,
+                       barcode.position.bottom_right, barcode.position.bottom_left)
+            xs, ys = [point.x for point in corners], [point.y for point in corners]
+            rect = Rect(min(xs), height - max(ys), max(xs) - min(xs), max(ys) - min(ys))
+            results.append(Decoded(bytes(barcode.bytes), rect))
+            if max_count and len(results) >= max_count:
+                break
+        return results
+    return decode
+
+
+# Registered decoder backends: {name: loader function}.
+DECODER_BACKENDS = {
+    'pylibdmtx': load_pylibdmtx,
+    'zxingcpp': load_zxingcpp,
+}
+
+# The backend (or fallback chain of backends) used when no backend is specified:
+DEFAULT_DECODER_BACKEND = 'pylibdmtx'
+
+_loaded_backends = {}
+
+
+# The default "decode ladder": a sequence of increasingly expensive decode attempts ("rungs").
+# Each rung is a dict of keyword arguments for `decode()`, plus the optional special key
+# `edge_limits`, which is a (min, max) tuple with the expected symbol edge length
+# as a fraction of the image (cell) size (see `decode_kwargs_for_rung()`).
+# Only the cells that failed on one rung are attempted on the next.
+# Every rung has a timeout (ms), so the time spent on a single cell is bounded.
+DEFAULT_DECODE_LADDER = (
+    # Rung 0: Cheap first pass - half resolution, stop after the first symbol, short timeout (ms),
+    # and only look for symbols of roughly the expected size (a tube lid barcode fills most of the cell).
+    {'shrink': 2, 'max_count': 1, 'timeout': 50, 'edge_limits': (0.25, 1.0)},
+    # Rung 1: Full resolution, still restricted to the expected symbol size.
+    {'shrink': 1, 'max_count': 1, 'timeout': 250, 'edge_limits': (0.25, 1.0)},
+    # Rung 2: Exhaustive search without any size hints. This rung also has a (longer) timeout,
+    # so an empty or undecodable well can never stall a scan, even without a scan time budget.
+    {'max_count': 1, 'timeout': 1000},
+)
+
+
+def decode_kwargs_for_rung(rung, image_shape, timeout=None):
+    """ Create the keyword arguments for `decode()` for a single decode-ladder rung.
+
+    Args:
+        rung: Dict with decode keyword arguments, and optionally `edge_limits`.
+        image_shape: The shape of the image (cell) being decoded, used to convert `edge_limits` to pixels.
+        timeout: Optional upper limit (in milliseconds) for the decode timeout,
+            e.g. the time remaining before an overall scan deadline.
+
+    Returns:
+        Dict with keyword arguments for `decode()`.
+    """
+    decode_kwargs = dict(rung)
+    edge_limits = decode_kwargs.pop('edge_limits', None)
+    if edge_limits is not None:
+        min_frac, max_frac = edge_limits
+        height, width = image_shape[:2]
+        # It is not entirely clear whether libdmtx compares edge lengths before or after shrinking,
+        # so we use the most permissive interpretation for both limits:
+        shrink = decode_kwargs.get('shrink') or 1
+        decode_kwargs['min_edge'] = int(min(height, width) * min_frac / shrink)
+        decode_kwargs['max_edge'] = int(max(height, width) * max_frac) + 1
+    if timeout is not None:
+        timeout = max(int(timeout), 1)  # decode() interprets timeout=0 as "no timeout".
+        if decode_kwargs.get('timeout') is None or decode_kwargs['timeout'] > timeout:
+            decode_kwargs['timeout'] = timeout
+    return decode_kwargs
+
+
+def register_decoder_backend(name, loader):
+    """ Register a decoder backend.
 
-from pylibdmtx.pylibdmtx import decode
+    Args:
+        name: The name of the backend.
+        loader: Function that imports the backend and returns a `decode(image, **decode_kwargs)` function,
+            which returns a list of `Decoded(data, rect)` namedtuples.
+            The loader should raise ImportError if the backend is not installed.
+    """
+    DECODER_BACKENDS[name] = loader
+    _loaded_backends.pop(name, None)
+
+
+def unregister_decoder_backend(name):
+    """ Remove a registered decoder backend (and its loaded decode function, if loaded). """
+    DECODER_BACKENDS.pop(name, None)
+    _loaded_backends.pop(name, None)
+
+
+def load_decoder_backend(name):
+    """ Return the decode function for the given backend, loading the backend on first use.
+
+    Raises:
+        ValueError, if the backend is not registered.
+        ImportError, if the backend is not installed.
+    """
+    try:
+        return _loaded_backends[name]
+    except KeyError:
+        pass
+    try:
+        loader = DECODER_BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"Unrecognized decoder backend '{name}'; must be one of {list(DECODER_BACKENDS)}.")
+    decode = _loaded_backends[name] = loader()
+    return decode
+
+
+def available_decoder_backends():
+    """ Return list with the names of all registered decoder backends that can be loaded. """
+    available = []
+    for name in DECODER_BACKENDS:
+        try:
+            load_decoder_backend(name)
+        except (ImportError, OSError):
+            continue
+        available.append(name)
+    return available
+
+
+def decode(image, backend=None, **decode_kwargs):
+    """ Decode barcodes in image using the given backend, or fallback chain of backends.
+
+    Args:
+        image: The image.
+        backend: Backend name, or sequence of backend names to try in order until one of them decodes
+            at least one barcode. Defaults to `DEFAULT_DECODER_BACKEND`.
+        **decode_kwargs: Keyword arguments passed to the backend's decode function.
+
+    Returns:
+        List of `Decoded(data, rect)` namedtuples.
+    """
+    if backend is None:
+        backend = DEFAULT_DECODER_BACKEND
+    if isinstance(backend, str):
+        return load_decoder_backend(backend)(image, **decode_kwargs)
+    results = []
+    for name in backend:
+        results = load_decoder_backend(name)(image, **decode_kwargs)
+        if results:
+            break
+    return results
+
+
+def select_decoder_backend(reference_image, expected, backends=None, repeats=3, **decode_kwargs):
+    """ Micro-benchmark decoder backends on a reference (cell) image, and return the fastest correct backend.
+
+    Args:
+        reference_image: Image with a single barcode, e.g. a single grid cell.
+        expected: The expected barcode data (str or bytes).
+        backends: The backends to try. Defaults to all available backends.
+        repeats: The number of times each backend decodes the image (the best time is used).
+        **decode_kwargs: Keyword arguments passed to the decode functions.
+
+    Returns:
+        Two-tuple of (backend_name, timings), where timings is a dict {backend: best time in seconds}
+        for all backends that decoded the reference image correctly.
+        backend_name is None if no backend decoded the reference image correctly.
+    """
+    if isinstance(expected, str):
+        expected = expected.encode('utf-8')
+    if backends is None:
+        backends = available_decoder_backends()
+    timings = {}
+    for name in backends:
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            results = decode(reference_image, backend=name, max_count=1, **decode_kwargs)
+            times.append(time.perf_counter() - start)
+            if not results or results[0].data != expected:
+                break
+        else:
+            timings[name] = min(times)
+    best = min(timings, key=timings.get) if timings else None
+    return best, timings
 
 
-def decode_barcodes_from_image(image):
+def decode_barcodes_from_image(image, **decode_kwargs):
     """ Returns a list of decoded barcodes (data and region) from *all* recognized barcodes in the image.
 
     Args:
         image:
+        **decode_kwargs: Keyword arguments passed to `decode()`, e.g. `timeout`, `shrink`, or `max_count`,
+            or `backend` to use a specific decoder backend (or fallback chain of backends).
 
     Returns:
         List of NamedTuples with (data, rect) values,
@@ -42,10 +264,10 @@ def decode_barcodes_from_image(image):
         and rect is a rectangle(left, top, width, height) indicating where the barcode was found.
 
     """
-    return decode(image)
+    return decode(image, **decode_kwargs)
 
 
-def decode_barcode_from_image(image, encoding='utf-8'):
+def decode_barcode_from_image(image, encoding='utf-8', **decode_kwargs):
     """ Returns the decoded barcode data from *the first* recognized barcode in the image.
     If 'binary_encoding' is provided, will decode the value to yield a string,
     otherwise returns a bytes.
@@ -53,6 +275,7 @@ def decode_barcode_from_image(image, encoding='utf-8'):
     Args:
         image:
         encoding: If given, decode the binary barcode to a text string.
+        **decode_kwargs: Keyword arguments passed to `decode()`, e.g. `timeout`, `shrink`, or `max_count`.
 
     Returns:
         A single string or bytes from form the first parsed barcode in the image.
@@ -69,7 +292,7 @@ def decode_barcode_from_image(image, encoding='utf-8'):
         >>> decode_barcode_from_image(image)
 
     """
-    barcode_data = next(iter(decode(image))).data
+    barcode_data = next(iter(decode(image, **decode_kwargs))).data
     if encoding:
         return barcode_data.decode(encoding)
     else:
@@ -0,0 +1,233 @@
+# Copyright 2019, Rasmus Sorensen <rasmusscholer@gmail.com>
+"""
+
+Module for automatically locating the box grid (box border and divider pitch) in a box image.
+
+The box dividers are thin lines at a regular pitch, which stand out in the row and column
+intensity projections of the image (the mean intensity of each row/column).
+For each axis we calculate a "line score" profile (how much darker, or lighter, each row/column is than
+its neighbourhood), and then search all (offset, pitch) combinations at once, using numpy broadcasting,
+for the regularly-spaced set of `n + 1` divider lines with the highest mean line score.
+
+To keep this cheap for large images, the search is first done on a sub-sampled image,
+and then refined at full resolution around the best coarse candidate.
+
+Since the camera and box holder are usually fixed, the located grid is cached per camera and box type
+(see `GridCalibrationCache`), and only re-located when a cheap validation check fails,
+e.g. because the camera has drifted.
+
+"""
+
+from collections import namedtuple
+import json
+from pathlib import Path
+import numpy as np
+
+
+# Grid parameters, as used by `boxscanner.segment_image_to_grid()`.
+GridParams = namedtuple('GridParams', 'top bottom left right grid_shape')
+
+# Coarse search is done on a sub-sampled image with at most this many pixels across:
+COARSE_MAX_SIZE = 800
+
+
+def moving_average(values, window):
+    """ Return the centred moving average of a 1D array (with edge-padding), same length as the input. """
+    window = max(int(window), 1)
+    padded = np.pad(values, (window // 2, window - 1 - window // 2), mode='edge')
+    cumsum = np.concatenate(([0], np.cumsum(padded)))
+    return (cumsum[window:] - cumsum[:-window]) / window
+
+
+def line_score_profile(image, axis, window, polarity='dark', smooth=1):
+    """ Calculate the "line score" profile of an image along one axis.
+
+    Args:
+        image: 2D grayscale image.
+        axis: 0 for the row profile (horizontal lines), 1 for the column profile (vertical lines).
+        window: Size of the neighbourhood (moving average) each row/column is compared to.
+        polarity: 'dark' if the box dividers are darker than their surroundings, 'light' if lighter.
+        smooth: Width of a moving average applied to the score, which makes the score more tolerant
+            to lines that are slightly off from the expected position (e.g. due to a non-integer pitch).
+
+    Returns:
+        1D numpy array with the line score for each row (axis=0) or column (axis=1).
+    """
+    profile = np.asarray(image, dtype=np.float32).mean(axis=1 - axis)
+    local_mean = moving_average(profile, window)
+    score = local_mean - profile if polarity == 'dark' else profile - local_mean
+    if smooth > 1:
+        score = moving_average(score, smooth)
+    return score
+
+
+def search_grid_lines(score, n_cells, pitches, offsets=None):
+    """ Find the offset and pitch of `n_cells + 1` regularly-spaced lines with the highest mean score.
+
+    All (pitch, offset) combinations are evaluated at once using numpy broadcasting.
+
+    Args:
+        score: 1D line score profile, see `line_score_profile()`.
+        n_cells: The number of grid cells along this axis.
+        pitches: 1D array of candidate pitches (may be non-integer).
+        offsets: 1D array of candidate offsets. Defaults to all integer offsets.
+
+    Returns:
+        Three-tuple of (offset, pitch, mean_score) for the best candidate.
+    """
+    length = len(score)
+    pitches = np.asarray(pitches, dtype=np.float64)
+    offsets = np.arange(length) if offsets is None else np.asarray(offsets)
+    k = np.arange(n_cells + 1)
+    # positions has shape (n_pitches, n_offsets, n_cells + 1):
+    positions = np.rint(offsets[None, :, None] + pitches[:, None, None] * k[None, None, :]).astype(int)
+    valid = (positions[..., 0] >= 0) & (positions[..., -1] < length)
+    line_scores = score[np.clip(positions, 0, length - 1)].mean(axis=2)
+    line_scores[~valid] = -np.inf
+    pitch_idx, offset_idx = np.unravel_index(np.argmax(line_scores), line_scores.shape)
+    return int(offsets[offset_idx]), float(pitches[pitch_idx]), float(line_scores[pitch_idx, offset_idx])
+
+
+def locate_grid_axis(image, axis, n_cells, min_box_fraction=0.5, polarity='dark'):
+    """ Locate the grid along one axis, returning (start, end).
+
+    Args:
+        image: 2D grayscale image.
+        axis: 0 to locate the rows (top/bottom), 1 to locate the columns (left/right).
+        n_cells: The number of grid cells along this axis.
+        min_box_fraction: The minimum size of the box, as a fraction of the image size.
+        polarity: 'dark' or 'light' box dividers, see `line_score_profile()`.
+
+    Returns:
+        Two-tuple of (start, end), the pixel positions of the first and last divider lines.
+    """
+    length = image.shape[axis]
+    # Coarse search on sub-sampled image:
+    step = max(1, int(np.ceil(max(image.shape[:2]) / COARSE_MAX_SIZE)))
+    coarse = image[::step, ::step]
+    coarse_length = coarse.shape[axis]
+    max_pitch = coarse_length / n_cells
+    window = max_pitch / 2
+    coarse_score = line_score_profile(coarse, axis=axis, window=window, polarity=polarity, smooth=max_pitch / 10)
+    pitches = np.arange(max(1, int(max_pitch * min_box_fraction)), int(max_pitch) + 1, 0.5)
+    offset, pitch, _ = search_grid_lines(coarse_score, n_cells, pitches)
+    # Refine at full resolution, around the coarse candidate:
+    score = line_score_profile(image, axis=axis, window=window * step, polarity=polarity, smooth=step)
+    pitches = np.arange(max(1, (pitch - 1) * step), (pitch + 1) * step + 0.25, 0.25)
+    offsets = np.arange(max(0, (offset - 1) * step), min(length, (offset + 1) * step + 1))
+    offset, pitch, _ = search_grid_lines(score, n_cells, pitches, offsets)
+    return offset, int(round(offset + pitch * n_cells))
+
+
+def grid_line_score(score, start, end, n_cells):
+    """ Return the normalized mean line score for `n_cells + 1` lines evenly spaced between start and end.
+    The score is normalized by the mean absolute line score, so it doesn't depend on image contrast.
+    """
+    positions = np.rint(np.linspace(start, end, n_cells + 1)).astype(int).clip(0, len(score) - 1)
+    return float(score[positions].mean() / (np.abs(score).mean() + 1e-6))
+
+
+def locate_box_grid(image, grid_shape=(10, 10), min_box_fraction=0.5, polarity='dark'):
+    """ Locate the box grid in an image.
+
+    Args:
+        image: 2D grayscale image.
+        grid_shape: (nrows, ncols) tuple, or an integer for a square grid.
+        min_box_fraction: The minimum size of the box, as a fraction of the image size.
+        polarity: 'dark' or 'light' box dividers, see `line_score_profile()`.
+
+    Returns:
+        Two-tuple of (grid_params, score), where `grid_params` is a GridParams namedtuple
+        with absolute pixel coordinates, and score is the grid score (see `box_grid_score()`),
+        which can be used to validate the grid in later images, see `validate_box_grid()`.
+    """
+    if isinstance(grid_shape, int):
+        grid_shape = (grid_shape, grid_shape)
+    image = np.asarray(image)
+    nrows, ncols = grid_shape
+    top, bottom = locate_grid_axis(image, 0, nrows, min_box_fraction, polarity)
+    left, right = locate_grid_axis(image, 1, ncols, min_box_fraction, polarity)
+    grid_params = GridParams(top, bottom, left, right, tuple(grid_shape))
+    return grid_params, box_grid_score(image, grid_params, polarity)
+
+
+def box_grid_score(image, grid_params, polarity='dark'):
+    """ Return the lowest of the row and column normalized line scores at the expected divider positions.
+
+    The score is calculated on the sub-sampled image, so it is cheap enough to calculate for every image.
+
+    Args:
+        image: 2D grayscale image.
+        grid_params: GridParams with absolute pixel coordinates, e.g. from `locate_box_grid()`.
+        polarity: 'dark' or 'light' box dividers.
+
+    Returns:
+        The grid score (float).
+    """
+    image = np.asarray(image)
+    top, bottom, left, right, (nrows, ncols) = grid_params
+    # Validate on the sub-sampled image, which is much faster and good enough for a sanity check:
+    step = max(1, int(np.ceil(max(image.shape[:2]) / COARSE_MAX_SIZE)))
+    coarse = image[::step, ::step]
+    scores = []
+    for axis, start, end, n_cells in ((0, top, bottom, nrows), (1, left, right, ncols)):
+        start, end = int(round(start / step)), int(round(end / step))
+        score = line_score_profile(coarse, axis=axis, window=(end - start) / n_cells / 2, polarity=polarity)
+        scores.append(grid_line_score(score, start, end, n_cells))
+    return min(scores)
+
+
+def validate_box_grid(image, grid_params, min_score, polarity='dark'):
+    """ Cheap check whether the grid params still match the box dividers in the image.
+
+    Args:
+        image: 2D grayscale image.
+        grid_params: GridParams with absolute pixel coordinates, e.g. from `locate_box_grid()`.
+        min_score: The minimum grid score, typically a fraction of the score
+            obtained when the grid was located.
+        polarity: 'dark' or 'light' box dividers.
+
+    Returns:
+        True if the grid score (see `box_grid_score()`) is at least `min_score`.
+    """
+    return box_grid_score(image, grid_params, polarity) >= min_score
+
+
+class GridCalibrationCache:
+    """ Cache of located box grids, per camera and box type.
+
+    If `filepath` is given, the cache is persisted to a JSON file, so the grid doesn't have to be
+    re-located every time the app is started.
+    """
+
+    def __init__(self, filepath=None):
+        self.filepath = Path(filepath) if filepath else None
+        self.calibrations = {}
+        if self.filepath is not None and self.filepath.exists():
+            self.load()
+
+    @staticmethod
+    def key(camera_id, box_type):
+        return f"{camera_id}/{box_type}"
+
+    def get(self, camera_id, box_type):
+        """ Return (grid_params, score) tuple for the given camera and box type, or None. """
+        try:
+            (top, bottom, left, right, grid_shape), score = self.calibrations[self.key(camera_id, box_type)]
+        except KeyError:
+            return None
+        return GridParams(top, bottom, left, right, tuple(grid_shape)), score
+
+    def set(self, camera_id, box_type, grid_params, score):
+        self.calibrations[self.key(camera_id, box_type)] = (tuple(grid_params), score)
+        if self.filepath is not None:
+            self.save()
+
+    def load(self):
+        with open(self.filepath) as fp:
+            self.calibrations = json.load(fp)
+
+    def save(self):
+        self.filepath.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.filepath, 'w') as fp:
+            json.dump(self.calibrations, fp, indent=2)
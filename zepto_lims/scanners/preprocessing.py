@@ -0,0 +1,270 @@
+# Copyright 2019, Rasmus Sorensen <rasmusscholer@gmail.com>
+"""
+
+Module for pre-processing box/cell images before decoding.
+
+As can be seen from the example images (e.g. `*-up4x-gb3-q90.jpg`, `*_25pct-*`),
+upscaling, blurring, and downscaling strongly affect whether libdmtx is able to decode a barcode,
+and how long it takes.
+
+A pre-processing "chain" is a declarative list of steps, e.g. from the config:
+
+    boxscanner_preprocessing:
+      - grayscale
+      - [resize, {scale: 0.5}]
+      - {step: gaussian_blur, ksize: 3}
+
+Each step is either just the step name (using the default parameters), a (name, params) two-tuple,
+or a dict with a 'step' item plus parameters. Available steps are listed in `PREPROCESSING_STEPS`.
+
+The chain can be applied either to the whole (cropped) box image ('image'), or to each cell ('cell'),
+see `boxscanner.scan_box_grid()`.
+
+`benchmark_preprocessing_chains()` runs a set of candidate chains over a folder of sample images,
+and `select_preprocessing_chain()` picks the fastest chain that still decodes as many barcodes as
+the best chain. This can also be run from the command line:
+
+    python -m zepto_lims.scanners.preprocessing <image_folder> --grid 10x10 --margin 10,-10,10,-10
+
+
+"""
+
+import json
+import time
+from pathlib import Path
+import click
+import numpy as np
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+
+# Where the pre-processing chain can be applied:
+PREPROCESSING_TARGETS = ('image', 'cell')
+
+# Candidate chains used by `select_preprocessing_chain()` if no candidates are given:
+DEFAULT_CANDIDATE_CHAINS = (
+    (),
+    ('grayscale',),
+    (('resize', {'scale': 0.5}),),
+    (('resize', {'scale': 0.5}), ('gaussian_blur', {'ksize': 3})),
+    (('gaussian_blur', {'ksize': 3}),),
+    ('sharpen',),
+    (('resize', {'scale': 2.0}), ('gaussian_blur', {'ksize': 3})),
+    ('adaptive_threshold',),
+)
+
+
+def _require_cv2(step):
+    if cv2 is None:
+        raise ImportError(f"Pre-processing step '{step}' requires OpenCV (cv2), which could not be imported.")
+
+
+def grayscale(image):
+    """ Convert a color (BGR/BGRA) image to grayscale. Grayscale images are returned as-is. """
+    image = np.asarray(image)
+    if image.ndim == 2:
+        return image
+    if cv2 is not None:
+        code = cv2.COLOR_BGRA2GRAY if image.shape[2] == 4 else cv2.COLOR_BGR2GRAY
+        return cv2.cvtColor(image, code)
+    # Same luminance weights as OpenCV, for BGR channel order:
+    return (image[..., :3] @ np.array([0.114, 0.587, 0.299])).astype(image.dtype)
+
+
+def resize(image, scale=None, size=None, interpolation=None):
+    """ Resize image, either by a `scale` factor or to a fixed (width, height) `size`.
+
+    Interpolation defaults to INTER_AREA when downscaling (best quality) and INTER_LINEAR when upscaling.
+    """
+    _require_cv2('resize')
+    image = np.asarray(image)
+    if size is None:
+        if scale is None or scale == 1:
+            return image
+        height, width = image.shape[:2]
+        size = (max(1, int(round(width * scale))), max(1, int(round(height * scale))))
+    if interpolation is None:
+        interpolation = cv2.INTER_AREA if size[0] < image.shape[1] else cv2.INTER_LINEAR
+    elif isinstance(interpolation, str):
+        interpolation = getattr(cv2, 'INTER_' + interpolation.upper())
+    return cv2.resize(image, tuple(size), interpolation=interpolation)
+
+
+def gaussian_blur(image, ksize=3, sigma=0):
+    """ Blur image with a (ksize × ksize) Gaussian kernel (ksize must be odd). """
+    _require_cv2('gaussian_blur')
+    return cv2.GaussianBlur(np.asarray(image), (ksize, ksize), sigma)
+
+
+def adaptive_threshold(image, block_size=31, C=5, method='gaussian'):
+    """ Binarize (grayscale) image by comparing each pixel to the mean of its (block_size × block_size)
+    neighbourhood, which removes uneven illumination. """
+    _require_cv2('adaptive_threshold')
+    method = cv2.ADAPTIVE_THRESH_GAUSSIAN_C if method == 'gaussian' else cv2.ADAPTIVE_THRESH_MEAN_C
+    return cv2.adaptiveThreshold(np.asarray(image), 255, method, cv2.THRESH_BINARY, block_size, C)
+
+
+def sharpen(image, amount=1.0, ksize=5, sigma=0):
+    """ Sharpen image by unsharp masking: image + amount * (image - blurred). """
+    _require_cv2('sharpen')
+    image = np.asarray(image)
+    blurred = cv2.GaussianBlur(image, (ksize, ksize), sigma)
+    return cv2.addWeighted(image, 1 + amount, blurred, -amount, 0)
+
+
+PREPROCESSING_STEPS = {
+    'grayscale': grayscale,
+    'resize': resize,
+    'gaussian_blur': gaussian_blur,
+    'adaptive_threshold': adaptive_threshold,
+    'sharpen': sharpen,
+}
+
+
+def parse_step(step):
+    """ Parse a single pre-processing step specification, returning a (name, params) two-tuple. """
+    if isinstance(step, str):
+        name, params = step, {}
+    elif isinstance(step, dict):
+        params = dict(step)
+        name = params.pop('step')
+    else:
+        name, params = step
+        params = dict(params or {})
+    if name not in PREPROCESSING_STEPS:
+        raise ValueError(f"Unrecognized pre-processing step '{name}'; must be one of {list(PREPROCESSING_STEPS)}.")
+    return name, params
+
+
+def build_pipeline(chain):
+    """ Build a pre-processing function from a declarative chain of steps.
+
+    Args:
+        chain: Sequence of pre-processing steps, see module docstring.
+
+    Returns:
+        Function that takes an image and returns the pre-processed image,
+        or None if the chain is empty (no pre-processing).
+    """
+    steps = [parse_step(step) for step in (chain or ())]
+    if not steps:
+        return None
+    funcs = [(PREPROCESSING_STEPS[name], params) for name, params in steps]
+
+    def pipeline(image):
+        for func, params in funcs:
+            image = func(image, **params)
+        return image
+    pipeline.chain = steps
+    return pipeline
+
+
+def preprocess_image(image, chain):
+    """ Apply a chain of pre-processing steps to a single image. """
+    pipeline = build_pipeline(chain)
+    return image if pipeline is None else pipeline(image)
+
+
+def chain_name(chain):
+    """ Return a short, human-readable name for a pre-processing chain, e.g. 'resize(scale=0.5)+sharpen'. """
+    steps = [parse_step(step) for step in (chain or ())]
+    if not steps:
+        return 'none'
+    return '+'.join(
+        name + ('(' + ','.join(f"{k}={v}" for k, v in sorted(params.items())) + ')' if params else '')
+        for name, params in steps
+    )
+
+
+def benchmark_preprocessing_chains(images, chains=None, grid_params=None, target='cell', repeats=1, **scan_kwargs):
+    """ Scan a set of sample images with each candidate pre-processing chain.
+
+    Args:
+        images: Sequence of images, or image file paths.
+        chains: Sequence of candidate pre-processing chains. Defaults to `DEFAULT_CANDIDATE_CHAINS`.
+        grid_params: Grid parameters, see `boxscanner.segment_image_to_grid()`.
+        target: Apply the chains to the whole box 'image' or to each 'cell'.
+        repeats: Number of times each image is scanned with each chain (the best time is used).
+        **scan_kwargs: Additional keyword arguments passed to `boxscanner.scan_box_grid()`.
+
+    Returns:
+        List of dicts, one for each chain, with items 'chain', 'name', 'barcodes' (the total number of
+        decoded barcodes over all images), and 'time' (total scan time over all images, in seconds).
+    """
+    from .boxscanner import scan_box_grid, count_barcodes
+    from zepto_lims.utils.image import imread
+    if chains is None:
+        chains = DEFAULT_CANDIDATE_CHAINS
+    images = [imread(image) if isinstance(image, (str, Path)) else image for image in images]
+    results = []
+    for chain in chains:
+        n_barcodes, total_time = 0, 0.0
+        for image in images:
+            times = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                scan_result = scan_box_grid(
+                    image, grid_params=grid_params, preprocessing=chain, preprocessing_target=target, **scan_kwargs)
+                times.append(time.perf_counter() - start)
+            n_barcodes += count_barcodes(scan_result.barcodes)
+            total_time += min(times)
+        results.append({'chain': chain, 'name': chain_name(chain), 'barcodes': n_barcodes, 'time': total_time})
+    return results
+
+
+def select_preprocessing_chain(results, min_barcodes=None):
+    """ Select the fastest pre-processing chain that reaches the full decode rate.
+
+    Args:
+        results: List of benchmark results, from `benchmark_preprocessing_chains()`.
+        min_barcodes: The number of barcodes that must be decoded.
+            Defaults to the highest number of barcodes decoded by any of the chains (at least one).
+
+    Returns:
+        The result dict for the selected chain, or None if no chain decoded `min_barcodes`.
+    """
+    if not results:
+        return None
+    if min_barcodes is None:
+        min_barcodes = max(1, max(result['barcodes'] for result in results))
+    candidates = [result for result in results if result['barcodes'] >= min_barcodes]
+    return min(candidates, key=lambda result: result['time']) if candidates else None
+
+
+@click.command()
+@click.argument('image_folder', type=click.Path(exists=True, file_okay=False))
+@click.option('--pattern', default='*.jpg', show_default=True, help="Glob pattern for the sample images.")
+@click.option('--grid', default='10x10', show_default=True, help="Box grid shape, e.g. 10x10.")
+@click.option('--margin', default='10,-10,10,-10', show_default=True, help="Box margin: top,bottom,left,right.")
+@click.option('--target', default='cell', show_default=True, type=click.Choice(PREPROCESSING_TARGETS))
+@click.option('--chains', type=click.Path(exists=True, dir_okay=False),
+              help="JSON file with a list of candidate chains.")
+@click.option('--repeats', type=int, default=1, show_default=True)
+def main(image_folder, pattern, grid, margin, target, chains, repeats):
+    """ Command line tool to pick the fastest pre-processing chain for a folder of sample images. """
+    image_files = sorted(Path(image_folder).glob(pattern))
+    grid_shape = tuple(int(n) for n in grid.lower().split('x'))
+    margin = tuple(float(v) if '.' in v else int(v) for v in margin.split(','))
+    if chains:
+        with open(chains) as fp:
+            chains = json.load(fp)
+    print(f"Benchmarking pre-processing chains on {len(image_files)} images in {image_folder}...")
+    results = benchmark_preprocessing_chains(
+        image_files, chains=chains, grid_params=margin + (grid_shape,), target=target, repeats=repeats)
+    for result in sorted(results, key=lambda result: result['time']):
+        print(f"{result['time']:8.3f} s  {result['barcodes']:5} barcodes  {result['name']}")
+    best = select_preprocessing_chain(results)
+    if best is None:
+        print(f"\nNo chain reached the full decode rate: No barcodes were decoded from the "
+              f"{len(image_files)} images matching '{pattern}'.")
+        return None
+    print(f"\nFastest chain with full decode rate: {best['name']}")
+    print(json.dumps([step if isinstance(step, str) else list(step) for step in best['chain']]))
+    return best
+
+
+if __name__ == '__main__':
+    main()
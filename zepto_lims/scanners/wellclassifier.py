@@ -0,0 +1,98 @@
+# Copyright 2019, Rasmus Sorensen <rasmusscholer@gmail.com>
+"""
+
+Module for classifying box grid cells (wells) as empty or containing a tube, *before* decoding.
+
+libdmtx spends the longest time on cells where it fails to find a barcode, and most of those
+are empty wells. Classifying all cells at once, using a few cheap image statistics,
+allows the box scanner to only run the decoder on cells that are not empty.
+
+The statistics are computed for all cells at once on a 4D (nrows, ncols, height, width) view of the
+box image, see `boxscanner.segment_image_to_grid_array()`:
+
+* std - the standard deviation of the pixel intensities. Empty wells are mostly uniform.
+* edge_density - the fraction of neighbouring pixels with an intensity difference above `edge_threshold`.
+    Cells are subsampled to approximately `edge_sample_size` pixels across before calculating
+    the edge density, so the value does not depend on the image resolution (or on up-scaling/blurring).
+* dark_ratio - the fraction of pixels darker than `dark_factor` times the cell's mean intensity
+    (the dark modules of a barcode).
+
+The default thresholds were checked against the images in `examples/example_data/images`,
+where all barcode images have an edge_density of 0.05 or more,
+while blank label/background regions have an edge_density below 0.005.
+
+"""
+
+import numpy as np
+
+
+CELL_EMPTY = 'empty'
+CELL_TUBE = 'tube'
+CELL_UNCERTAIN = 'uncertain'
+
+DEFAULT_EMPTY_WELL_THRESHOLDS = {
+    # Parameters for calculating the statistics:
+    'edge_threshold': 40,  # Intensity difference (gray levels) between neighbouring pixels counted as an edge.
+    'edge_sample_size': 32,  # Cells are subsampled to approximately this size for the edge density.
+    'dark_factor': 0.6,  # Pixels darker than this fraction of the cell mean are counted as dark.
+    # A cell is empty if either its std or its edge density is below these values:
+    'empty_max_std': 10.0,
+    'empty_max_edge_density': 0.01,
+    # A cell likely contains a tube (barcode) if both edge density and dark ratio are within these limits:
+    'tube_min_edge_density': 0.04,
+    'tube_min_dark_ratio': 0.02,
+    'tube_max_dark_ratio': 0.5,
+}
+
+
+def calc_cell_stats(cells, edge_threshold=40, edge_sample_size=32, dark_factor=0.6):
+    """ Calculate cheap image statistics for all grid cells at once.
+
+    Args:
+        cells: 4D numpy array with shape (nrows, ncols, cell_height, cell_width),
+            e.g. from `boxscanner.segment_image_to_grid_array()`.
+        edge_threshold: Minimum intensity difference between neighbouring pixels to count as an edge.
+        edge_sample_size: Subsample cells to approximately this number of pixels across
+            before calculating the edge density.
+        dark_factor: Pixels darker than `dark_factor` times the cell mean are counted as dark.
+
+    Returns:
+        Three-tuple of (std, edge_density, dark_ratio), each a (nrows, ncols) numpy array.
+    """
+    cell_height, cell_width = cells.shape[2:4]
+    step = max(1, min(cell_height, cell_width) // edge_sample_size)
+    # Subsampling with a step is just a strided view; only the small subsampled cells are copied:
+    sampled = cells[:, :, ::step, ::step].astype(np.float32)
+    std = sampled.std(axis=(2, 3))
+    edges_x = np.abs(np.diff(sampled, axis=3)) > edge_threshold
+    edges_y = np.abs(np.diff(sampled, axis=2)) > edge_threshold
+    edge_density = (edges_x.mean(axis=(2, 3)) + edges_y.mean(axis=(2, 3))) / 2
+    mean = sampled.mean(axis=(2, 3), keepdims=True)
+    dark_ratio = (sampled < mean * dark_factor).mean(axis=(2, 3))
+    return std, edge_density, dark_ratio
+
+
+def classify_cells(cells, thresholds=None):
+    """ Classify all grid cells as empty, likely containing a tube, or uncertain.
+
+    Args:
+        cells: 4D numpy array with shape (nrows, ncols, cell_height, cell_width).
+        thresholds: Dict with thresholds, overriding the values in `DEFAULT_EMPTY_WELL_THRESHOLDS`.
+
+    Returns:
+        (nrows, ncols) numpy array with `CELL_EMPTY`, `CELL_TUBE`, or `CELL_UNCERTAIN` for each cell.
+    """
+    thresholds = dict(DEFAULT_EMPTY_WELL_THRESHOLDS, **(thresholds or {}))
+    std, edge_density, dark_ratio = calc_cell_stats(
+        cells,
+        edge_threshold=thresholds['edge_threshold'],
+        edge_sample_size=thresholds['edge_sample_size'],
+        dark_factor=thresholds['dark_factor'],
+    )
+    is_empty = (std < thresholds['empty_max_std']) | (edge_density < thresholds['empty_max_edge_density'])
+    is_tube = (
+        (edge_density >= thresholds['tube_min_edge_density'])
+        & (dark_ratio >= thresholds['tube_min_dark_ratio'])
+        & (dark_ratio <= thresholds['tube_max_dark_ratio'])
+    )
+    return np.where(is_empty, CELL_EMPTY, np.where(is_tube, CELL_TUBE, CELL_UNCERTAIN))
@@ -0,0 +1,171 @@
+# Copyright 2019, Rasmus Sorensen <rasmusscholer@gmail.com>
+"""
+
+Inverted index from tube barcode to box, used to identify which box was just scanned.
+
+Instead of grouping the whole tubes table by box and comparing the scanned barcodes against every
+box's barcode set (which is O(total number of tubes) for every scan), we look up the box of each
+scanned barcode and count the "votes" for each box. Only boxes that share at least one barcode with
+the scan are scored, so matching a scan takes time proportional to the number of scanned barcodes.
+
+The index is built once from the tubes table, and then kept up to date incrementally
+when tubes are moved (see `TubeTrackerDf.update_tubes_from_barcodes()`).
+
+The tubes table should have one row per barcode, but a barcode can occur in multiple rows (e.g. after
+a manual edit). All rows of such a barcode are tracked (see `get_rows()`), so that updates are applied
+to every row, and the barcode is in the box of its last row until it is moved.
+
+"""
+
+from collections import Counter
+import pandas as pd
+
+
+# Box similarity score = common + ADDED_WEIGHT * added + REMOVED_WEIGHT * removed
+ADDED_WEIGHT = -0.2
+REMOVED_WEIGHT = -0.1
+
+MATCH_COLUMNS = ('common', 'added', 'removed', 'similarity')
+
+
+class BarcodeBoxIndex:
+    """ Inverted index of {barcode: boxname}, with the barcodes in each box,
+    and (optionally) the row position of each barcode in the tubes table.
+
+    Args:
+        barcodes: Iterable of barcodes.
+        boxnames: The box of each barcode.
+        rows: Optional row position (in the tubes table) of each barcode.
+            If a barcode occurs more than once, `rows` has its last row, and `duplicate_rows` has all of them.
+    """
+
+    def __init__(self, barcodes=(), boxnames=(), rows=None):
+        self.box_of = dict(zip(barcodes, boxnames))
+        self.box_barcodes = {}
+        for barcode, boxname in self.box_of.items():
+            self.box_barcodes.setdefault(boxname, set()).add(barcode)
+        self.rows = {}
+        self.duplicate_rows = {}
+        if rows is not None:
+            for barcode, row in zip(barcodes, rows):
+                if barcode in self.rows:
+                    self.duplicate_rows.setdefault(barcode, [self.rows[barcode]]).append(row)
+                self.rows[barcode] = row
+
+    @classmethod
+    def from_tubes_df(cls, tubes_df):
+        """ Build index from a tubes table (DataFrame with `barcode` and `boxname` columns).
+        Row positions are for `tubes_df.iloc[]`. """
+        if 'barcode' not in tubes_df or 'boxname' not in tubes_df:
+            return cls()
+        return cls(tubes_df['barcode'].values, tubes_df['boxname'].values, rows=range(len(tubes_df)))
+
+    def __len__(self):
+        return len(self.box_of)
+
+    def __contains__(self, barcode):
+        return barcode in self.box_of
+
+    @property
+    def box_sizes(self):
+        """ Return dict with the number of barcodes in each box. """
+        return {boxname: len(barcodes) for boxname, barcodes in self.box_barcodes.items()}
+
+    def get_box(self, barcode):
+        """ Return the box of the given barcode, or None if the barcode is not in the index. """
+        return self.box_of.get(barcode)
+
+    def get_box_barcodes(self, boxname):
+        """ Return (a copy of) the set of barcodes in the given box. """
+        return set(self.box_barcodes.get(boxname, ()))
+
+    def get_rows(self, barcodes):
+        """ Return the tubes-table rows of the given barcodes, including all rows of duplicated barcodes.
+
+        Returns:
+            Two-tuple of (barcodes, rows) lists, where barcodes with multiple rows are repeated for each row.
+        """
+        if not self.duplicate_rows:
+            barcodes = list(barcodes)
+            return barcodes, [self.rows[barcode] for barcode in barcodes]
+        row_barcodes, rows = [], []
+        for barcode in barcodes:
+            barcode_rows = self.duplicate_rows.get(barcode, (self.rows[barcode],))
+            row_barcodes.extend([barcode] * len(barcode_rows))
+            rows.extend(barcode_rows)
+        return row_barcodes, rows
+
+    def move(self, barcode, boxname):
+        """ Move a barcode to the given box (adding the barcode to the index if needed). """
+        if barcode in self.box_of:
+            previous = self.box_of[barcode]
+            if previous == boxname:
+                return
+            self._discard(barcode, previous)
+        self.box_of[barcode] = boxname
+        self.box_barcodes.setdefault(boxname, set()).add(barcode)
+
+    def move_many(self, barcodes, boxname):
+        """ Move multiple barcodes to the given box. """
+        for barcode in barcodes:
+            self.move(barcode, boxname)
+
+    def add_rows(self, barcodes, boxname, start_row):
+        """ Add new barcodes to the given box, for rows appended to the tubes table starting at `start_row`. """
+        for row, barcode in enumerate(barcodes, start=start_row):
+            self.move(barcode, boxname)
+            self.rows[barcode] = row
+
+    def assign(self, barcodes, boxnames, rows=None):
+        """ Move each barcode to its own box, optionally also setting the row position of each barcode. """
+        for barcode, boxname in zip(barcodes, boxnames):
+            self.move(barcode, boxname)
+        if rows is not None:
+            self.rows.update(zip(barcodes, rows))
+
+    def remove(self, barcode):
+        """ Remove a barcode from the index. """
+        if barcode in self.box_of:
+            self._discard(barcode, self.box_of.pop(barcode))
+            self.rows.pop(barcode, None)
+            self.duplicate_rows.pop(barcode, None)
+
+    def _discard(self, barcode, boxname):
+        box_barcodes = self.box_barcodes[boxname]
+        box_barcodes.discard(barcode)
+        if not box_barcodes:
+            del self.box_barcodes[boxname]
+
+    def match_counts(self, barcodes_set):
+        """ Count the barcodes in common with each box that shares at least one barcode with the scan.
+
+        Returns:
+            Dict with {boxname: (common, added, removed)} counts, where `added` is the number of scanned
+            barcodes not in the box, and `removed` is the number of barcodes in the box not in the scan.
+        """
+        votes = Counter(self.box_of[barcode] for barcode in barcodes_set if barcode in self.box_of)
+        n_scanned = len(barcodes_set)
+        return {
+            boxname: (common, n_scanned - common, len(self.box_barcodes[boxname]) - common)
+            for boxname, common in votes.items()
+        }
+
+    def top_matches(self, barcodes_set, k=None):
+        """ Return the top-k best matching boxes for the scanned barcodes.
+
+        Args:
+            barcodes_set: The scanned barcodes.
+            k: The number of boxes to return. If None, all boxes sharing a barcode with the scan are returned.
+
+        Returns:
+            DataFrame indexed by boxname, with `common`, `added`, `removed`, and `similarity` columns,
+            sorted by similarity (best match first).
+        """
+        counts = self.match_counts(barcodes_set)
+        df = pd.DataFrame(
+            [(common, added, removed, common + ADDED_WEIGHT * added + REMOVED_WEIGHT * removed)
+             for common, added, removed in counts.values()],
+            columns=list(MATCH_COLUMNS), index=pd.Index(list(counts.keys()), dtype=object),
+        )
+        df = df.sort_values('similarity', ascending=False, kind='mergesort')
+        return df if k is None else df.head(k)
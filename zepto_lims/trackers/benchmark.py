@@ -0,0 +1,135 @@
+# Copyright 2019, Rasmus Sorensen <rasmusscholer@gmail.com>
+"""
+
+Benchmark for updating tube locations in a large tubes table.
+
+Creates a synthetic, in-memory tubes table (default: 1 million tubes in 10x10 boxes),
+and times `TubeTrackerDf.update_tubes_from_barcodes()` for box scans where a few tubes
+were removed, moved in from other boxes, or are brand-new.
+
+Command line usage:
+
+    python -m zepto_lims.trackers.benchmark --tubes 1000000 --scanned 100 --repeats 5
+
+The one-time cost of building the barcode index is reported separately (`index_build_ms`).
+Scans with brand-new tubes are timed separately (`update_with_new_ms`), since appending rows
+to a pandas DataFrame always copies the whole table.
+
+"""
+
+import contextlib
+import io
+import json
+import time
+import click
+import numpy as np
+import pandas as pd
+
+from zepto_lims.utils.gridpos import get_position_codec
+from .tubetracker import TubeTrackerDf
+
+
+def make_tubes_df(n_tubes, box_shape=(10, 10)):
+    """ Return a synthetic tubes table, with `n_tubes` tubes in full boxes of the given shape. """
+    box_size = box_shape[0] * box_shape[1]
+    tube_idx = np.arange(n_tubes)
+    rows, cols = np.divmod(tube_idx % box_size, box_shape[1])
+    return pd.DataFrame({
+        'boxname': pd.Series(tube_idx // box_size).map('box{:06}'.format),
+        'barcode': pd.Series(tube_idx).map('tube{:08}'.format),
+        'pos': get_position_codec(box_shape).encode(rows, cols),
+    })
+
+
+def make_tracker(tubes_df, boxes_df=None):
+    """ Return a TubeTrackerDf using the given (in-memory) tables. Nothing is written to disk. """
+    tracker = TubeTrackerDf({'username': 'benchmark', 'datastore_autoflush': False})
+    if boxes_df is None:
+        boxes_df = pd.DataFrame({'boxname': tubes_df['boxname'].unique()})
+    table_cache = tracker.data_client.datastore.table_cache
+    table_cache[tracker.tubes_table_name] = tubes_df
+    table_cache[tracker.boxes_table_name] = boxes_df
+    return tracker
+
+
+def make_box_scan(tracker, boxname, n_scanned=100, n_removed=5, n_moved_in=5, n_new=0, rng=None):
+    """ Return a simulated {barcode: pos} scan of a box, where some tubes were removed,
+    some were moved in from other boxes, and some are brand-new. """
+    rng = np.random.default_rng(rng)
+    val_pos = tracker.get_barcode_val_pos_for_box(boxname)
+    barcodes = list(val_pos)[:n_scanned]
+    keep = barcodes[:len(barcodes) - n_removed - n_moved_in - n_new]
+    scan = {barcode: val_pos[barcode] for barcode in keep}
+    free_positions = [val_pos[barcode] for barcode in barcodes[len(keep):]]
+    all_barcodes = tracker.get_tubes_data()['barcode'].values
+    moved_in = rng.choice(all_barcodes, n_moved_in, replace=False)
+    new = [f"new-{boxname}-{i}" for i in range(n_new)]
+    for barcode, pos in zip(list(moved_in) + new, free_positions):
+        scan[barcode] = pos
+    return scan
+
+
+def time_box_updates(tracker, boxnames, n_scanned=100, n_new=0, rng=None):
+    """ Return list of timings (in ms) for updating each box from a simulated scan. """
+    timings = []
+    for boxname in boxnames:
+        scan = make_box_scan(tracker, boxname, n_scanned=n_scanned, n_new=n_new, rng=rng)
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            tracker.update_tubes_from_barcodes(boxname, scan, create_box_if_nonexisting=False, flush=False)
+            timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def timing_summary(timings):
+    return {'min': min(timings), 'median': float(np.median(timings)), 'max': max(timings)}
+
+
+def benchmark_update_tubes(n_tubes=1_000_000, n_scanned=100, repeats=5, seed=0):
+    """ Time `update_tubes_from_barcodes()` for box scans against a tubes table with `n_tubes` tubes.
+
+    Two kinds of scans are timed:
+        `update_ms`                 Scans where some tubes were removed and some moved in from other boxes.
+        `update_with_new_ms`        Scans that also include brand-new tubes. Appending rows to a DataFrame
+                                    copies the table, so this includes one O(n_tubes) append.
+
+    Returns:
+        Dict with `n_tubes`, `n_scanned`, `index_build_ms`, and the (min, median, max) timings in ms.
+    """
+    rng = np.random.default_rng(seed)
+    tracker = make_tracker(make_tubes_df(n_tubes))
+    start = time.perf_counter()
+    tracker.get_barcode_index()
+    index_build_ms = (time.perf_counter() - start) * 1000
+    boxnames = rng.choice(tracker.get_boxes_data()['boxname'].values, 2 * repeats, replace=False)
+    return {
+        'n_tubes': n_tubes,
+        'n_scanned': n_scanned,
+        'index_build_ms': index_build_ms,
+        'update_ms': timing_summary(time_box_updates(tracker, boxnames[:repeats], n_scanned, n_new=0, rng=rng)),
+        'update_with_new_ms': timing_summary(
+            time_box_updates(tracker, boxnames[repeats:], n_scanned, n_new=5, rng=rng)),
+    }
+
+
+@click.command()
+@click.option('--tubes', type=int, default=1_000_000, show_default=True, help="Number of tubes in the tubes table.")
+@click.option('--scanned', type=int, default=100, show_default=True, help="Number of tubes in each box scan.")
+@click.option('--repeats', type=int, default=5, show_default=True)
+@click.option('--output', help="Write the benchmark results to this JSON file.")
+def main(tubes, scanned, repeats, output):
+    """ Benchmark updating a box scan against a large tubes table. """
+    results = benchmark_update_tubes(n_tubes=tubes, n_scanned=scanned, repeats=repeats)
+    print(f"Tubes table: {results['n_tubes']} tubes; box scans with {results['n_scanned']} tubes.")
+    print(f"Barcode index build (once): {results['index_build_ms']:.1f} ms")
+    for key, label in (('update_ms', "moved/removed tubes"), ('update_with_new_ms', "also new tubes")):
+        timings = results[key]
+        print(f"update_tubes_from_barcodes(), {label}: {timings['min']:.2f} ms (min), "
+              f"{timings['median']:.2f} ms (median), {timings['max']:.2f} ms (max)")
+    if output:
+        with open(output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+
+
+if __name__ == '__main__':
+    main()
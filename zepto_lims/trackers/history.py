@@ -0,0 +1,192 @@
+# Copyright 2019, Rasmus Sorensen <rasmusscholer@gmail.com>
+"""
+
+Point-in-time ("as-of") queries over the tube movement history.
+
+The tube movement events recorded by a journaling datastore (see `datastores.journal_csv_df_store`)
+are indexed into per-barcode and per-box timelines, each sorted by time. Questions like
+"where was tube X on date D" or "what did box Y contain last month" are then answered by
+bisecting a single (small) timeline, rather than by scanning the full history.
+
+Each event sets a tube's location, and also records where the tube was before the event, so:
+
+* A tube's location at time D is the new location of its last event at or before D.
+    If the tube has no events before D, it was at the *old* location of its first event after D.
+* A tube was in box Y at time D if its last Y-event (an event moving the tube into, out of, or within Y)
+    at or before D moved it into Y. If it has no Y-events before D, it was in Y if its first Y-event
+    after D moved it out of (or within) Y.
+
+Tubes without any events have not moved since journaling started, so their location is the current location.
+This is handled by `TubeTrackerDf.get_tube_location_at()` and `TubeTrackerDf.get_box_contents_at()`.
+
+"""
+
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+
+
+# Result of `TubeHistoryIndex.location_at()`:
+#   boxname, pos    The location of the tube.
+#   timestamp       When the tube was moved to the location, or None if the tube was there before the history starts.
+TubeLocation = namedtuple('TubeLocation', 'boxname pos timestamp')
+
+TIMELINE_COLUMNS = ('time', 'barcode', 'old_boxname', 'old_pos', 'new_boxname', 'new_pos', 'scan_id')
+
+
+def to_time(when):
+    """ Convert a datetime, date string, or pandas Timestamp to integer nanoseconds (as used by the timelines). """
+    return pd.Timestamp(when).value
+
+
+def events_to_columns(events):
+    """ Return dict with {column: array}, for events (DataFrame with journal columns), sorted by time. """
+    times = pd.to_datetime(events['timestamp']).values.astype('int64') if len(events) else np.zeros(0, 'int64')
+    order = np.argsort(times, kind='stable')
+    columns = {'time': times[order]}
+    for column in TIMELINE_COLUMNS[1:]:
+        values = events[column].values if column in events else np.full(len(events), '', dtype=object)
+        columns[column] = np.asarray(values, dtype=object)[order]
+    return columns
+
+
+class Timeline:
+    """ Events (as column arrays) sorted by time, for a single barcode or box. """
+
+    def __init__(self, columns):
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.columns['time'])
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    def bisect(self, when):
+        """ Return the number of events at or before time `when` (integer nanoseconds). """
+        return int(np.searchsorted(self.columns['time'], when, side='right'))
+
+    def extend(self, columns):
+        """ Append events (column arrays, all later than or at the same time as the existing events). """
+        self.columns = {key: np.concatenate([values, columns[key]]) for key, values in self.columns.items()}
+
+    def to_frame(self):
+        """ Return the timeline as DataFrame, with a `timestamp` column instead of the integer `time` column. """
+        df = pd.DataFrame({key: values for key, values in self.columns.items() if key != 'time'})
+        df.insert(0, 'timestamp', pd.to_datetime(self.columns['time']))
+        return df
+
+
+def group_timelines(columns, keys):
+    """ Split event columns into {key: Timeline}, grouping by `keys` (array with one key per event). """
+    if not len(keys):
+        return {}
+    indices = pd.Series(np.arange(len(keys))).groupby(keys, sort=False).indices
+    return {key: Timeline({name: values[idx] for name, values in columns.items()}) for key, idx in indices.items()}
+
+
+def box_event_columns(columns):
+    """ Return (event columns, boxnames) for the box timelines: Each event is listed under its old box
+    and under its new box (only once, if the tube was moved within the same box). """
+    old, new = columns['old_boxname'], columns['new_boxname']
+    departures = np.flatnonzero((old != '') & (old != new))
+    # Concatenate and re-sort by time (stable, so the event order within a box is preserved):
+    idx = np.concatenate([departures, np.arange(len(new))])
+    order = np.argsort(idx, kind='stable')
+    idx = idx[order]
+    boxnames = np.concatenate([old[departures], new])[order]
+    return {name: values[idx] for name, values in columns.items()}, boxnames
+
+
+class TubeHistoryIndex:
+    """ Per-barcode and per-box timelines of tube movement events, for point-in-time queries.
+
+    Args:
+        events: DataFrame with tube movement events (the journal columns, see `JOURNAL_COLUMNS`).
+    """
+
+    def __init__(self, events=None):
+        self.barcode_timelines = {}
+        self.box_timelines = {}
+        self.n_events = 0
+        if events is not None:
+            self.extend(events)
+
+    def __len__(self):
+        return self.n_events
+
+    def extend(self, events):
+        """ Add events to the index. The events must be later than (or at the same time as) the indexed events. """
+        if len(events) == 0:
+            return
+        columns = events_to_columns(events)
+        for timelines, (event_columns, keys) in (
+                (self.barcode_timelines, (columns, columns['barcode'])),
+                (self.box_timelines, box_event_columns(columns)),
+        ):
+            for key, timeline in group_timelines(event_columns, keys).items():
+                if key in timelines:
+                    timelines[key].extend(timeline.columns)
+                else:
+                    timelines[key] = timeline
+        self.n_events += len(events)
+
+    def get_barcode_timeline(self, barcode):
+        """ Return DataFrame with all events for the given barcode (empty if the barcode has no events). """
+        timeline = self.barcode_timelines.get(barcode)
+        if timeline is None:
+            return pd.DataFrame(columns=['timestamp', *TIMELINE_COLUMNS[1:]])
+        return timeline.to_frame()
+
+    def get_box_timeline(self, boxname):
+        """ Return DataFrame with all events moving tubes into, out of, or within the given box. """
+        timeline = self.box_timelines.get(boxname)
+        if timeline is None:
+            return pd.DataFrame(columns=['timestamp', *TIMELINE_COLUMNS[1:]])
+        return timeline.to_frame()
+
+    def location_at(self, barcode, when):
+        """ Return the location of the tube at the given time.
+
+        Args:
+            barcode: The tube barcode.
+            when: datetime, date string, or pandas Timestamp.
+
+        Returns:
+            TubeLocation, or None if the barcode has no events, or did not exist at the given time.
+        """
+        timeline = self.barcode_timelines.get(barcode)
+        if timeline is None:
+            return None
+        n = timeline.bisect(to_time(when))
+        if n > 0:
+            return TubeLocation(timeline['new_boxname'][n - 1], timeline['new_pos'][n - 1],
+                                pd.Timestamp(timeline['time'][n - 1]))
+        if timeline['old_boxname'][0] == '':
+            # The first event added the tube.
+            return None
+        return TubeLocation(timeline['old_boxname'][0], timeline['old_pos'][0], None)
+
+    def box_contents_at(self, boxname, when):
+        """ Return the tubes (with events) that were in the given box at the given time.
+
+        Returns:
+            Dict with {barcode: pos}. Tubes that have not moved at all (no events) are not included.
+        """
+        timeline = self.box_timelines.get(boxname)
+        if timeline is None:
+            return {}
+        n = timeline.bisect(to_time(when))
+        # The last event at or before `when` for each barcode: The tube is in the box if the event moved it there.
+        before = pd.DataFrame({
+            'barcode': timeline['barcode'][:n], 'boxname': timeline['new_boxname'][:n], 'pos': timeline['new_pos'][:n],
+        }).drop_duplicates('barcode', keep='last')
+        # The first event after `when`, for barcodes without earlier events: The tube is in the box
+        # if the event moved it out of (or within) the box.
+        after = pd.DataFrame({
+            'barcode': timeline['barcode'][n:], 'boxname': timeline['old_boxname'][n:], 'pos': timeline['old_pos'][n:],
+        }).drop_duplicates('barcode', keep='first')
+        after = after[~after['barcode'].isin(before['barcode'])]
+        contents = pd.concat([before, after])
+        contents = contents[contents['boxname'] == boxname]
+        return dict(zip(contents['barcode'], contents['pos']))
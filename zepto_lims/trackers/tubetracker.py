@@ -47,13 +47,51 @@ Pandas alternatives:
 """
 
 from typing import Union  # Optional
-from collections import OrderedDict
-from pprint import pprint
+from collections import namedtuple
+from datetime import datetime
+import uuid
+import numpy as np
 import pandas as pd
 
 from zepto_lims.dataclients.internal_df_client import InternalDfClient
+from zepto_lims.datastores.journal_csv_df_store import JOURNAL_COLUMNS
+from zepto_lims.trackers.barcodeindex import BarcodeBoxIndex
+from zepto_lims.trackers.history import TubeHistoryIndex, TubeLocation
 from zepto_lims.utils.gridpos import val_pos_dict_from_grid, values_coords_tup_from_val_pos
-from zepto_lims.utils.transformation import calc_best_values_coords_rotation_result
+from zepto_lims.utils.transformation import (
+    calc_best_values_coords_rotation_result, calc_best_values_coords_transform_batch, DIHEDRAL_TRANSFORMS,
+)
+
+
+# Column in the boxes table with the (optional) lid/side barcode of each box:
+LID_BARCODE_COLUMN = 'lid_barcode'
+
+# Result of `TubeTrackerDf.identify_box()`:
+#   boxname     The identified box, or None.
+#   method      How the box was identified: 'lid' (lid barcode lookup), 'tubes' (tube barcode set matching), or None.
+#   consistent  Whether the tube barcodes agree with the lid barcode (i.e. the best-matching box by tubes
+#               is the same box). None if the consistency check was not done.
+BoxIdentification = namedtuple('BoxIdentification', 'boxname method consistent')
+
+# Result of `TubeTrackerDf.reconcile_box_scans()`:
+#   events      DataFrame with the tube movement events (one row per changed tube, JOURNAL_COLUMNS).
+#   removed     List of barcodes removed from the scanned boxes (not found in any of the scans).
+#   added       List of new barcodes, added to the tubes table.
+#   conflicts   Dict with {barcode: [boxname, ...]} for barcodes found in more than one scanned box.
+ReconciliationResult = namedtuple('ReconciliationResult', 'events removed added conflicts')
+
+# How `reconcile_box_scans()` handles barcodes found in more than one scanned box:
+#   skip    Leave the tube where it is (the conflict is reported, and must be resolved manually).
+#   last    Use the last scan containing the barcode.
+#   raise   Raise ValueError without making any changes.
+CONFLICT_POLICIES = ('skip', 'last', 'raise')
+
+
+def event_values_to_str(values):
+    """ Convert an array of [boxname, pos] values to strings for the journal, with missing values as ''
+    (the same as the old values of new tubes, and how the journal reads empty values back). """
+    values = np.asarray(values, dtype=object)
+    return np.where(pd.isna(values), '', values).astype(str)
 
 
 class TubeTrackerDf:
@@ -70,6 +108,12 @@ class TubeTrackerDf:
         self.tubes_table_name_fmt = "{user}_tubes"
         self.boxes_table_name_fmt = "{user}_boxes"
         self.default_username = self.config.get('username', 'Default')
+        self._lid_barcode_index = None
+        self._lid_barcode_index_key = None
+        self._barcode_index = None
+        # The tubes table the barcode index was built for (a reference, not an id, which could be re-used):
+        self._barcode_index_df = None
+        self._history_index = None
 
     @property
     def username(self):
@@ -91,14 +135,31 @@ class TubeTrackerDf:
         """ Retrieve a pandas DataFrame with all tubes (for the currently-selected user). """
         return self.data_client.get_table(self.boxes_table_name)
 
-    def save_tubes_data(self, df, flush=None):
-        """ Retrieve a pandas DataFrame with all tubes (for the currently-selected user). """
-        self.data_client.set_table(self.tubes_table_name, df, flush=flush)
+    def save_tubes_data(self, df, flush=None, journaled=False):
+        """ Save the pandas DataFrame with all tubes (for the currently-selected user).
+
+        Args:
+            df: The tubes table.
+            flush: Flush changes (typically to disk).
+            journaled: Whether all changes to the table have been recorded as tube movement events
+                (see `record_tube_movements()`). Otherwise, journaling datastores write the whole table.
+
+        The barcode index is rebuilt when next used (see `set_barcode_index()` to keep an up-to-date index).
+        """
+        self.set_barcode_index(None, None)
+        self.data_client.set_table(self.tubes_table_name, df, flush=flush, journaled=journaled)
 
     def save_boxes_data(self, df, flush=None):
         """ Retrieve a pandas DataFrame with all tubes (for the currently-selected user). """
+        self._lid_barcode_index = None
         self.data_client.set_table(self.boxes_table_name, df, flush=flush)
 
+    def flush(self):
+        """ Write the (cached) tubes and boxes tables to disk, e.g. after a batch of un-flushed updates. """
+        self.save_boxes_data(self.get_boxes_data(), flush=True)
+        # Changes made without movement events have already been marked as such by `save_tubes_data()`:
+        self.save_tubes_data(self.get_tubes_data(), flush=True, journaled=True)
+
     def get_box_tubes(self, boxname):
         """ Get dataframe with tubes in a single box. """
         df = self.get_tubes_data()
@@ -122,6 +183,22 @@ class TubeTrackerDf:
         }
         return boxes_barcodesets
 
+    def get_barcode_index(self):
+        """ Return the inverted {barcode: boxname} index of the tubes table (see `BarcodeBoxIndex`).
+
+        The index is built when the tubes table is first used (or has been saved or replaced by a different
+        table), and is then updated incrementally when tubes are moved by `update_tubes_from_barcodes()`.
+        """
+        tubes_df = self.get_tubes_data()
+        if self._barcode_index is None or self._barcode_index_df is not tubes_df:
+            self.set_barcode_index(tubes_df, BarcodeBoxIndex.from_tubes_df(tubes_df))
+        return self._barcode_index
+
+    def set_barcode_index(self, tubes_df, barcode_index):
+        """ Set the barcode index for the given tubes table (or clear it, if `barcode_index` is None). """
+        self._barcode_index = barcode_index
+        self._barcode_index_df = tubes_df if barcode_index is not None else None
+
     def get_boxes_diff(self, barcodes_set):
         """ Calculate differences between a given set of barcodes and the boxes in the database. """
         boxes_barcodesets = self.get_box_tubebarcodesets()
@@ -135,24 +212,21 @@ class TubeTrackerDf:
         }
         return boxes_diff
 
-    def get_best_matching_boxes(self, barcodes_set):
-        """ Compare all boxes' barcodes with the given barcodes_set. """
-        boxes_diff = self.get_boxes_diff(barcodes_set)
-        boxes_diff_count = OrderedDict((
-            (boxname, (len(common), len(added), len(removed), len(common) - 0.2*len(added) - 0.1*len(removed)))
-            for boxname, (common, added, removed) in boxes_diff.items()
-        ))
-        box_similarity_scores = sorted([
-            (len(common) - 0.2*len(added) - 0.1*len(removed), boxname)
-            for boxname, (common, added, removed) in boxes_diff.items()
-        ], reverse=True)
-        pprint(box_similarity_scores)
-        boxes_diff_count_df = pd.DataFrame.from_records(
-            list(boxes_diff_count.values()),
-            columns="common added removed similarity".split(),
-            index=boxes_diff_count.keys()
-        )
-        boxes_diff_count_df.sort_values('common')
+    def get_best_matching_boxes(self, barcodes_set, top_k=None):
+        """ Compare the given barcodes_set with the boxes sharing at least one barcode with it.
+
+        Uses the inverted barcode index (see `get_barcode_index()`), so this takes time proportional
+        to the number of scanned barcodes, rather than the total number of tubes.
+
+        Args:
+            barcodes_set: The scanned barcodes.
+            top_k: Only return the `top_k` best matching boxes.
+
+        Returns:
+            DataFrame indexed by boxname with `common`, `added`, `removed`, and `similarity` columns,
+            sorted by similarity (best matching box first).
+        """
+        boxes_diff_count_df = self.get_barcode_index().top_matches(set(barcodes_set), k=top_k)
         print("Best matching boxes:")
         print(boxes_diff_count_df.head())
         return boxes_diff_count_df
@@ -162,7 +236,7 @@ class TubeTrackerDf:
             # user_input_callback=lambda best_box: input(f"Select Box '{best_box}? [Y/n] ").lower()
     ):
         """ Get the box with most barcodes in common with the given barcodes_set. """
-        boxes_diff_count_df = self.get_best_matching_boxes(barcodes_set)
+        boxes_diff_count_df = self.get_best_matching_boxes(barcodes_set, top_k=5)
         if len(boxes_diff_count_df) == 0:
             print("Did not find any existing boxes.")
             return
@@ -175,6 +249,82 @@ class TubeTrackerDf:
         #     return
         return best_box
 
+    def get_lid_barcode_index(self):
+        """ Return dict index of {lid_barcode: boxname} for the boxes with a lid barcode.
+
+        The index is only rebuilt when the boxes table changes (is saved, replaced, or changes length),
+        so looking up a box by its lid barcode is a constant-time dict lookup.
+        """
+        boxes_df = self.get_boxes_data()
+        key = (id(boxes_df), len(boxes_df))
+        if self._lid_barcode_index is None or self._lid_barcode_index_key != key:
+            if LID_BARCODE_COLUMN in boxes_df:
+                has_lid = boxes_df[LID_BARCODE_COLUMN].notna() & (boxes_df[LID_BARCODE_COLUMN] != '')
+                lid_df = boxes_df.loc[has_lid, [LID_BARCODE_COLUMN, 'boxname']]
+                self._lid_barcode_index = dict(zip(lid_df[LID_BARCODE_COLUMN].astype(str), lid_df['boxname']))
+            else:
+                self._lid_barcode_index = {}
+            self._lid_barcode_index_key = key
+        return self._lid_barcode_index
+
+    def get_box_by_lid_barcode(self, lid_barcode):
+        """ Return the boxname with the given lid barcode, or None if no box has that lid barcode. """
+        if not lid_barcode:
+            return None
+        return self.get_lid_barcode_index().get(str(lid_barcode))
+
+    def set_box_lid_barcode(self, boxname, lid_barcode, flush=None):
+        """ Assign a lid barcode to a box in the boxes table.
+
+        Raises:
+            ValueError, if the box doesn't exist or the lid barcode is already assigned to another box.
+        """
+        boxes_df = self.get_boxes_data()
+        if boxname not in boxes_df['boxname'].values:
+            raise ValueError(f"Boxname '{boxname}' not present in boxes table!")
+        existing = self.get_box_by_lid_barcode(lid_barcode)
+        if existing is not None and existing != boxname:
+            raise ValueError(f"Lid barcode '{lid_barcode}' is already assigned to box '{existing}'.")
+        if LID_BARCODE_COLUMN not in boxes_df:
+            print(f"INFO: Adding column '{LID_BARCODE_COLUMN}' to boxes_df !")
+            boxes_df[LID_BARCODE_COLUMN] = None
+        boxes_df.loc[boxes_df['boxname'] == boxname, LID_BARCODE_COLUMN] = lid_barcode
+        self._lid_barcode_index = None
+        self.save_boxes_data(boxes_df, flush=flush)
+
+    def identify_box(self, barcodes_set=None, lid_barcode=None, check_consistency=True):
+        """ Identify a scanned box, by its lid barcode if possible, otherwise by its tube barcodes.
+
+        Looking up the lid barcode is a constant-time operation, whereas matching the tube barcodes
+        compares the scanned barcodes against every box in the database (see `get_best_matching_boxes()`).
+
+        Args:
+            barcodes_set: The scanned tube barcodes.
+            lid_barcode: The scanned lid barcode, if any (see `BoxScanner.scan_box_lid_barcode()`).
+            check_consistency: If True, and the box was identified by its lid barcode, check that the tube
+                barcodes (if any) also match the box best. This requires the full set matching.
+
+        Returns:
+            BoxIdentification namedtuple with (boxname, method, consistent).
+        """
+        boxname = self.get_box_by_lid_barcode(lid_barcode)
+        if boxname is not None:
+            consistent = None
+            if check_consistency and barcodes_set:
+                best_box = self.get_best_matching_box(barcodes_set)
+                consistent = (best_box == boxname)
+                if not consistent:
+                    print(f"WARNING: Lid barcode '{lid_barcode}' identifies box '{boxname}', "
+                          f"but the tube barcodes best match box '{best_box}'.")
+            return BoxIdentification(boxname, 'lid', consistent)
+        if lid_barcode:
+            print(f"Lid barcode '{lid_barcode}' is not assigned to any box; matching by tube barcodes.")
+        if barcodes_set:
+            boxname = self.get_best_matching_box(barcodes_set)
+            if boxname is not None:
+                return BoxIdentification(boxname, 'tubes', None)
+        return BoxIdentification(None, None, None)
+
     def get_best_box_rotation(self, boxname, barcodes_val_pos_dict):
         existing_val_pos_dict = self.get_barcode_val_pos_for_box(boxname)
         values1, coords1 = values_coords_tup_from_val_pos(existing_val_pos_dict)
@@ -184,6 +334,138 @@ class TubeTrackerDf:
         )
         return avg_dist, rotation, global_shift
 
+    def get_best_box_transforms(self, barcodes_val_pos_dict, boxnames=None, method='vote'):
+        """ Find the best dihedral transform (rotation and/or flip) and translation between the scanned barcodes
+        and each of the given boxes, in a single batched calculation.
+        By default, only the boxes sharing at least one barcode with the scan are aligned,
+        as found with the barcode index (see `get_barcode_index()`).
+        See `utils.transformation.ALIGNMENT_METHODS` for `method`.
+
+        Returns:
+            Dict with {boxname: AlignmentResult} (see `utils.transformation.calc_best_coords_transform_batch()`).
+        """
+        if boxnames is None:
+            boxnames = list(self.get_barcode_index().match_counts(set(barcodes_val_pos_dict)))
+        tubes_df = self.get_tubes_data()
+        tubes_df = tubes_df.loc[tubes_df['boxname'].isin(boxnames), :]
+        values2, coords2 = values_coords_tup_from_val_pos(barcodes_val_pos_dict)
+        box_candidates = {
+            boxname: values_coords_tup_from_val_pos(dict(zip(group_df['barcode'], group_df['pos'])))
+            for boxname, group_df in tubes_df.groupby('boxname')
+        }
+        # Boxes without any tubes are included as empty candidates (with transform -1):
+        empty = ((), np.zeros((0, 2), dtype=int))
+        candidates = [box_candidates.get(boxname, empty) for boxname in boxnames]
+        results = calc_best_values_coords_transform_batch(values2, coords2, candidates, method=method)
+        return dict(zip(boxnames, results))
+
+    def get_best_box_transform(self, boxname, barcodes_val_pos_dict):
+        """ Find the best dihedral transform and translation between the scanned barcodes and the given box.
+
+        Returns:
+            Three-tuple of (alignment, rotation, flipped), where `alignment` is an AlignmentResult,
+            and `rotation` (in units of 90°) and `flipped` describe the alignment's transform.
+            If the box has no tubes in common with the scan, the alignment's transform is -1,
+            and the rotation and flipped are (0, False).
+        """
+        alignment = self.get_best_box_transforms(barcodes_val_pos_dict, boxnames=[boxname])[boxname]
+        if alignment.transform < 0:
+            return alignment, 0, False
+        rotation, flipped = DIHEDRAL_TRANSFORMS[alignment.transform]
+        return alignment, rotation, flipped
+
+    def get_moved_tubes(self, boxname, barcodes_val_pos_dict):
+        """ Return list of the barcodes that were moved within the box, i.e. the tubes that are not in place
+        after aligning the scan onto the box (accounting for rotation/flip and shift of the whole box).
+
+        Tubes that were added or removed are not included (see `get_boxes_diff()`).
+        """
+        existing_val_pos_dict = self.get_barcode_val_pos_for_box(boxname)
+        common_barcodes = [barcode for barcode in existing_val_pos_dict if barcode in barcodes_val_pos_dict]
+        if not common_barcodes:
+            return []
+        alignment, rotation, flipped = self.get_best_box_transform(boxname, barcodes_val_pos_dict)
+        # The alignment errors are in the order of the box's (common) barcodes:
+        return [barcode for barcode, inlier in zip(common_barcodes, alignment.inliers) if not inlier]
+
+    def record_tube_movements(self, events, scan_id=None, flush=None):
+        """ Record tube movement events with the data client (written to the journal by journaling datastores).
+
+        Args:
+            events: List of (barcodes, old_values, new_values) tuples, where `old_values` and `new_values`
+                are arrays with the [boxname, pos] of each barcode before and after the change.
+                Barcodes where the box and position is unchanged are not recorded.
+            scan_id: Identifier of the scan. Defaults to a new random (uuid4) identifier.
+            flush: Write the events now (typically to disk).
+
+        Returns:
+            DataFrame with the recorded events (JOURNAL_COLUMNS).
+        """
+        if not events:
+            return pd.DataFrame(columns=list(JOURNAL_COLUMNS))
+        barcodes = np.concatenate([np.asarray(event[0], dtype=object) for event in events])
+        old_values = event_values_to_str(np.concatenate([event[1] for event in events]))
+        new_values = event_values_to_str(np.concatenate([event[2] for event in events]))
+        changed = (old_values != new_values).any(axis=1)
+        events_df = pd.DataFrame({
+            'timestamp': datetime.now().isoformat(),
+            'scan_id': scan_id if scan_id is not None else uuid.uuid4().hex,
+            'barcode': barcodes[changed],
+            'old_boxname': old_values[changed, 0], 'old_pos': old_values[changed, 1],
+            'new_boxname': new_values[changed, 0], 'new_pos': new_values[changed, 1],
+        }, columns=list(JOURNAL_COLUMNS))
+        self.data_client.append_events(self.tubes_table_name, events_df, flush=flush)
+        if self._history_index is not None:
+            self._history_index.extend(events_df)
+        return events_df
+
+    def get_history_index(self):
+        """ Return the tube movement history index (per-barcode and per-box timelines, see `trackers.history`).
+
+        The index is built from the events recorded by the datastore the first time it is needed,
+        and then extended as tubes are moved. With a datastore that does not record events
+        (e.g. the plain CsvDfStore), the history only includes the events recorded by this tracker.
+        """
+        if self._history_index is None:
+            events = self.data_client.read_events(self.tubes_table_name)
+            self._history_index = TubeHistoryIndex(events)
+        return self._history_index
+
+    def get_tube_timeline(self, barcode):
+        """ Return DataFrame with the movement events of the given tube, oldest first. """
+        return self.get_history_index().get_barcode_timeline(barcode)
+
+    def get_tube_location_at(self, barcode, when):
+        """ Return the location of a tube at the given time (datetime, date string, or pandas Timestamp).
+
+        Returns:
+            TubeLocation(boxname, pos, timestamp), or None if the tube is unknown or did not exist at the given time.
+            Tubes that have not moved (no events) are at their current location, with timestamp None.
+        """
+        history_index = self.get_history_index()
+        if barcode in history_index.barcode_timelines:
+            return history_index.location_at(barcode, when)
+        barcode_index = self.get_barcode_index()
+        if barcode not in barcode_index:
+            return None
+        row = self.get_tubes_data().iloc[barcode_index.rows[barcode]]
+        return TubeLocation(row['boxname'], row['pos'], None)
+
+    def get_box_contents_at(self, boxname, when):
+        """ Return the tubes that were in the given box at the given time, as dict with {barcode: pos}
+        (same format as `get_barcode_val_pos_for_box()`). """
+        history_index = self.get_history_index()
+        contents = history_index.box_contents_at(boxname, when)
+        # Tubes currently in the box that have never moved:
+        barcode_index = self.get_barcode_index()
+        unmoved = [barcode for barcode in barcode_index.get_box_barcodes(boxname)
+                   if barcode not in history_index.barcode_timelines]
+        if unmoved:
+            tubes_df = self.get_tubes_data()
+            positions = tubes_df['pos'].values[[barcode_index.rows[barcode] for barcode in unmoved]]
+            contents.update(zip(unmoved, positions))
+        return contents
+
     def add_box(self, boxname):
         """ Add a new box to the boxes table.
         This does not add any tubes.
@@ -203,10 +485,16 @@ class TubeTrackerDf:
             pos_for_removed_tubes='N/A',
             # mark_removed_as='(missing)',
             create_box_if_nonexisting=True,
-            flush=True
+            add_new_tubes=True,
+            flush=True,
+            scan_id=None,
     ):
         """ Update the given box based on scanned barcodes in a box grid.
 
+        The update is done as a bulk operation: The rows of the scanned and removed tubes are looked up
+        in the barcode index (see `get_barcode_index()`), and updated with a single `iloc` assignment each,
+        so the update takes time proportional to the number of scanned tubes, not the size of the tubes table.
+
         Args:
             boxname: The box from which the barcodes was just scanned.
             barcodes: The barcodes that were just scanned.
@@ -228,7 +516,11 @@ class TubeTrackerDf:
                     (trashed)       For tubes that have been thrown out.
             create_box_if_nonexisting: Whether to automatically create `boxname` if it doesn't exist
                 in the database.
+            add_new_tubes: Whether to add scanned barcodes that are not in the tubes table as new tubes
+                (appended to the tubes table in the same batch).
             flush: Flush changes (typically to disk).
+            scan_id: Identifier of the scan, recorded with the tube movement events (for journaling datastores).
+                Defaults to a new random (uuid4) identifier.
 
         Args to be added later:
             mark_removed_as: This is for implementing a secondary way of marking the status of
@@ -244,6 +536,8 @@ class TubeTrackerDf:
             barcodes = val_pos_dict_from_grid(grid=barcodes)
         tubes_df = self.get_tubes_data()
         boxes_df = self.get_boxes_data()
+        # Added columns are not described by the movement events, so the whole table must then be saved:
+        journaled = all(column in tubes_df for column in ('barcode', 'boxname', 'pos'))
         # Sanity checks of the provided DataFrames:
         if 'barcode' not in tubes_df:
             print("INFO: Adding column 'barcode' to tubes_df !")
@@ -278,42 +572,195 @@ class TubeTrackerDf:
 
         # Before we update the scanned barcodes, we should identify the barcodes that have
         # been removed and update the box on these to '(missing)' or similar.
-        previous_box_barcodes = set(tubes_df['barcode'][tubes_df['boxname'] == boxname])
+        barcode_index = self.get_barcode_index()
+        previous_box_barcodes = barcode_index.get_box_barcodes(boxname)
         barcodes_set = set(barcodes.keys())
         removed = previous_box_barcodes - barcodes_set
         added = barcodes_set - previous_box_barcodes
         print(f"Removed barcodes from box '{boxname}':", sorted(removed))
-        if update_removed:
-            # Eliminate for-loop by using pd.Series.isin(collection) instead of pd.Series == val
-            for barcode in removed:
-                # tubes_df['boxname'].where(tubes_df['barcode'] == barcode, boxname_for_removed_tubes, inplace=True)
-                # tubes_df['pos'].where(tubes_df['barcode'] == barcode, 'N/A', inplace=True)
-                tubes_df.loc[tubes_df['barcode'] == barcode, 'boxname'] = boxname_for_removed_tubes
-                tubes_df.loc[tubes_df['barcode'] == barcode, 'pos'] = pos_for_removed_tubes
-
-        ## RANT: WHY IS PANDAS SO WEIRD??
-        ## FROM pandas.DataFramw.where() docstring:
-        ## > "Replace values where the condition is False."
-        ## Why should the condition be False, instead of True?
-        ## From the docs:
-        ## > "Roughly `df1.where(m, df2)` is equivalent to `np.where(m, df1, df2)`."
-        ## Maybe just use df.loc[mask, col] = (new value)
-
-        # Update 'boxname' and 'pos' for the scanned barcodes:
-        # This could perhaps also be done without a for-loop, by using `in barcodes.keys()`,
-        # tubes_df.loc[tubes_df['barcode'] in barcode, 'boxname'] = boxname
-        # or by creating a DataFrame from barcodes and then using df.update().
-        # Using df.update() probably requires using `barcode` as the index of the DataFrame.
-        # Using df.update() would also make it easier to add new tubes.
-        for barcode, pos in barcodes.items():
-            # tubes_df['boxname'].where(tubes_df['barcode'] == barcode, boxname, inplace=True)
-            # tubes_df['pos'].where(tubes_df['barcode'] == barcode, pos, inplace=True)
-            # Alternative to using where:
-            tubes_df.loc[tubes_df['barcode'] == barcode, 'boxname'] = boxname
-            tubes_df.loc[tubes_df['barcode'] == barcode, 'pos'] = pos
-
-        # TODO: Add new tubes!
+        columns = [tubes_df.columns.get_loc('boxname'), tubes_df.columns.get_loc('pos')]
+        # Movement events, as (barcodes, old [boxname, pos] array, new [boxname, pos] array) for each kind of change:
+        events = []
+        if update_removed and removed:
+            removed = list(removed)
+            removed_barcodes, removed_rows = barcode_index.get_rows(removed)
+            new_values = np.array(
+                [[boxname_for_removed_tubes, pos_for_removed_tubes]] * len(removed_rows), dtype=object)
+            events.append((removed_barcodes, tubes_df.iloc[removed_rows, columns].values, new_values))
+            tubes_df.iloc[removed_rows, columns] = new_values
+            barcode_index.move_many(removed, boxname_for_removed_tubes)
+
+        # Update 'boxname' and 'pos' for the scanned barcodes already in the tubes table:
+        existing = [barcode for barcode in barcodes if barcode in barcode_index]
+        if existing:
+            existing_barcodes, existing_rows = barcode_index.get_rows(existing)
+            new_values = np.array([[boxname, barcodes[barcode]] for barcode in existing_barcodes], dtype=object)
+            events.append((existing_barcodes, tubes_df.iloc[existing_rows, columns].values, new_values))
+            tubes_df.iloc[existing_rows, columns] = new_values
+            barcode_index.move_many(existing, boxname)
+
+        # Add new tubes (scanned barcodes that are not in the tubes table), in a single append:
+        new_barcodes = [barcode for barcode in barcodes if barcode not in barcode_index]
+        if new_barcodes and add_new_tubes:
+            print(f"Adding {len(new_barcodes)} new tubes to box '{boxname}':", sorted(new_barcodes))
+            new_tubes_df = pd.DataFrame({
+                'boxname': boxname, 'barcode': new_barcodes, 'pos': [barcodes[barcode] for barcode in new_barcodes],
+            }, columns=tubes_df.columns)
+            events.append((new_barcodes, np.full((len(new_barcodes), 2), '', dtype=object),
+                           new_tubes_df[['boxname', 'pos']].values))
+            start_row = len(tubes_df)
+            tubes_df = pd.concat([tubes_df, new_tubes_df], ignore_index=True)
+            barcode_index.add_rows(new_barcodes, boxname, start_row)
 
         # Finally, make sure to save the updated dataframes:
         self.save_boxes_data(boxes_df, flush=flush)
-        self.save_tubes_data(tubes_df, flush=flush)
+        self.save_tubes_data(tubes_df, flush=flush, journaled=journaled)
+        self.record_tube_movements(events, scan_id=scan_id, flush=flush)
+        # The index has been updated incrementally, and is valid for the (possibly extended) tubes table:
+        self.set_barcode_index(tubes_df, barcode_index)
+
+    def reconcile_box_scans(
+            self, scans,
+            update_removed=True,
+            boxname_for_removed_tubes='(missing)',
+            pos_for_removed_tubes='N/A',
+            create_box_if_nonexisting=True,
+            add_new_tubes=True,
+            on_conflict='skip',
+            flush=True,
+            scan_id=None,
+    ):
+        """ Update the tube locations from scans of many boxes (e.g. a whole freezer rack) as one transaction.
+
+        All scans are combined into a single table of (boxname, barcode, pos), which is reconciled
+        against the tubes table in one pass: The moved, removed, and new tubes of all boxes are found
+        together, the tubes table is updated with a single `iloc` assignment (and a single append for
+        new tubes), and both tables (and the tube movement events) are written in a single flush.
+
+        The update is made on copies of the tables, which only replace the current tables (and the barcode
+        index is only updated) once they have been written, so if writing fails, nothing is changed.
+        OBS: With a journaling datastore, the boxes table is written before the tube movement events are
+        appended to the journal. If appending the events fails, the boxes table on disk can include
+        the newly created boxes, without the tubes moved into them. Since boxes are only ever added here,
+        the tables on disk are still consistent, and the scans can simply be reconciled again.
+
+        Unlike calling `update_tubes_from_barcodes()` for each box, a tube moved between two scanned boxes
+        is not first marked as removed, and barcodes found in more than one scanned box are reported
+        as conflicts (see `on_conflict`) instead of silently ending up in the last box.
+
+        Args:
+            scans: The box scans, either as a dict with {boxname: barcodes}, or a list of (boxname, barcodes)
+                tuples (if a box is scanned more than once, the last scan is used).
+                Barcodes are given as either a grid (list of lists) or a dict with {barcode: pos},
+                see `update_tubes_from_barcodes()`.
+            update_removed: Whether to update removed tubes (tubes previously in a scanned box,
+                which are not found in any of the scans).
+            boxname_for_removed_tubes: The boxname for removed tubes, see `update_tubes_from_barcodes()`.
+            pos_for_removed_tubes: The position for removed tubes.
+            create_box_if_nonexisting: Whether to create scanned boxes that are not in the boxes table.
+                If False, the scans of such boxes are skipped.
+                If 'raise', raise ValueError instead (without making any changes).
+            add_new_tubes: Whether to add scanned barcodes that are not in the tubes table as new tubes.
+            on_conflict: How to handle barcodes found in more than one box, one of CONFLICT_POLICIES.
+            flush: Flush changes (typically to disk).
+            scan_id: Identifier recorded with the tube movement events. Defaults to a new random (uuid4) identifier.
+
+        Returns:
+            ReconciliationResult(events, removed, added, conflicts)
+        """
+        if on_conflict not in CONFLICT_POLICIES:
+            raise ValueError(f"`on_conflict` must be one of {CONFLICT_POLICIES}, not {on_conflict!r}.")
+        scans = {boxname: val_pos_dict_from_grid(grid=barcodes) if isinstance(barcodes, list) else barcodes
+                 for boxname, barcodes in dict(scans).items()}
+        # All changes are made to copies of the tables, see above:
+        previous_tubes_df, previous_boxes_df = self.get_tubes_data(), self.get_boxes_data()
+        tubes_df, boxes_df = previous_tubes_df.copy(), previous_boxes_df.copy()
+        journaled = all(column in tubes_df for column in ('barcode', 'boxname', 'pos'))
+        for column in ('barcode', 'boxname', 'pos'):
+            if column not in tubes_df:
+                print(f"INFO: Adding column '{column}' to tubes_df !")
+                tubes_df[column] = 'N/A'
+        if 'boxname' not in boxes_df:
+            print("INFO: Adding column 'boxname' to boxes_df !")
+            boxes_df['boxname'] = 'N/A'
+
+        # Scanned boxes that are not in the boxes table are created with a single append (or skipped):
+        existing_boxnames = set(boxes_df['boxname'].values)
+        missing_boxes = [boxname for boxname in scans if boxname not in existing_boxnames]
+        if missing_boxes:
+            print("WARNING: Scanned boxes not present in 'boxes' table:", missing_boxes)
+            if create_box_if_nonexisting == 'raise':
+                raise ValueError(f"Scanned boxes {missing_boxes} do not exist in the database.")
+            if create_box_if_nonexisting is True:
+                boxes_df = pd.concat([boxes_df, pd.DataFrame({'boxname': missing_boxes})], ignore_index=True)
+            else:
+                print("Skipping the scans of boxes not present in 'boxes' table:", missing_boxes)
+        # All scanned barcodes, including skipped scans (the tubes were seen, so they are not missing):
+        seen = {barcode for barcodes in scans.values() for barcode in barcodes}
+        if missing_boxes and create_box_if_nonexisting is not True:
+            scans = {boxname: barcodes for boxname, barcodes in scans.items() if boxname not in missing_boxes}
+
+        scanned_boxnames, scanned_barcodes, scanned_positions = [], [], []
+        for boxname, barcodes in scans.items():
+            scanned_boxnames.extend([boxname] * len(barcodes))
+            scanned_barcodes.extend(barcodes.keys())
+            scanned_positions.extend(barcodes.values())
+        scanned = pd.DataFrame({'boxname': scanned_boxnames, 'barcode': scanned_barcodes, 'pos': scanned_positions},
+                               dtype=object)
+
+        # Barcodes found in more than one box:
+        duplicated = scanned['barcode'].duplicated(keep=False).values
+        conflicts = scanned[duplicated].groupby('barcode', sort=True)['boxname'].agg(list).to_dict()
+        if conflicts:
+            print(f"WARNING: {len(conflicts)} barcodes found in more than one box:", conflicts)
+            if on_conflict == 'raise':
+                raise ValueError(f"Barcodes found in more than one box: {conflicts}")
+            if on_conflict == 'skip':
+                scanned = scanned[~duplicated]
+            else:
+                scanned = scanned.drop_duplicates('barcode', keep='last')
+
+        # The barcode index is only read here; it is updated once the tables have been written:
+        barcode_index = self.get_barcode_index()
+        in_index = scanned['barcode'].map(barcode_index.rows).notna().values
+        existing, new = scanned[in_index], scanned[~in_index]
+        # Removed tubes: Tubes in the scanned boxes, which are not in any of the scans.
+        # (Conflicting barcodes were scanned, so they are left where they are, see `on_conflict`.)
+        removed = [barcode for boxname in scans for barcode in barcode_index.box_barcodes.get(boxname, ())
+                   if barcode not in seen] if update_removed else []
+        print(f"Removed barcodes from {len(scans)} boxes:", sorted(removed))
+
+        # Update 'boxname' and 'pos' for the removed and moved tubes, with a single assignment:
+        columns = [tubes_df.columns.get_loc('boxname'), tubes_df.columns.get_loc('pos')]
+        targets = dict.fromkeys(removed, (boxname_for_removed_tubes, pos_for_removed_tubes))
+        targets.update(zip(existing['barcode'], zip(existing['boxname'], existing['pos'])))
+        barcodes, rows = barcode_index.get_rows(targets)
+        new_values = np.array([targets[barcode] for barcode in barcodes], dtype=object).reshape(-1, 2)
+        events = [(barcodes, tubes_df.iloc[rows, columns].values, new_values)] if rows else []
+        if rows:
+            tubes_df.iloc[rows, columns] = new_values
+
+        # Add new tubes, in a single append:
+        added = list(new['barcode']) if add_new_tubes else []
+        start_row = len(tubes_df)
+        if added:
+            print(f"Adding {len(added)} new tubes:", sorted(added))
+            events.append((added, np.full((len(added), 2), '', dtype=object), new[['boxname', 'pos']].values))
+            tubes_df = pd.concat([tubes_df, new.reindex(columns=tubes_df.columns)], ignore_index=True)
+
+        # Commit all changes in a single flush, restoring the previous tables if writing fails:
+        self._lid_barcode_index = None
+        try:
+            self.data_client.set_tables({self.boxes_table_name: boxes_df, self.tubes_table_name: tubes_df},
+                                        flush=flush, journaled=journaled)
+        except Exception:
+            self.data_client.set_tables({self.boxes_table_name: previous_boxes_df,
+                                         self.tubes_table_name: previous_tubes_df}, flush=False, journaled=True)
+            raise
+        events_df = self.record_tube_movements(events, scan_id=scan_id, flush=flush)
+        barcode_index.assign(removed, [boxname_for_removed_tubes] * len(removed))
+        barcode_index.assign(existing['barcode'].values, existing['boxname'].values)
+        if added:
+            barcode_index.assign(added, new['boxname'].values, rows=range(start_row, start_row + len(added)))
+        self.set_barcode_index(tubes_df, barcode_index)
+        return ReconciliationResult(events_df, removed, added, conflicts)
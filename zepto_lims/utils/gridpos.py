@@ -28,14 +28,33 @@ Conversion functions:
         values_coords_tup_from_val_pos()  - Convert barcode positions from the database to barcode
         val_pos_dict_from_values_coords()   box-grid coordinates (and back - not needed).
 
+    pos-str <-> coords:
+        PositionCodec - Lookup tables between position strings and grid coordinates,
+                        with vectorized encode() and decode() for numpy arrays and pandas Series,
+                        e.g. to convert the whole `pos` column of the tubes table in one operation.
+                        Use `get_position_codec()` to get a (cached) codec.
+
 
 """
 
 from collections import OrderedDict
+from functools import lru_cache
 import numpy as np
+import pandas as pd
 import re
 
 
+# Position formats that are always accepted when decoding position strings,
+# i.e. both zero-padded ('A01') and un-padded ('A1') columns:
+STANDARD_POS_FMTS = ("{row}{col:02}", "{row}{col}")
+
+# Default codec grid shape; covers all single-letter rows and two-digit columns:
+DEFAULT_CODEC_SHAPE = (26, 99)
+
+# Default regex for parsing position strings in `values_coords_tup_from_val_pos()`:
+DEFAULT_POS_REGEX = r"(?P<row>[A-z])(?P<col>\d+)"
+
+
 def alphabet_iterator(start='A', take=None):
     val = ord(start)
     # is_upper = start == start.upper()
@@ -86,10 +105,116 @@ def values_coords_tup_from_grid(grid, exclude=(None, np.NaN), unique=True) -> tu
     return vals, np.array(coords)
 
 
+class PositionCodec:
+    """ Convert between position strings (e.g. 'A01') and (row, col) grid coordinates using lookup tables.
+
+    The tables are built once (use `get_position_codec()` to re-use codecs),
+    after which encoding is an array indexing operation, and decoding is a (vectorized) hash-table lookup,
+    instead of formatting/regex-parsing each position string one at a time.
+
+    Args:
+        shape: The (nrows, ncols) shape of the grid.
+        pos_fmt: How to format each position (e.g. 'A1' or 'A01').
+        transpose: Transpose columns and rows, i.e. the position letter is given by the column.
+        row_start: The letter of the first row.
+        col_start: The number of the first column.
+
+    Decoding also accepts the standard position formats, e.g. both 'A1' and 'A01'.
+    """
+
+    def __init__(self, shape=DEFAULT_CODEC_SHAPE, pos_fmt="{row}{col:02}", transpose=False, row_start='A', col_start=1):
+        if len(row_start) != 1:
+            raise ValueError("PositionCodec `row_start` must be a single character!")
+        self.shape = nrows, ncols = tuple(shape)
+        self.pos_fmt = pos_fmt
+        self.transpose = transpose
+        self.row_start = row_start
+        self.col_start = col_start
+        row_start_ord = ord(row_start)
+        rows, cols = np.indices(self.shape)
+        if transpose:
+            rows, cols = cols, rows
+
+        def pos_table(fmt):
+            return np.array([
+                fmt.format(row=chr(row + row_start_ord), col=col + col_start)
+                for row, col in zip(rows.ravel(), cols.ravel())
+            ], dtype=object).reshape(self.shape)
+
+        # encode table: (row, col) -> pos-str
+        self.pos_table = pos_table(pos_fmt)
+        # decode table: pos-str -> flat cell index (the first format wins if formats produce the same string):
+        pos_index = {}
+        for fmt in (pos_fmt,) + STANDARD_POS_FMTS:
+            table = self.pos_table if fmt == pos_fmt else pos_table(fmt)
+            for flat_idx, pos in enumerate(table.ravel()):
+                pos_index.setdefault(pos, flat_idx)
+        self.pos_index = pos_index
+        self._index = pd.Index(list(pos_index.keys()))
+        self._flat_idx = np.fromiter(pos_index.values(), dtype=np.intp, count=len(pos_index))
+
+    def __repr__(self):
+        return (f"PositionCodec(shape={self.shape}, pos_fmt={self.pos_fmt!r}, transpose={self.transpose}, "
+                f"row_start={self.row_start!r}, col_start={self.col_start})")
+
+    def encode(self, rows, cols=None):
+        """ Convert grid coordinates to position strings.
+
+        Args:
+            rows: Row indices (scalar, array, or pandas Series),
+                or a (n, 2) coordinates array if `cols` is not given.
+            cols: Column indices.
+
+        Returns:
+            Position string(s); a numpy array (dtype object) for array input,
+            or a pandas Series (with the same index) for Series input.
+        """
+        if cols is None:
+            rows, cols = np.asarray(rows).T
+        positions = self.pos_table[np.asarray(rows), np.asarray(cols)]
+        if isinstance(rows, pd.Series):
+            return pd.Series(positions, index=rows.index)
+        return positions
+
+    def decode(self, positions, errors='raise'):
+        """ Convert position strings to grid coordinates.
+
+        Args:
+            positions: Position strings, e.g. a list, numpy array, or pandas Series (e.g. `tubes_df['pos']`).
+            errors: If 'raise', raise ValueError for position strings not on the grid.
+                If 'coerce', the coordinates are set to (-1, -1) for these positions.
+
+        Returns:
+            (n, 2)-shaped integer coordinates array, or a DataFrame with `row` and `col` columns
+            (with the same index) for Series input.
+        """
+        idx = self._index.get_indexer(pd.Index(positions, dtype=object))
+        invalid = idx < 0
+        if invalid.any() and errors == 'raise':
+            pos = np.asarray(positions, dtype=object)[invalid][0]
+            raise ValueError(f"Could not parse grid coordinate from pos-string '{pos}'.")
+        coords = np.stack(np.divmod(self._flat_idx[idx], self.shape[1]), axis=-1)
+        coords[invalid] = -1
+        if isinstance(positions, pd.Series):
+            return pd.DataFrame(coords, columns=['row', 'col'], index=positions.index)
+        return coords
+
+
+@lru_cache(maxsize=32)
+def get_position_codec(shape=DEFAULT_CODEC_SHAPE, pos_fmt="{row}{col:02}", transpose=False, row_start='A', col_start=1):
+    """ Return a PositionCodec for the given parameters, built only once for each set of parameters. """
+    return PositionCodec(tuple(shape), pos_fmt=pos_fmt, transpose=transpose, row_start=row_start, col_start=col_start)
+
+
+def grid_shape(grid) -> tuple:
+    """ Return the (nrows, ncols) shape of a grid (list of lists, where rows may have different lengths). """
+    return len(grid), max((len(row) for row in grid), default=0)
+
+
 def values_coords_tup_from_val_pos(
         val_pos_dict: dict,
         a01_coord: tuple = (0, 0),
-        pos_regex: str = r"(?P<row>[A-z])(?P<col>\d+)",
+        pos_regex: str = DEFAULT_POS_REGEX,
         transpose: bool = False
 ) -> tuple:
     """ Convert a {val: pos-str} dict to (values, coords) tuple, where coords is a nx2 matrix.
@@ -107,6 +232,17 @@ def values_coords_tup_from_val_pos(
         where n is the number of values.
     """
     row_offset, col_offset = a01_coord
+    values = tuple(val_pos_dict.keys())
+    if not values:
+        raise ValueError("`val_pos_dict` is empty.")
+    if pos_regex == DEFAULT_POS_REGEX:
+        # Decode all positions with the lookup-table codec, only falling back to regex-parsing
+        # for position strings not in the codec's tables (e.g. rows beyond 'Z').
+        # A custom `pos_regex` may parse positions differently, so it is always used as given.
+        coords = get_position_codec(transpose=transpose).decode(list(val_pos_dict.values()), errors='coerce')
+        if not (coords < 0).any():
+            offset = (col_offset, row_offset) if transpose else (row_offset, col_offset)
+            return values, coords + offset
     pos_regex = re.compile(pos_regex)
 
     def coord_from_pos(pos) -> tuple:
@@ -168,15 +304,11 @@ def val_pos_dict_from_grid(
     if len(row_start) != 1:
         raise ValueError("val_pos_dict_from_grid() `row_start` must be a single character!")
     exclude = set(exclude)
-    row_start_ord = ord(row_start)
-    if transpose:
-        def pos_str(row: int, col: int) -> str:
-            return pos_fmt.format(row=chr(col + row_start_ord), col=row + col_start)
-    else:
-        def pos_str(row: int, col: int) -> str:
-            return pos_fmt.format(row=chr(row + row_start_ord), col=col + col_start)
+    pos_table = get_position_codec(
+        grid_shape(grid), pos_fmt=pos_fmt, transpose=transpose, row_start=row_start, col_start=col_start
+    ).pos_table
 
-    return {value: pos_str(row=row_i, col=col_j)
+    return {value: pos_table[row_i, col_j]
             for row_i, rvals in enumerate(grid)
             for col_j, value in enumerate(rvals)
             if value not in exclude}
@@ -203,15 +335,11 @@ def pos_val_dict_from_grid(
 
     """
     exclude = set(exclude)
-    row_start_ord = ord(row_start)
-    if transpose:
-        def pos_str(row: int, col: int) -> str:
-            return pos_fmt.format(row=chr(col + row_start_ord), col=row + col_start)
-    else:
-        def pos_str(row: int, col: int) -> str:
-            return pos_fmt.format(row=chr(row + row_start_ord), col=col + col_start)
+    pos_table = get_position_codec(
+        grid_shape(grid), pos_fmt=pos_fmt, transpose=transpose, row_start=row_start, col_start=col_start
+    ).pos_table
 
-    return {pos_str(row=row_i, col=col_j): value
+    return {pos_table[row_i, col_j]: value
             for row_i, rvals in enumerate(grid)
             for col_j, value in enumerate(rvals)
             if value not in exclude}
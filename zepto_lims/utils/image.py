@@ -1,36 +1,211 @@
 # Copyright 2019, Rasmus Sorensen <rasmusscholer@gmail.com>
 """
 
+Image loading (and showing) functions.
+
+The image backend (cv2, PIL, or skimage, in that order of preference) is selected once, when the module
+is imported, and is available as `IMAGE_BACKEND`.
+
+* `imread()` reads an image, optionally at reduced resolution (`reduce=2, 4, 8`).
+    With cv2, this uses the `IMREAD_REDUCED_*` flags, and with PIL the JPEG "draft" mode,
+    which both decode the JPEG at reduced size, rather than decoding the full image and then resizing.
+* Binary PGM (.pgm) files and raw frames (see `read_raw()`) are read through memory-mapped,
+    read-only buffers, so no pixel data is copied or decoded.
+* `ImageCache` is a bounded LRU cache of decoded images, keyed by file path and modification time,
+    so re-reading an unchanged file (e.g. replayed or repeated scans) skips the decoding entirely.
 
 """
 
+from pathlib import Path
+import numpy as np
+
+from .lrucache import LRUCache
+
 
 try:
     import cv2
 except ImportError:
     cv2 = None
+try:
+    import PIL.Image as PilImage
+except ImportError:
+    PilImage = None
+
+if cv2 is not None:
+    IMAGE_BACKEND = 'cv2'
+elif PilImage is not None:
+    IMAGE_BACKEND = 'pil'
+else:
     try:
-        from skimage.io import imread, imshow as _imshow, show as _show
-        print("WARNING: Using un-tested skimage to read and show images.")
-        # skimage.io.imshow uses matplotlib by default.
-        def imshow(image, title='window title'):
-            _imshow(image)
-            _show()
+        import skimage.io as skimage_io
     except ImportError:
-        try:
-            import PIL.Image as PilImage
-        except ImportError:
-            raise ImportError("ERROR: Could not load any of the standard image libraries (cv2, PIL, skimage).")
+        raise ImportError("ERROR: Could not load any of the standard image libraries (cv2, PIL, skimage).")
+    IMAGE_BACKEND = 'skimage'
+    print("WARNING: Using un-tested skimage to read and show images.")
+
+
+# Supported resolution reduction factors for `imread(..., reduce=n)`:
+REDUCE_FACTORS = (1, 2, 4, 8)
+
+if cv2 is not None:
+    CV2_IMREAD_FLAGS = {
+        (True, 1): cv2.IMREAD_GRAYSCALE,
+        (True, 2): cv2.IMREAD_REDUCED_GRAYSCALE_2,
+        (True, 4): cv2.IMREAD_REDUCED_GRAYSCALE_4,
+        (True, 8): cv2.IMREAD_REDUCED_GRAYSCALE_8,
+        (False, 1): cv2.IMREAD_COLOR,
+        (False, 2): cv2.IMREAD_REDUCED_COLOR_2,
+        (False, 4): cv2.IMREAD_REDUCED_COLOR_4,
+        (False, 8): cv2.IMREAD_REDUCED_COLOR_8,
+    }
+
+# File extensions read as memory-mapped (binary) PGM files, regardless of the image backend:
+MEMMAP_EXTENSIONS = ('.pgm',)
+
+
+def _imread_cv2(filepath, as_gray, reduce):
+    # OBS: cv2.imread does NOT support Python pathlib.Path as filename argument, only strings.
+    return cv2.imread(str(filepath), CV2_IMREAD_FLAGS[(bool(as_gray), reduce)])
+
+
+def _imread_pil(filepath, as_gray, reduce):
+    with PilImage.open(filepath) as im:
+        mode = 'L' if as_gray else 'RGB'
+        if reduce > 1:
+            size = (im.width // reduce, im.height // reduce)
+            # draft() makes the JPEG decoder decode directly to a (scale >= size) reduced image:
+            im.draft(mode, size)
+            im = im.convert(mode)
+            if im.size != size:
+                im = im.resize(size)
         else:
-            def imread(filepath, as_gray=True):
-                PilImage.open(filepath)
+            im = im.convert(mode)
+        return np.asarray(im)
 
-            def imshow(image, title='window title'):
-                PilImage.Image(image).show(title=title)
-else:
-    def imread(filepath, as_gray=True):
-        # OBS: cv2.imread does NOT support Python pathlib.Path as filename argument, only strings.
-        return cv2.imread(str(filepath), cv2.IMREAD_GRAYSCALE)
 
+def _imread_skimage(filepath, as_gray, reduce):
+    image = skimage_io.imread(str(filepath), as_gray=as_gray)
+    if as_gray and image.dtype != np.uint8:
+        image = (image * 255).round().astype(np.uint8)
+    return image[::reduce, ::reduce] if reduce > 1 else image
+
+
+_IMREAD_BACKENDS = {
+    'cv2': _imread_cv2,
+    'pil': _imread_pil,
+    'skimage': _imread_skimage,
+}
+_imread = _IMREAD_BACKENDS[IMAGE_BACKEND]
+
+
+def read_pgm_header(fp):
+    """ Read the header of a binary (P5) PGM file.
+
+    Returns:
+        Three-tuple of (shape, dtype, offset) where `offset` is the byte offset of the pixel data.
+    """
+    fields = []
+    while len(fields) < 4:
+        line = fp.readline()
+        if not line:
+            raise ValueError("Unexpected end of file in PGM header.")
+        fields.extend(line.split(b'#', 1)[0].split())
+    magic, width, height, maxval = fields[:4]
+    if magic != b'P5':
+        raise ValueError(f"Only binary (P5) PGM files are supported, not {magic!r}.")
+    # Multi-byte PGM pixels are big-endian:
+    dtype = np.dtype(np.uint8) if int(maxval) < 256 else np.dtype('>u2')
+    return (int(height), int(width)), dtype, fp.tell()
+
+
+def read_pgm(filepath):
+    """ Read a binary PGM file as a read-only, memory-mapped numpy array (zero-copy). """
+    with open(filepath, 'rb') as fp:
+        shape, dtype, offset = read_pgm_header(fp)
+    return np.memmap(filepath, dtype=dtype, mode='r', offset=offset, shape=shape)
+
+
+def read_raw(filepath, shape, dtype=np.uint8, offset=0):
+    """ Read a raw (headerless) frame, e.g. dumped from a camera, as a read-only, memory-mapped numpy array.
+
+    Args:
+        filepath: The raw frame file.
+        shape: The frame shape, e.g. (height, width).
+        dtype: The pixel data type.
+        offset: Byte offset of the pixel data in the file.
+    """
+    return np.memmap(filepath, dtype=dtype, mode='r', offset=offset, shape=tuple(shape))
+
+
+def imread(filepath, as_gray=True, reduce=1):
+    """ Read an image file as a numpy array.
+
+    Args:
+        filepath: The image file.
+        as_gray: Read the image as grayscale (default), otherwise as color (BGR for cv2, RGB for PIL).
+        reduce: Resolution reduction factor, one of 1, 2, 4, or 8. The image is decoded directly at
+            reduced resolution, if supported by the backend and file format.
+
+    Returns:
+        The image as numpy array. OBS: As `cv2.imread`, the cv2 backend returns None if the file could not be read.
+        Binary PGM images are returned as read-only memory-mapped arrays (a strided view when reduced).
+    """
+    if reduce not in REDUCE_FACTORS:
+        raise ValueError(f"`reduce` must be one of {REDUCE_FACTORS}, not {reduce!r}.")
+    if Path(filepath).suffix.lower() in MEMMAP_EXTENSIONS and as_gray:
+        image = read_pgm(filepath)
+        return image[::reduce, ::reduce] if reduce > 1 else image
+    return _imread(filepath, as_gray, reduce)
+
+
+class ImageCache(LRUCache):
+    """ Size-bounded LRU cache of decoded images (see `utils.lrucache.LRUCache`),
+    keyed by file path and modification time.
+
+    If the file is modified, its modification time changes, and the image is read again.
+    Cached images are read-only, so an image returned from the cache can't be modified in-place by mistake.
+    """
+
+    def __init__(self, maxsize=16):
+        super().__init__(maxsize=maxsize)
+
+    @staticmethod
+    def make_key(filepath, as_gray=True, reduce=1):
+        """ Return the cache key for an image file. """
+        stat = Path(filepath).stat()
+        return str(Path(filepath).resolve()), stat.st_mtime_ns, stat.st_size, bool(as_gray), reduce
+
+    def imread(self, filepath, as_gray=True, reduce=1):
+        """ Return the image, from the cache if the file is unchanged, otherwise read with `imread()`. """
+        key = self.make_key(filepath, as_gray=as_gray, reduce=reduce)
+        found, image = self.lookup(key)
+        if found:
+            return image
+        image = imread(filepath, as_gray=as_gray, reduce=reduce)
+        if image is None or not self.maxsize:
+            return image
+        image.flags.writeable = False
+        self.put(key, image)
+        return image
+
+
+# Shared cache, used by `cached_imread()`:
+IMAGE_CACHE = ImageCache(maxsize=16)
+
+
+def cached_imread(filepath, as_gray=True, reduce=1):
+    """ Read image using the shared `IMAGE_CACHE`. See `ImageCache.imread()`. """
+    return IMAGE_CACHE.imread(filepath, as_gray=as_gray, reduce=reduce)
+
+
+if IMAGE_BACKEND == 'cv2':
     def imshow(image, title='window title'):
         cv2.imshow(title, image)
+elif IMAGE_BACKEND == 'pil':
+    def imshow(image, title='window title'):
+        PilImage.fromarray(np.asarray(image)).show(title=title)
+else:
+    def imshow(image, title='window title'):
+        # skimage.io.imshow uses matplotlib by default.
+        skimage_io.imshow(image)
+        skimage_io.show()
@@ -0,0 +1,68 @@
+# Copyright 2019, Rasmus Sorensen <rasmusscholer@gmail.com>
+"""
+
+Module with a generic, thread-safe, size-bounded LRU cache.
+
+The cache is used for the decode results of grid cells (see `scanners.decodecache.DecodeCache`),
+and for decoded images (see `utils.image.ImageCache`).
+
+"""
+
+from collections import OrderedDict
+import threading
+
+
+class LRUCache:
+    """ Thread-safe, size-bounded LRU cache.
+
+    Values can be None, so use `lookup()` to distinguish between a cached None and a cache miss.
+    A `maxsize` of 0 (or None) disables the cache.
+
+    The cache keeps track of the number of hits and misses, see `info()`.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def lookup(self, key):
+        """ Look up key in the cache.
+
+        Returns:
+            Two-tuple of (found, value).
+        """
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return False, None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return True, value
+
+    def put(self, key, value):
+        """ Add value to the cache, evicting the least-recently used entries if the cache is full. """
+        if not self.maxsize:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        """ Remove all entries from the cache and reset the hit/miss counters. """
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def info(self):
+        """ Return dict with cache statistics: hits, misses, size, and maxsize. """
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data), 'maxsize': self.maxsize}
@@ -23,15 +23,38 @@ How to calculate transformation of a set of points:
 Since we only have 90° rotations, it is perhaps easier to just do all four rotations,
 and then calculate the best translation between the two grids.
 
+Boxes can also be flipped (mirrored), e.g. if a box is scanned from the underside.
+Together with the four rotations, this gives the eight "dihedral" transforms of the square grid,
+see `DIHEDRAL_TRANSFORMS`. `calc_best_coords_transform_result()` evaluates all eight transforms
+in a single, stacked numpy operation, and `calc_best_coords_transform_batch()` scores many candidate
+boxes against one scan in a single batched call.
+
 
 """
 
+from collections import namedtuple
 import numpy as np
 # import snoop
 
 from .gridpos import values_coords_tup_from_grid
 
 
+# Result of aligning a scan onto a box's previous coordinates:
+#   error           The average error distance (per tube) after applying the transform and translation.
+#   transform       Index of the best dihedral transform, see `DIHEDRAL_TRANSFORMS`.
+#   translation     The integer (row, col) translation, applied after the transform.
+#   errors          The error distance for each tube (in the order of the aligned coordinates).
+#   inliers         Boolean array, True for the tubes that are exactly in place after the transform and translation
+#                   (i.e. with zero error); the other tubes were moved.
+AlignmentResult = namedtuple('AlignmentResult', 'error transform translation errors inliers')
+
+# Methods for estimating the translation for each transform:
+#   'mean'  The rounded mean displacement. Moved tubes skew the estimate, so use this only for unchanged boxes.
+#   'vote'  The modal (most common) integer displacement, i.e. the translation with most tubes exactly in place.
+#           This is robust to moved tubes, and the transform with most inliers is selected.
+ALIGNMENT_METHODS = ('mean', 'vote')
+
+
 def align_coords_by_values(values1, coords1, values2, coords2):
     # OBS: Need to make sure the newly-scanned coords are "aligned" with the old,
     # i.e. we can only use values that are in common, and coords must be in the same order:
@@ -174,3 +197,173 @@ def rot_90deg(x, y, rot90):
         # x-values -> negative y-values
         # y-values -> x-values
         return y, -x
+
+
+def _dihedral_matrices():
+    """ Return (8, 2, 2) stack of matrices for the dihedral transforms of (row, col) coordinates. """
+    basis = np.eye(2, dtype=int)
+    flip = np.array([[1, 0], [0, -1]])  # Mirror left-right (col -> -col).
+    matrices = []
+    for flipped in (False, True):
+        for rotation in (0, 1, 2, 3):
+            # Column j of the matrix is the transformed j-th basis vector:
+            vectors = rotate_coords(basis @ flip if flipped else basis, rotation)
+            matrices.append(vectors.T)
+    return np.stack(matrices)
+
+
+# The eight dihedral transforms of the grid, as (rotation, flipped) tuples, where the
+# coordinates are first mirrored left-right (if flipped), and then rotated (see `rotate_coords()`).
+# Transform 0 is the identity, and transforms 0-3 are the rotations.
+DIHEDRAL_TRANSFORMS = tuple((rotation, flipped) for flipped in (False, True) for rotation in (0, 1, 2, 3))
+DIHEDRAL_MATRICES = _dihedral_matrices()
+
+
+def transform_coords(coords, transform):
+    """ Apply dihedral transform (index into `DIHEDRAL_TRANSFORMS`) to (n, 2) coordinates. """
+    return np.asarray(coords) @ DIHEDRAL_MATRICES[transform].T
+
+
+def calc_best_coords_transform_batch(coords1, coords2, mask=None, transforms=None, method='vote'):
+    """ Find the best dihedral transform and integer translation for a batch of aligned coordinate sets.
+
+    All transforms are evaluated for all candidates in a single, stacked numpy operation.
+    Candidates with different numbers of points are zero-padded to the same length and masked.
+
+    With method='vote', the translation for each transform is the modal displacement vector.
+    The displacements are hashed to integer keys and counted with a single `np.unique()`,
+    so this is O(n log n) for n points. The transform with most inliers (points exactly in place) is selected,
+    with ties broken by the lowest average error, then by the lowest transform index.
+
+    Args:
+        coords1: (m, n, 2) array with the previous coordinates of each candidate (e.g. from the database).
+        coords2: (m, n, 2) array with the scanned coordinates, aligned with coords1.
+        mask: Optional (m, n) boolean array, which is False for the padding points.
+        transforms: Indices of the transforms to evaluate. Defaults to all eight dihedral transforms.
+        method: How to estimate the translation, see `ALIGNMENT_METHODS`.
+
+    Returns:
+        Four-tuple of (error, transform, translation, errors) arrays, with shapes
+            (m,), (m,), (m, 2), (m, n)
+        where `transform(coords2) - translation` is the best match for coords1.
+        The error is NaN (and the transform is -1) for candidates without any points.
+    """
+    if method not in ALIGNMENT_METHODS:
+        raise ValueError(f"Unrecognized alignment `method` '{method}'; must be one of {ALIGNMENT_METHODS}.")
+    coords1 = np.asarray(coords1, dtype=float)
+    coords2 = np.asarray(coords2, dtype=float)
+    if mask is None:
+        mask = np.ones(coords1.shape[:2], dtype=bool)
+    transforms = np.arange(len(DIHEDRAL_MATRICES)) if transforms is None else np.asarray(transforms)
+    matrices = DIHEDRAL_MATRICES[transforms]
+    weights = mask[:, None, :, None]  # (m, 1, n, 1)
+    n_points = mask.sum(axis=1)  # (m,)
+    # (m, t, n, 2): Every candidate's scanned coordinates, in every transform:
+    transformed = np.einsum('tij,mnj->mtni', matrices, coords2)
+    displacements = (transformed - coords1[:, None]) * weights
+    if method == 'vote':
+        shifts, n_inliers = modal_displacements(displacements, mask)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if method == 'mean':
+            shifts = np.round(displacements.sum(axis=2) / n_points[:, None, None])  # (m, t, 2)
+        errors = np.linalg.norm((displacements - shifts[:, :, None]) * weights, axis=-1)  # (m, t, n)
+        mean_errors = errors.sum(axis=2) / n_points[:, None]  # (m, t)
+    mean_errors_inf = np.where(np.isnan(mean_errors), np.inf, mean_errors)
+    if method == 'vote':
+        # Only consider the transforms with most inliers:
+        mean_errors_inf = np.where(n_inliers == n_inliers.max(axis=1, keepdims=True), mean_errors_inf, np.inf)
+    best = np.argmin(mean_errors_inf, axis=1)  # First (lowest) transform wins ties.
+    idx = np.arange(len(best))
+    error = mean_errors[idx, best]
+    transform = np.where(n_points > 0, transforms[best], -1)
+    translation = np.nan_to_num(shifts[idx, best]).astype(int)
+    return error, transform, translation, errors[idx, best]
+
+
+def modal_displacements(displacements, mask):
+    """ Return the most common integer displacement vector (and its count) for each candidate and transform.
+
+    Args:
+        displacements: (m, t, n, 2) integer-valued displacement vectors.
+        mask: (m, n) boolean array, False for padding points.
+
+    Returns:
+        Two-tuple of (shifts, counts), with shapes (m, t, 2) and (m, t).
+    """
+    m, t, n, _ = displacements.shape
+    shifts = np.zeros((m, t, 2))
+    counts = np.zeros((m, t), dtype=int)
+    if n == 0 or not mask.any():
+        return shifts, counts
+    disp = displacements.astype(np.int64)
+    lo = disp.min(axis=(0, 1, 2))
+    span = disp.max(axis=(0, 1, 2)) - lo + 1
+    # Hash each displacement vector to a unique integer key, offset for each (candidate, transform) group,
+    # and count the (non-padding) keys sparsely, since most of the m*t*n_keys possible keys never occur:
+    keys = (disp[..., 0] - lo[0]) * span[1] + (disp[..., 1] - lo[1])  # (m, t, n)
+    n_keys = int(span[0] * span[1])
+    group_keys = keys + np.arange(m * t, dtype=np.int64).reshape(m, t, 1) * n_keys
+    unique_keys, key_counts = np.unique(
+        group_keys[np.broadcast_to(mask[:, None, :], keys.shape)], return_counts=True)
+    groups, keys = np.divmod(unique_keys, n_keys)
+    # Sort by group, then by descending count, then by key (so the lowest key wins ties), and take the first:
+    order = np.lexsort((keys, -key_counts, groups))
+    first = order[np.r_[True, groups[order][1:] != groups[order][:-1]]]
+    shifts.reshape(m * t, 2)[groups[first]] = np.stack(np.divmod(keys[first], span[1]), axis=-1) + lo
+    counts.reshape(m * t)[groups[first]] = key_counts[first]
+    return shifts, counts
+
+
+def calc_best_coords_transform_result(coords1, coords2, transforms=None, method='vote') -> AlignmentResult:
+    """ Find the best dihedral transform (rotation and/or flip) and integer translation to align
+    the scanned coordinates `coords2` onto the previous coordinates `coords1`.
+
+    Args:
+        coords1: (n, 2) coordinates, e.g. the tube-barcode box-grid coordinates in the database.
+        coords2: (n, 2) coordinates of the same values, e.g. for the barcodes that were just scanned.
+            The points must be aligned, see `align_coords_by_values()`.
+        transforms: Indices of the transforms to evaluate. Defaults to all eight dihedral transforms.
+        method: How to estimate the translation, see `ALIGNMENT_METHODS`.
+            The default, 'vote', gives the exact rotation and shift even if some tubes were moved.
+
+    Returns:
+        AlignmentResult namedtuple with (error, transform, translation, errors, inliers).
+    """
+    error, transform, translation, errors = calc_best_coords_transform_batch(
+        np.asarray(coords1)[None], np.asarray(coords2)[None], transforms=transforms, method=method)
+    return AlignmentResult(error[0], int(transform[0]), translation[0], errors[0], errors[0] == 0)
+
+
+def calc_best_values_coords_transform_batch(values, coords, candidates, transforms=None, method='vote') -> list:
+    """ Score many candidate boxes against one scan in a single batched call.
+
+    Args:
+        values: The scanned values (barcodes).
+        coords: (n, 2) coordinates of the scanned values.
+        candidates: List of (values, coords) tuples, e.g. the previous barcodes and coordinates of each box.
+        transforms: Indices of the transforms to evaluate. Defaults to all eight dihedral transforms.
+        method: How to estimate the translation, see `ALIGNMENT_METHODS`.
+
+    Returns:
+        List with an AlignmentResult for each candidate, where `errors` are for the values common to
+        the candidate and the scan (in the candidate's order). Candidates without any values in common
+        with the scan have error NaN and transform -1.
+    """
+    aligned = [align_coords_by_values(cand_values, cand_coords, values, coords)
+               for cand_values, cand_coords in candidates]
+    n_max = max([len(coords1) for coords1, _ in aligned], default=0)
+    coords1_batch = np.zeros((len(aligned), n_max, 2))
+    coords2_batch = np.zeros((len(aligned), n_max, 2))
+    mask = np.zeros((len(aligned), n_max), dtype=bool)
+    for i, (coords1, coords2) in enumerate(aligned):
+        if len(coords1):
+            coords1_batch[i, :len(coords1)] = coords1
+            coords2_batch[i, :len(coords2)] = coords2
+            mask[i, :len(coords1)] = True
+    error, transform, translation, errors = calc_best_coords_transform_batch(
+        coords1_batch, coords2_batch, mask=mask, transforms=transforms, method=method)
+    errors = [errors[i, :mask[i].sum()] for i in range(len(aligned))]
+    return [
+        AlignmentResult(error[i], int(transform[i]), translation[i], errors[i], errors[i] == 0)
+        for i in range(len(aligned))
+    ]